@@ -13,9 +13,8 @@
 # limitations under the License.
 
 from uptimeserver.config import Config
-from uptimeserver.providers import IngressProvider, IngressProviderConfig
+from uptimeserver.providers import IngressProvider, RulesIngressProviderConfig
 from uptimeserver.services import *
-import re
 
 class CustomConfig(Config):
     def configure(self, server, monitoring):
@@ -44,33 +43,22 @@ class CustomConfig(Config):
         
         super().configure(server, monitoring)
         
-class CustomIngressProviderConfig(IngressProviderConfig):
+class CustomIngressProviderConfig(RulesIngressProviderConfig):
     """ Custom Configuration for IngressProvider
     
+    Only ypcloud.io urls are monitored (not the site ones) and kong urls need an apikey.
+    
     Constructor
     
     Args:
         config (Config): configuration
     """
     
-    regex_global_ypcloud = re.compile(".*ypcloud.io.*")
-    regex_sites_ypcloud = re.compile(".*(aws|gce).ypcloud.io.*")
-    regex_kong_ypcloud = re.compile(".*ypapi.ypcloud.io.*")
-    
     def __init__(self, config):
         self.config = config
-    
-    def exclude(self, url):
-        if self.regex_sites_ypcloud.match(url) is not None or \
-            self.regex_global_ypcloud.match(url) is None:
-            return True
-            
-        return False
-    
-    def headers(self, url):
-        if self.regex_kong_ypcloud.match(url) is not None:
-            headers = {"apikey" : self.config.secret.get("KONG_HEALTH_APIKEY", "")}
-        else:
-            headers = {}
         
-        return headers
+        super().__init__([
+            {"regex": ".*(aws|gce).ypcloud.io.*", "exclude": True},
+            {"regex": ".*ypapi.ypcloud.io.*", "headers": {"apikey" : self.config.secret.get("KONG_HEALTH_APIKEY", "")}},
+            {"regex": ".*ypcloud.io.*", "exclude": False}
+        ], default_exclude=True)
@@ -6,6 +6,9 @@ setup(
     version='1.1.0',
     python_requires='>=3.5',
     packages=find_packages(),
+    entry_points={
+        'console_scripts': ['uptimeserver-backfill=uptimeserver.backfill:main'],
+    },
     install_requires=['kubernetes', 'pymongo', 'python-dateutil', 'requests', 'elasticsearch', 'requests-aws4auth'],
 
     # Metadata
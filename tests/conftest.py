@@ -0,0 +1,34 @@
+# Copyright (c) 2018 Yellow Pages Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Shared fixtures
+
+Tests using MongoDB run on mongomock and are skipped if it is not installed.
+"""
+
+import pymongo
+import pytest
+
+@pytest.fixture
+def mongo(monkeypatch):
+    """MongoDB server shared by all the clients created during the test
+
+    Returns:
+        MongoClient: a mongomock client
+    """
+    mongomock = pytest.importorskip("mongomock")
+    server = mongomock.MongoClient()
+    monkeypatch.setattr(pymongo, "MongoClient", lambda *args, **kwargs: server)
+    return server
@@ -0,0 +1,95 @@
+# Copyright (c) 2018 Yellow Pages Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+BulkWriter tests
+
+Failed writes are kept and only those are retried when a period is resumed.
+"""
+
+import pymongo
+import pytest
+
+from uptimeserver.consolidation import BulkWriter
+
+class Collection:
+    """Collection failing the writes of some documents"""
+
+    name = "daily_uptime"
+
+    def __init__(self, failing=None):
+        self.failing = set(failing or [])
+        self.written = []
+
+    def bulk_write(self, batch, ordered=True):
+        errors = [{"index": index} for index, operation in enumerate(batch) if operation in self.failing]
+        self.written.extend(operation for operation in batch if operation not in self.failing)
+        if len(errors) > 0:
+            raise pymongo.errors.BulkWriteError({"writeErrors": errors})
+
+def test_batches():
+    collection = Collection()
+    writer = BulkWriter(collection, batch_size=2)
+    writer.reset(100)
+
+    writer.add("a")
+    assert collection.written == []
+    writer.add("b")
+    assert collection.written == ["a", "b"]
+
+    writer.add("c")
+    writer.done()
+    assert collection.written == ["a", "b", "c"]
+    assert not writer.resumable(100)
+
+def test_only_failed_writes_are_resumed():
+    collection = Collection(failing=["b"])
+    writer = BulkWriter(collection, batch_size=10)
+    writer.reset(100)
+    for operation in ["a", "b", "c"]:
+        writer.add(operation)
+
+    with pytest.raises(Exception):
+        writer.done()
+
+    assert writer.resumable(100)
+    assert not writer.resumable(200)
+
+    # the backend is back
+    collection.failing = set()
+    assert writer.retry()
+    assert collection.written == ["a", "c", "b"]
+    assert not writer.resumable(100)
+
+def test_period_not_complete_is_not_resumable():
+    collection = Collection(failing=["a"])
+    writer = BulkWriter(collection, batch_size=1)
+    writer.reset(100)
+    writer.add("a")
+
+    # done was not reached (eg: the computation failed)
+    assert not writer.written()
+    assert not writer.resumable(100)
+
+def test_reset_drops_failed_writes():
+    collection = Collection(failing=["a"])
+    writer = BulkWriter(collection, batch_size=10)
+    writer.reset(100)
+    writer.add("a")
+    with pytest.raises(Exception):
+        writer.done()
+
+    writer.reset(200)
+    assert not writer.resumable(100)
+    assert writer.failed == []
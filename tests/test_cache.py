@@ -0,0 +1,167 @@
+# Copyright (c) 2018 Yellow Pages Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+SLACache tests
+"""
+
+from collections import OrderedDict
+import time
+
+from uptimeserver.cache import SLACache
+from uptimeserver.services import IngressService, Service
+from uptimeserver.storage import MemoryStorage
+
+DAY = 1514764800 # 2018-01-01 UTC
+
+def test_invalidate_overlapping_periods():
+    cache = SLACache()
+    cache.set("a", DAY, 86400, 90)
+    cache.set("a", DAY + 86400, 86400, 95)
+    cache.set("b", DAY, 86400, 80)
+
+    cache.invalidate("a", DAY + 86400 + 60, DAY + 86400 + 120)
+
+    assert cache.get("a", DAY, 86400) == 90
+    assert cache.get("a", DAY + 86400, 86400) is None
+    assert cache.get("b", DAY, 86400) == 80
+
+def test_open_downtime_invalidates_all_next_periods():
+    cache = SLACache()
+    cache.set("a", DAY, 86400, 90)
+    cache.set("a", DAY + 86400, 86400, 95)
+
+    cache.invalidate("a", DAY + 60)
+
+    assert cache.get("a", DAY, 86400) is None
+    assert cache.get("a", DAY + 86400, 86400) is None
+
+def test_set_after_invalidation_is_ignored():
+    cache = SLACache()
+    version = cache.version("a")
+
+    # a downtime is written during the computation
+    cache.invalidate("a", DAY)
+    cache.set("a", DAY, 86400, 100, version=version)
+    assert cache.get("a", DAY, 86400) is None
+
+    cache.set("a", DAY, 86400, 90, version=cache.version("a"))
+    assert cache.get("a", DAY, 86400) == 90
+
+def test_lru_eviction():
+    cache = SLACache(max_entries=2)
+    cache.set("a", DAY, 86400, 90)
+    cache.set("b", DAY, 86400, 80)
+    cache.get("a", DAY, 86400)
+    cache.set("c", DAY, 86400, 70)
+
+    assert cache.get("a", DAY, 86400) == 90
+    assert cache.get("b", DAY, 86400) is None
+    assert cache.get("c", DAY, 86400) == 70
+
+def test_persisted_entries(mongo):
+    collection = mongo["uptime"]["sla_cache"]
+    SLACache(collection=collection).set("a", DAY, 86400, 90)
+
+    # a restart
+    cache = SLACache(collection=collection)
+    assert cache.get("a", DAY, 86400) == 90
+
+    cache.invalidate("a", DAY + 60, DAY + 120)
+    assert collection.count_documents({}) == 0
+    assert SLACache(collection=collection).get("a", DAY, 86400) is None
+
+def test_storage_invalidates_on_write():
+    storage = MemoryStorage(sla_cache={"max_entries": 10})
+    service = IngressService("ns", "a", "https://a.example.com/health")
+    storage.svc_all(service, Service.OK, None)
+    id_svc = service.storage_get(storage.storage_id_svc)
+
+    # closed period
+    assert storage.stats_get_svc_sla(service, DAY, 86400) == 100
+    assert storage.sla_cache.get(id_svc, DAY, 86400) == 100
+
+    version = storage.sla_cache.version(id_svc)
+    storage.svc_all(service, Service.FAIL, None)
+    assert storage.sla_cache.version(id_svc) != version
+
+def test_versions_are_bounded():
+    cache = SLACache(max_entries=2)
+    versions = {id_svc: cache.version(id_svc) for id_svc in ["a", "b"]}
+    cache.invalidate("b", DAY)
+    cache.invalidate("c", DAY)
+    cache.invalidate("d", DAY)
+    assert len(cache.versions) == 2
+
+    # b was evicted: a SLA computed before an eviction can't be stored (even for a)
+    for id_svc, version in versions.items():
+        cache.set(id_svc, DAY, 86400, 90, version=version)
+        assert cache.get(id_svc, DAY, 86400) is None
+
+def test_ttl(monkeypatch):
+    cache = SLACache(ttl=60)
+    cache.set("a", DAY, 86400, 90)
+    assert cache.get("a", DAY, 86400) == 90
+
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 120)
+    assert cache.get("a", DAY, 86400) is None
+    assert cache.entries == OrderedDict()
+
+class Racing:
+    """Collection invalidating the cache during a read or before a write"""
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.during = None
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+    def race(self):
+        during, self.during = self.during, None
+        if during is not None:
+            during()
+
+    def find_one(self, *args, **kwargs):
+        result = self.collection.find_one(*args, **kwargs)
+        self.race()
+        return result
+
+    def update_one(self, *args, **kwargs):
+        self.race()
+        return self.collection.update_one(*args, **kwargs)
+
+def test_invalidation_during_a_read(mongo):
+    collection = Racing(mongo["uptime"]["sla_cache"])
+    SLACache(collection=collection).set("a", DAY, 86400, 90)
+
+    cache = SLACache(collection=collection)
+    collection.during = lambda: cache.invalidate("a", DAY + 60, DAY + 120)
+
+    # read before the invalidation
+    assert cache.get("a", DAY, 86400) is None
+    assert cache.entries == OrderedDict()
+    assert cache.get("a", DAY, 86400) is None
+
+def test_invalidation_during_a_write(mongo):
+    collection = Racing(mongo["uptime"]["sla_cache"])
+    cache = SLACache(collection=collection)
+    version = cache.version("a")
+    collection.during = lambda: cache.invalidate("a", DAY + 60, DAY + 120)
+
+    # the invalidation removes the persisted entries before the write
+    cache.set("a", DAY, 86400, 90, version=version)
+    assert cache.get("a", DAY, 86400) is None
+    assert collection.count_documents({}) == 0
@@ -0,0 +1,76 @@
+# Copyright (c) 2018 Yellow Pages Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+MongoStorageConsolidationSLA tests
+
+SLA are collected by a custom hook (bulk_write is not available on mongomock).
+"""
+
+from bson.objectid import ObjectId
+
+from uptimeserver.consolidation import MongoStorageConsolidationSLA
+from uptimeserver.storage import MongoStorage
+
+DAY = 86400
+WEEK = 1514764800 # Monday 2018-01-01 UTC
+
+def consolidation(services=2):
+    storage = MongoStorage("mongodb://localhost", "uptime")
+    ids = sorted(storage.uptime.insert_one({"name": str(i)}).inserted_id for i in range(services))
+    return MongoStorageConsolidationSLA(storage), ids
+
+def daily(consolidation, id_svc, day, down):
+    consolidation.daily_uptime.insert_one({"_id_uptime": id_svc, "date": WEEK + day * DAY, "duration": DAY, "down": down, "sla": 100 - (down * 100 / DAY)})
+
+def rollup(consolidation):
+    results = {}
+    consolidation.get_all_weekly_sla(WEEK, lambda service, sla, down: results.__setitem__(service["_id"], down))
+    return results
+
+def test_rollup_from_dailies(mongo):
+    sla, (a, b) = consolidation()
+    for day in range(7):
+        daily(sla, a, day, 60)
+    daily(sla, b, 0, 600)
+
+    # daily SLA of a service that doesn't exist anymore
+    daily(sla, ObjectId(), 0, 600)
+
+    # only read for the days without daily SLA
+    sla.storage.uptime_history.insert_one({"_id_uptime": b, "down_start_date": WEEK + 3 * DAY, "down_end_date": WEEK + 3 * DAY + 120})
+    sla.storage.uptime_history.insert_one({"_id_uptime": a, "down_start_date": WEEK + 3 * DAY, "down_end_date": WEEK + 3 * DAY + 120})
+
+    assert rollup(sla) == {a: 7 * 60, b: 600 + 120}
+
+def test_rollup_skips_dailies_not_aligned(mongo):
+    sla, (a,) = consolidation(1)
+    sla.daily_uptime.insert_one({"_id_uptime": a, "date": WEEK - 3600, "duration": DAY, "down": 600})
+    sla.storage.uptime_history.insert_one({"_id_uptime": a, "down_start_date": WEEK + 60, "down_end_date": WEEK + 120})
+
+    assert rollup(sla) == {a: 60}
+
+def test_rollup_resumes_after_checkpoint(mongo):
+    sla, (a, b) = consolidation()
+    sla.resume_sla("weekly", WEEK)
+    sla.checkpoint_sla("weekly", WEEK, a)
+
+    assert rollup(sla) == {b: 0}
+
+    # checkpoint of another period
+    sla.checkpoint_sla("weekly", WEEK + 7 * DAY, a)
+    assert rollup(sla) == {a: 0, b: 0}
+
+    sla.checkpoint_clear("weekly")
+    assert sla.consolidation_state.count_documents({}) == 0
@@ -0,0 +1,84 @@
+# Copyright (c) 2018 Yellow Pages Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+MongoStorage extra_policy tests
+"""
+
+import time
+
+from uptimeserver.services import IngressService, Service
+from uptimeserver.storage import MongoStorage
+
+EXTRA = {"status_code": 500, "text": "x" * 1000, "headers": ["a" * 100]}
+
+def downtimes(storage, service):
+    return list(storage.stats_iter_svc_downtimes(service, time.time() - 60, 120))
+
+def fail(storage, name):
+    service = IngressService("ns", name, "https://%s.example.com/health" % (name))
+    storage.svc_all(service, Service.FAIL, EXTRA)
+    return service
+
+def test_truncate_and_compress(mongo):
+    storage = MongoStorage("mongodb://localhost", "uptime", extra_policy={"max_size": 10, "compress": True})
+    service = fail(storage, "a")
+
+    stored = storage.uptime_history.find_one()
+    assert "extra" not in stored and "extra_z" in stored
+
+    assert downtimes(storage, service)[0]["extra"] == {"status_code": 500, "text": "x" * 10, "headers": ["a" * 10]}
+
+    # the projection excludes the encoded extra
+    assert all("extra_z" not in downtime and "extra" not in downtime \
+        for downtime in storage.stats_iter_svc_downtimes(service, time.time() - 60, 120, projection={"extra": 0}))
+
+def test_dedup(mongo):
+    storage = MongoStorage("mongodb://localhost", "uptime", extra_policy={"compress": True, "dedup": True})
+    services = [fail(storage, name) for name in ["a", "b"]]
+
+    assert storage.uptime_extra.count_documents({}) == 1
+    for service in services:
+        assert downtimes(storage, service)[0]["extra"] == EXTRA
+
+def test_without_policy(mongo):
+    storage = MongoStorage("mongodb://localhost", "uptime")
+    service = fail(storage, "a")
+
+    assert storage.uptime_history.find_one()["extra"] == EXTRA
+    assert downtimes(storage, service)[0]["extra"] == EXTRA
+
+def test_retention_archives_and_removes_extra(mongo, tmp_path):
+    storage = MongoStorage("mongodb://localhost", "uptime", history_partitioning="monthly", extra_policy={"dedup": True})
+    service = fail(storage, "a")
+    storage.svc_all(service, Service.OK, None)
+
+    # still referenced by an open downtime
+    fail(storage, "b")
+
+    storage.uptime_extra.update_many({}, { "$set" : {"last_used": 0} })
+    assert len(storage.history_retention(time.time() + 86400 * 62, str(tmp_path))) == 1
+    assert storage.uptime_extra.count_documents({}) == 1
+    assert len(list(tmp_path.glob("*.uptime_extra.bson.gz"))) == 1
+
+    storage.uptime_history.delete_many({})
+    assert storage.extra_gc([storage.uptime_extra.find_one()["_id"]], time.time() - 300) == 1
+
+def test_extra_used_recently_is_kept(mongo):
+    storage = MongoStorage("mongodb://localhost", "uptime", history_partitioning="monthly", extra_policy={"dedup": True})
+    service = fail(storage, "a")
+    storage.svc_all(service, Service.OK, None)
+
+    storage.history_retention(time.time() + 86400 * 62)
+    assert storage.uptime_extra.count_documents({}) == 1
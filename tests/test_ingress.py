@@ -0,0 +1,181 @@
+# Copyright (c) 2018 Yellow Pages Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+IngressProvider tests
+
+The Kubernetes API is replaced by a list of ingresses (no cluster needed).
+"""
+
+from types import SimpleNamespace
+
+import pytest
+
+from uptimeserver import providers
+from uptimeserver.monitoring import ServicesMonitoring
+from uptimeserver.providers import IngressProvider
+
+def ingress(ns, name, hosts, paths=["/"]):
+    """An ingress with the same paths on every host"""
+    rules = [SimpleNamespace(host=host, http=SimpleNamespace(paths=[SimpleNamespace(path=path) for path in paths])) for host in hosts]
+    return SimpleNamespace(kind="Ingress", \
+        metadata=SimpleNamespace(namespace=ns, name=name, resource_version="1"), \
+        spec=SimpleNamespace(rules=rules))
+
+def event(action, ingress):
+    return {"type": action, "object": ingress}
+
+class Kubernetes:
+    """Ingresses listed by pages"""
+
+    def __init__(self, ingresses):
+        self.ingresses = ingresses
+        self.calls = []
+
+    def page(self, ingresses, limit, _continue):
+        start = int(_continue or 0)
+        _continue = None
+        if start + limit < len(ingresses):
+            _continue = str(start + limit)
+        return SimpleNamespace(items=ingresses[start:start + limit], \
+            metadata=SimpleNamespace(resource_version="100", _continue=_continue))
+
+    def list_ingress_for_all_namespaces(self, limit=None, _continue=None, **kwargs):
+        self.calls.append((None, kwargs))
+        return self.page(self.ingresses, limit, _continue)
+
+    def list_namespaced_ingress(self, namespace, limit=None, _continue=None, **kwargs):
+        self.calls.append((namespace, kwargs))
+        return self.page([ingress for ingress in self.ingresses if ingress.metadata.namespace == namespace], limit, _continue)
+
+@pytest.fixture
+def provider(monkeypatch):
+    k8s = Kubernetes([])
+    monkeypatch.setattr(providers.config, "new_client_from_config", lambda context=None: None)
+    monkeypatch.setattr(providers.client, "ExtensionsV1beta1Api", lambda api_client=None: k8s, raising=False)
+
+    monitoring = ServicesMonitoring()
+    provider = IngressProvider("ingress", "context", monitoring)
+    provider.debounce_seconds = 0
+    yield provider
+    provider.stopProvider()
+
+def urls(provider):
+    return sorted(service.url for service in provider.services())
+
+def test_relist_applies_the_difference(provider):
+    provider.list_limit = 1
+    provider.k8s.ingresses = [ingress("ns", "a", ["a1.example.com", "a2.example.com"]), ingress("ns", "b", ["b.example.com"])]
+    provider.ingress_relist()
+
+    assert urls(provider) == ["https://a1.example.com/health", "https://a2.example.com/health", "https://b.example.com/health"]
+    assert provider.resource_versions[None] == "100"
+    kept = [service for service in provider.services() if service.url == "https://a1.example.com/health"][0]
+
+    provider.k8s.ingresses = [ingress("ns", "a", ["a1.example.com"]), ingress("ns", "c", ["c.example.com"])]
+    provider.ingress_relist()
+
+    assert urls(provider) == ["https://a1.example.com/health", "https://c.example.com/health"]
+    # the services that didn't change are kept
+    assert any(service is kept for service in provider.services())
+
+def test_events_only_apply_the_difference(provider):
+    provider.dispatch_ingress_event(event("ADDED", ingress("ns", "a", ["a.example.com"], ["/v1", "v2"])))
+    assert urls(provider) == ["https://a.example.com/v1/health", "https://a.example.com/v2/health"]
+    kept = [service for service in provider.services() if service.url == "https://a.example.com/v1/health"][0]
+
+    provider.dispatch_ingress_event(event("MODIFIED", ingress("ns", "a", ["a.example.com"], ["/v1", "/v3"])))
+    assert urls(provider) == ["https://a.example.com/v1/health", "https://a.example.com/v3/health"]
+    assert any(service is kept for service in provider.services())
+
+    # same url on another ingress
+    provider.dispatch_ingress_event(event("ADDED", ingress("other", "a", ["a.example.com"], ["/v1"])))
+    provider.dispatch_ingress_event(event("DELETED", ingress("ns", "a", ["a.example.com"], ["/v1", "/v3"])))
+    assert [(service.ns, service.url) for service in provider.services()] == [("other", "https://a.example.com/v1/health")]
+    assert list(provider.ingresses.keys()) == [("other", "a")]
+
+def test_headers_change_replaces_the_service(provider):
+    provider.ingress_config = SimpleNamespace(exclude=lambda url: "internal" in url, headers=lambda url: {"apikey": "1"})
+    provider.dispatch_ingress_event(event("ADDED", ingress("ns", "a", ["a.example.com", "internal.example.com"])))
+    assert urls(provider) == ["https://a.example.com/health"]
+
+    provider.ingress_config = SimpleNamespace(exclude=lambda url: False, headers=lambda url: {"apikey": "2"})
+    provider.dispatch_ingress_event(event("MODIFIED", ingress("ns", "a", ["a.example.com"])))
+    assert [service.headers for service in provider.services()] == [{"apikey": "2"}]
+
+def test_events_are_debounced(provider):
+    provider.debounce_seconds = 3600
+    provider.dispatch_ingress_event(event("ADDED", ingress("ns", "a", ["a1.example.com"])))
+    provider.dispatch_ingress_event(event("MODIFIED", ingress("ns", "a", ["a2.example.com"])))
+    provider.dispatch_ingress_event(event("ADDED", ingress("ns", "b", ["b.example.com"])))
+    assert urls(provider) == []
+    assert provider.timer is not None
+
+    # end of the window: the latest state of each ingress is applied
+    provider.ingress_flush()
+    assert urls(provider) == ["https://a2.example.com/health", "https://b.example.com/health"]
+    assert provider.events == {}
+
+def test_failing_monitoring_queues_the_events_again(provider):
+    provider.debounce_seconds = 3600
+    provider.dispatch_ingress_event(event("ADDED", ingress("ns", "a", ["a.example.com"])))
+
+    def fail(added, removed):
+        raise Exception("monitoring issue")
+    provider.services_update = fail
+    provider.ingress_flush()
+
+    assert provider.ingresses == {}
+    assert list(provider.events.keys()) == [("ns", "a")]
+    assert provider.timer is not None
+
+    del provider.services_update
+    provider.ingress_flush()
+    assert urls(provider) == ["https://a.example.com/health"]
+
+def test_bad_ingress_keeps_its_services(provider):
+    provider.dispatch_ingress_event(event("ADDED", ingress("ns", "a", ["a.example.com"])))
+
+    broken = ingress("ns", "a", ["a.example.com"])
+    broken.spec.rules = None
+    provider.dispatch_ingress_event(event("MODIFIED", broken))
+    provider.dispatch_ingress_event(event("ADDED", ingress("ns", "b", ["b.example.com"])))
+
+    assert urls(provider) == ["https://a.example.com/health", "https://b.example.com/health"]
+
+def test_namespaced_relist_with_selectors(provider):
+    provider.namespaces = ["a", "b"]
+    provider.label_selector = "uptime=enabled"
+    provider.k8s.ingresses = [ingress("a", "x", ["x.example.com"]), ingress("b", "y", ["y.example.com"])]
+    provider.ingress_relist("a")
+    provider.ingress_relist("b")
+
+    assert provider.k8s.calls == [("a", {"label_selector": "uptime=enabled"}), ("b", {"label_selector": "uptime=enabled"})]
+
+    # a relist only applies the ingresses of its namespace
+    provider.k8s.ingresses = []
+    provider.ingress_relist("a")
+    assert urls(provider) == ["https://y.example.com/health"]
+
+def test_relist_keeps_the_services_of_a_bad_ingress(provider):
+    provider.k8s.ingresses = [ingress("ns", "a", ["a.example.com"]), ingress("ns", "b", ["b.example.com"])]
+    provider.ingress_relist()
+
+    broken = ingress("ns", "a", ["a.example.com"])
+    broken.spec.rules = None
+    provider.k8s.ingresses = [broken, ingress("ns", "c", ["c.example.com"])]
+    provider.ingress_relist()
+
+    assert urls(provider) == ["https://a.example.com/health", "https://c.example.com/health"]
+    assert provider.resource_versions[None] == "100"
@@ -0,0 +1,137 @@
+# Copyright (c) 2018 Yellow Pages Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+HashRing and PartitionedInstance tests
+"""
+
+import time
+from types import SimpleNamespace
+
+from uptimeserver.instances import HashRing, OneInstanceLock, PartitionedInstance
+from uptimeserver.monitoring import ServicesMonitoring
+from uptimeserver.services import MongoService
+
+KEYS = ["IngressService:https://host%d.example.com/health" % (i) for i in range(3000)]
+
+def owners(ring):
+    return {key: ring.owner(key) for key in KEYS}
+
+def test_distribution():
+    ring = HashRing(["a", "b", "c"])
+    counts = {}
+    for owner in owners(ring).values():
+        counts[owner] = counts.get(owner, 0) + 1
+
+    assert sorted(counts.keys()) == ["a", "b", "c"]
+    for count in counts.values():
+        assert 0.25 * len(KEYS) < count < 0.42 * len(KEYS)
+
+def test_stable_between_instances():
+    assert owners(HashRing(["a", "b", "c"])) == owners(HashRing(["c", "a", "b"]))
+
+def test_member_joining_only_takes_keys():
+    before = owners(HashRing(["a", "b", "c"]))
+    after = owners(HashRing(["a", "b", "c", "d"]))
+
+    moved = [key for key in KEYS if before[key] != after[key]]
+    assert all(after[key] == "d" for key in moved)
+    assert 0.15 * len(KEYS) < len(moved) < 0.35 * len(KEYS)
+
+def test_member_leaving_only_gives_its_keys():
+    before = owners(HashRing(["a", "b", "c"]))
+    after = owners(HashRing(["a", "b"]))
+
+    assert all(before[key] == "c" for key in KEYS if before[key] != after[key])
+
+class Collection:
+    def index_information(self):
+        return {"_id_": {}}
+
+def member(id, alive=10):
+    """A member without MongoDB (only the partitions are used)"""
+    wakes = []
+    server = SimpleNamespace(
+        storage=SimpleNamespace(db=SimpleNamespace(get_collection=lambda name: Collection())),
+        monitoring=SimpleNamespace(partition=None, wake=lambda: wakes.append(True)),
+        consolidations=[])
+
+    instance = PartitionedInstance(server, alive=alive, inactive_during=3 * alive)
+    instance.id = id
+    instance.lease_until = time.monotonic() + 3600
+    return instance, wakes
+
+def test_rebalance_settles_before_taking_keys():
+    instance, wakes = member("a")
+    instance.rebalance(["a", "b"])
+
+    # not settled yet: nothing is owned
+    assert not any(instance.owned(key) for key in KEYS)
+
+    instance.pending_at = time.monotonic()
+    instance.rebalance(["a", "b"])
+
+    ring = HashRing(["a", "b"])
+    assert all(instance.owned(key) == (ring.owner(key) == "a") for key in KEYS)
+    assert wakes == [True]
+
+def test_rebalance_releases_keys_right_away():
+    instance, wakes = member("a")
+    instance.rebalance(["a"])
+    instance.pending_at = time.monotonic()
+    instance.rebalance(["a"])
+    assert all(instance.owned(key) for key in KEYS)
+
+    # a member joins: its keys are released before the settle, the others are kept
+    instance.rebalance(["a", "b"])
+    ring = HashRing(["a", "b"])
+    assert all(instance.owned(key) == (ring.owner(key) == "a") for key in KEYS)
+
+def test_lease_expired_owns_nothing():
+    instance, wakes = member("a")
+    instance.rebalance(["a"])
+    instance.pending_at = time.monotonic()
+    instance.rebalance(["a"])
+
+    instance.lease_until = time.monotonic() - 1
+    assert not any(instance.owned(key) for key in KEYS)
+
+def lock(services):
+    """An active instance monitoring services (without MongoDB)"""
+    monitoring = ServicesMonitoring()
+    monitoring.add_many(services)
+    server = SimpleNamespace(
+        storage=SimpleNamespace(db=SimpleNamespace(get_collection=lambda name: Collection())),
+        monitoring=monitoring,
+        scheduler=SimpleNamespace(next_runs=lambda: {}),
+        consolidations=[])
+    return OneInstanceLock(server)
+
+def test_services_with_the_same_name_are_kept_apart():
+    def services():
+        return [MongoService("db", "mongodb://user:secret@a"), MongoService("db", "mongodb://user:secret@b")]
+
+    a, b = services()
+    assert a.identity_key() != b.identity_key()
+    assert "secret" not in a.identity_key()
+
+    a.checked = True
+    a.failure_counter = 2
+    handoff = lock([a, b]).handoff_state()
+    assert len(handoff["services"]) == 1
+
+    # the next active instance
+    a, b = services()
+    lock([a, b]).handoff_services(handoff)
+    assert (a.failure_counter, b.failure_counter) == (2, 0)
@@ -0,0 +1,135 @@
+# Copyright (c) 2018 Yellow Pages Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+MemoryStorage tests
+
+Downtimes are written with svc_all then moved to fixed dates to compute SLA.
+"""
+
+import time
+
+from uptimeserver.consolidation import MemoryStorageConsolidationSLA, MemoryStorageConsolidationStatus
+from uptimeserver.services import IngressService, Service
+from uptimeserver.storage import MemoryStorage
+
+DAY = 1514764800 # 2018-01-01 UTC
+
+def ingress(name="a"):
+    return IngressService("ns", name, "https://%s.example.com/health" % (name))
+
+def downtime(storage, service, start, end):
+    """Add a downtime to a service at fixed dates"""
+    storage.svc_all(service, Service.FAIL, {"status_code": 500})
+    if end != 0:
+        storage.svc_all(service, Service.OK, None)
+
+    id_svc = service.storage_get(storage.storage_id_svc)
+    document = storage.uptime_history[storage.history_index[id_svc][-1]]
+    document["down_start_date"] = start
+    document["down_end_date"] = end
+    return id_svc
+
+def test_transitions():
+    storage = MemoryStorage()
+    service = ingress()
+
+    assert storage.svc_all(service, Service.FAIL, {"status_code": 500})
+    svc = storage.stats_get_svc(service)
+    assert svc["status"] == Service.FAIL
+
+    current = storage.query_exec_find_current_downtime(None, svc["_id"])
+    assert current["down_end_date"] == 0
+    assert current["extra"] == {"status_code": 500}
+
+    # same status: nothing written
+    assert storage.svc_all(service, Service.FAIL, None)
+    assert len(storage.stats_get_all_downtimes_svc(service, 0, time.time() + 60)) == 1
+
+    assert storage.svc_all(service, Service.OK, None)
+    assert storage.stats_get_svc(service)["status"] == Service.OK
+    assert storage.query_exec_find_current_downtime(None, svc["_id"]) is None
+
+    downtimes = storage.stats_get_all_downtimes_svc(service, 0, time.time() + 60)
+    assert len(downtimes) == 1
+    assert downtimes[0]["down_end_date"] >= downtimes[0]["down_start_date"] > 0
+
+def test_services_are_found_by_identity():
+    storage = MemoryStorage()
+    storage.svc_all(ingress(), Service.FAIL, None)
+
+    # a new object for the same service (eg: provider restarted)
+    service = ingress()
+    assert storage.svc_all(service, Service.OK, None)
+
+    assert len(storage.stats_get_all_svc()) == 1
+    assert storage.stats_get_svc(service)["status"] == Service.OK
+
+def test_sla():
+    storage = MemoryStorage()
+    service = ingress()
+    downtime(storage, service, DAY + 3600, DAY + 2 * 3600)
+    downtime(storage, service, DAY - 600, DAY + 600)
+
+    # 1 hour and the part of the second downtime in the day
+    assert storage.stats_get_svc_sla(service, DAY, 86400) == 100 - (4200 * 100 / 86400)
+    assert storage.stats_get_svc_sla(service, DAY + 86400, 86400) == 100
+
+    # an open downtime is down until the end of the period
+    other = ingress("b")
+    downtime(storage, other, DAY + 86400 / 2, 0)
+    assert storage.stats_get_svc_sla(other, DAY, 86400) == 50
+
+def test_injected_failures():
+    storage = MemoryStorage(failure_rate=1)
+
+    assert not storage.svc_all(ingress(), Service.FAIL, None)
+    assert storage.stats_get_all_svc() == []
+
+def test_consolidations():
+    storage = MemoryStorage()
+    service = ingress()
+    id_svc = downtime(storage, service, DAY, DAY + 8640)
+
+    consolidation = MemoryStorageConsolidationSLA(storage)
+    consolidation.date_daily_sla = DAY + 86400
+    consolidation.compute_daily_sla()
+    assert consolidation.daily_uptime[(id_svc, DAY)] == 90
+
+    status = MemoryStorageConsolidationStatus(storage, {"category": "ns"}, down_time_duration=600)
+    status.compute_status()
+    assert storage.uptime[id_svc]["status_public"] == Service.OK
+
+    # down for more than down_time_duration
+    downtime(storage, service, time.time() - 900, 0)
+    status.compute_status()
+    assert storage.uptime[id_svc]["status_public"] == Service.FAIL
+
+def test_streaming():
+    storage = MemoryStorage()
+    for name in ["c", "a", "b"]:
+        downtime(storage, ingress(name), DAY, DAY + 60)
+    service = ingress("a")
+    downtime(storage, service, DAY + 600, DAY + 660)
+
+    services = list(storage.stats_iter_all_svc(projection=["description"], sort=[("description", -1)], limit=2))
+    assert [svc["description"] for svc in services] == ["https://c.example.com/health", "https://b.example.com/health"]
+    assert sorted(services[0].keys()) == ["_id", "description"]
+
+    downtimes = list(storage.stats_iter_svc_downtimes(service, DAY, 86400, projection={"extra": 0}, sort=[("down_start_date", -1)]))
+    assert [document["down_start_date"] for document in downtimes] == [DAY + 600, DAY]
+    assert all("extra" not in document for document in downtimes)
+
+    assert len(list(storage.stats_iter_all_downtimes(DAY, 86400))) == 4
+    assert len(list(storage.stats_iter_all_downtimes(DAY, 86400, limit=3))) == 3
@@ -0,0 +1,83 @@
+# Copyright (c) 2018 Yellow Pages Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+ServicesMonitoring tests
+
+The monitoring is not started: tasks are only filled.
+"""
+
+from uptimeserver.monitoring import ServicesMonitoring
+from uptimeserver.services import IngressService, MongoService
+
+def ingress(name):
+    return IngressService("ns", name, "https://%s.example.com/health" % (name))
+
+def tasks(monitoring):
+    return [[service.name for service in task.services] for task in monitoring.tasks]
+
+def test_add_many_fills_tasks():
+    monitoring = ServicesMonitoring(max_services=2)
+    monitoring.add(ingress("a"))
+    monitoring.add_many([ingress(name) for name in ["b", "c", "d", "e"]])
+
+    assert tasks(monitoring) == [["a", "b"], ["c", "d"], ["e"]]
+    assert len(monitoring.services()) == 5
+
+def test_duplicates_are_ignored():
+    monitoring = ServicesMonitoring(max_services=10)
+    monitoring.add_many([ingress("a"), ingress("b"), ingress("a")])
+
+    # already added by another provider
+    monitoring.add_many([ingress("b"), ingress("c")], provider="other")
+
+    assert sorted(service.name for service in monitoring.services("default")) == ["a", "b"]
+    assert [service.name for service in monitoring.services("other")] == ["c"]
+    assert tasks(monitoring) == [["a", "b", "c"]]
+
+def test_remove_many_only_removes_services_of_the_provider():
+    monitoring = ServicesMonitoring(max_services=2)
+    monitoring.add_many([ingress(name) for name in ["a", "b", "c"]])
+    monitoring.add_many([ingress("d")], provider="other")
+
+    monitoring.remove_many([ingress("a"), ingress("b"), ingress("d")])
+
+    assert [service.name for service in monitoring.services("default")] == ["c"]
+    assert [service.name for service in monitoring.services("other")] == ["d"]
+    # the empty task is removed
+    assert tasks(monitoring) == [["c", "d"]]
+
+def test_update():
+    monitoring = ServicesMonitoring(max_services=10)
+    monitoring.add_many([ingress("a"), ingress("b")])
+
+    monitoring.update([ingress("c"), ingress("a")], [ingress("a")])
+
+    assert sorted(service.name for service in monitoring.services()) == ["a", "b", "c"]
+
+    # the service can be added again once removed
+    monitoring.remove_provider()
+    assert monitoring.services() == []
+    assert monitoring.tasks == []
+    monitoring.add(ingress("a"))
+    assert tasks(monitoring) == [["a"]]
+
+def test_services_with_the_same_name():
+    monitoring = ServicesMonitoring(max_services=10)
+    monitoring.add_many([MongoService("db", "mongodb://a"), MongoService("db", "mongodb://b")])
+    assert sorted(service.uri for service in monitoring.services()) == ["mongodb://a", "mongodb://b"]
+
+    monitoring.remove(MongoService("db", "mongodb://a"))
+    assert [service.uri for service in monitoring.services()] == ["mongodb://b"]
+    assert [[service.uri for service in task.services] for task in monitoring.tasks] == [["mongodb://b"]]
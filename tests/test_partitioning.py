@@ -0,0 +1,145 @@
+# Copyright (c) 2018 Yellow Pages Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+MongoStorage history partitioning tests
+
+Closed downtimes are written on uptime_history then moved by history_repair.
+"""
+
+import gzip
+import time
+
+import bson
+from bson.objectid import ObjectId
+
+from uptimeserver.services import IngressService, Service
+from uptimeserver.storage import MongoStorage
+
+JAN = 1514764800 # 2018-01-01 UTC
+FEB = 1517443200 # 2018-02-01 UTC
+MAR = 1519862400 # 2018-03-01 UTC
+
+def partitioned():
+    return MongoStorage("mongodb://localhost", "uptime", history_partitioning="monthly")
+
+def closed(storage, id_svc, start, end):
+    """A closed downtime not moved yet"""
+    return storage.uptime_history.insert_one({"_id_uptime": id_svc, "down_start_date": start, "down_end_date": end}).inserted_id
+
+def starts(storage, id_svc, start_date, duration):
+    return sorted(downtime["down_start_date"] for downtime in storage.stats_get_all_downtimes_svc(id_svc, start_date, duration))
+
+def test_closed_downtime_is_moved(mongo):
+    storage = partitioned()
+    service = IngressService("ns", "a", "https://a.example.com/health")
+
+    storage.svc_all(service, Service.FAIL, None)
+    assert storage.uptime_history.count_documents({}) == 1
+
+    storage.svc_all(service, Service.OK, None)
+    assert storage.uptime_history.count_documents({}) == 0
+
+    name = storage.history_partition_name(time.time())
+    assert storage.db.get_collection(name).count_documents({}) == 1
+    assert storage.uptime_history_partitions.find_one({"_id": name}) is not None
+
+    assert len(list(storage.stats_get_all_downtimes_svc(service, time.time() - 60, 120))) == 1
+
+def test_range_reads_overlapping_partitions(mongo):
+    storage = partitioned()
+    id_svc = ObjectId()
+    closed(storage, id_svc, JAN + 86400, JAN + 86400 + 60)
+    # ends after the end of its partition
+    closed(storage, id_svc, FEB - 3600, FEB + 3600)
+    closed(storage, id_svc, MAR + 86400, MAR + 86400 + 60)
+
+    assert storage.history_repair() == 3
+    assert storage.uptime_history.count_documents({}) == 0
+
+    assert storage.history_partitions_for_range(FEB, FEB + 86400) == ["uptime_history_201801"]
+    assert storage.history_partitions_for_range(JAN, MAR + 86400 * 2) == ["uptime_history_201801", "uptime_history_201803"]
+
+    assert starts(storage, id_svc, FEB, 86400) == [FEB - 3600]
+    assert starts(storage, id_svc, JAN, MAR + 86400 * 2 - JAN) == [JAN + 86400, FEB - 3600, MAR + 86400]
+    assert storage.stats_get_svc_sla(id_svc, FEB, 86400) == 100 - (3600 * 100 / 86400)
+
+def test_interrupted_move_is_read_once(mongo):
+    storage = partitioned()
+    id_svc = ObjectId()
+    id_downtime = closed(storage, id_svc, JAN + 60, JAN + 120)
+
+    # moved but not removed from uptime_history
+    downtime = storage.uptime_history.find_one({"_id": id_downtime})
+    storage.history_partition(downtime).insert_one(downtime)
+
+    assert starts(storage, id_svc, JAN, 86400) == [JAN + 60]
+
+    # the move can be replayed
+    storage.history_move_downtime(downtime)
+    assert starts(storage, id_svc, JAN, 86400) == [JAN + 60]
+
+def test_retention(mongo, tmp_path):
+    storage = partitioned()
+    id_svc = ObjectId()
+    closed(storage, id_svc, JAN + 60, JAN + 120)
+    closed(storage, id_svc, JAN + 600, JAN + 660)
+    closed(storage, id_svc, MAR + 60, MAR + 120)
+    storage.history_repair()
+
+    # open downtimes are not partitioned
+    storage.uptime_history.insert_one({"_id_uptime": id_svc, "down_start_date": JAN, "down_end_date": 0})
+
+    assert storage.history_retention(MAR, str(tmp_path)) == ["uptime_history_201801"]
+
+    assert "uptime_history_201801" not in storage.db.list_collection_names()
+    assert storage.history_partitions_for_range(JAN, MAR + 86400) == ["uptime_history_201803"]
+    assert storage.uptime_history.count_documents({}) == 1
+
+    with gzip.open(str(tmp_path / "uptime_history_201801.bson.gz"), "rb") as f:
+        archived = bson.decode_all(f.read())
+    assert sorted(downtime["down_start_date"] for downtime in archived) == [JAN + 60, JAN + 600]
+
+def test_retention_requires_partitioning(mongo):
+    storage = MongoStorage("mongodb://localhost", "uptime")
+    storage.uptime_history.insert_one({"_id_uptime": ObjectId(), "down_start_date": JAN, "down_end_date": JAN + 60})
+
+    assert storage.history_retention(MAR) == []
+    assert storage.uptime_history.count_documents({}) == 1
+
+def test_partition_dropped_by_another_instance(mongo):
+    storage = partitioned()
+    other = partitioned()
+    id_svc = ObjectId()
+    closed(storage, id_svc, JAN + 60, JAN + 120)
+    storage.history_repair()
+
+    assert other.history_retention(FEB) == ["uptime_history_201801"]
+
+    # the partition is created and registered again
+    closed(storage, id_svc, JAN + 600, JAN + 660)
+    storage.history_repair()
+    assert starts(other, id_svc, JAN, 86400) == [JAN + 600]
+
+def test_migrate_moves_closed_downtimes(mongo):
+    id_svc = ObjectId()
+    storage = MongoStorage("mongodb://localhost", "uptime")
+    closed(storage, id_svc, JAN + 60, JAN + 120)
+
+    # the partitioning is enabled later
+    storage = partitioned()
+    storage.migrate()
+
+    assert storage.uptime_history.count_documents({}) == 0
+    assert starts(storage, id_svc, JAN, 86400) == [JAN + 60]
@@ -0,0 +1,105 @@
+# Copyright (c) 2018 Yellow Pages Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+RulesIngressProviderConfig tests
+"""
+
+import importlib.util
+import os
+from types import SimpleNamespace
+
+import pytest
+
+from uptimeserver.providers import RulesIngressProviderConfig
+
+def test_first_matching_rule_wins():
+    config = RulesIngressProviderConfig([
+        {"host_suffix": "aws.example.com", "exclude": True},
+        {"host_suffix": "example.com", "exclude": False}
+    ], default_exclude=True)
+
+    assert config.exclude("https://api.aws.example.com/health")
+    assert not config.exclude("https://api.example.com/health")
+    assert config.exclude("https://example.org/health")
+
+def test_order_between_host_and_other_rules():
+    config = RulesIngressProviderConfig([
+        {"path_prefix": "/internal/", "exclude": True},
+        {"host_suffix": "example.com", "exclude": False},
+        {"regex": ".*/admin/.*", "exclude": True}
+    ], default_exclude=True)
+
+    assert config.exclude("https://example.com/internal/health")
+    assert not config.exclude("https://example.com/admin/health")
+    assert config.exclude("https://example.org/admin/health")
+
+def test_exclude_and_headers_are_decided_separately():
+    config = RulesIngressProviderConfig([
+        {"host_suffix": "api.example.com", "headers": {"apikey": "secret"}},
+        {"host_suffix": "example.com", "exclude": False, "headers": {"apikey": "other"}}
+    ], default_exclude=True, default_headers={"default": "1"})
+
+    assert not config.exclude("https://v1.api.example.com/")
+    assert config.headers("https://v1.api.example.com/") == {"apikey": "secret"}
+    assert config.headers("https://www.example.com/") == {"apikey": "other"}
+    assert config.headers("https://example.org/") == {"default": "1"}
+
+def test_host_suffix_matches_labels():
+    config = RulesIngressProviderConfig([{"host_suffix": "example.com", "exclude": True}])
+
+    assert config.exclude("https://EXAMPLE.com/")
+    assert not config.exclude("https://badexample.com/")
+
+def test_regex_rules_with_groups():
+    config = RulesIngressProviderConfig([
+        {"regex": r"https://(?P<name>a)\.example\.com/", "exclude": True},
+        {"regex": r"https://(?P<name>b)\.example\.com/(\w+)/\2", "headers": {"apikey": "secret"}}
+    ])
+
+    assert config.exclude("https://a.example.com/")
+    assert config.headers("https://b.example.com/v1/v1") == {"apikey": "secret"}
+    assert config.headers("https://b.example.com/v1/v2") == {}
+
+def test_headers_are_copied():
+    config = RulesIngressProviderConfig([{"host_suffix": "example.com", "headers": {"apikey": "secret"}}])
+
+    config.headers("https://example.com/")["apikey"] = "changed"
+    assert config.headers("https://example.com/") == {"apikey": "secret"}
+
+def test_invalid_rules():
+    with pytest.raises(Exception):
+        RulesIngressProviderConfig([{"exclude": True}])
+    with pytest.raises(Exception):
+        RulesIngressProviderConfig([{"host_suffix": "example.com"}])
+
+def test_docker_config_keeps_its_decisions():
+    spec = importlib.util.spec_from_file_location("docker_config", os.path.join(os.path.dirname(__file__), "..", "docker", "config.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    config = module.CustomIngressProviderConfig(SimpleNamespace(secret={"KONG_HEALTH_APIKEY": "secret"}))
+
+    # url -> (exclude, headers) of the regexes used before the rule engine
+    decisions = {
+        "https://www.ypcloud.io/health": (False, {}),
+        "https://api.aws.ypcloud.io/health": (True, {}),
+        "https://eu-aws.ypcloud.io/health": (True, {}),
+        "https://prod-gce.ypcloud.io/v1/health": (True, {}),
+        "https://ypapi.ypcloud.io/v1/health": (False, {"apikey": "secret"}),
+        "https://eu-ypapi.ypcloud.io/health": (False, {"apikey": "secret"}),
+        "https://example.com/ypcloud.io/health": (False, {}),
+        "https://example.com/health": (True, {})
+    }
+    for url, decision in decisions.items():
+        assert (config.exclude(url), config.headers(url)) == decision, url
@@ -0,0 +1,118 @@
+# Copyright (c) 2018 Yellow Pages Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Scheduler tests
+
+Missed runs are tested by dispatching a late job directly (no scheduler thread).
+"""
+
+import threading
+import time
+
+import pytest
+
+from uptimeserver.scheduler import Job, Scheduler
+
+def late_job(scheduler, missed, running=0):
+    """A job due at 100 (monotonic) every 10 seconds, already running or not"""
+    job = scheduler.add("job", lambda: None, interval=10, missed=missed)
+    job.running = running
+    return job
+
+def dispatch(scheduler, job, now, due=100):
+    with scheduler.condition:
+        job.due = due
+        scheduler.dispatch(job, now)
+
+def test_missed_policy_is_validated():
+    with pytest.raises(Exception):
+        Job("job", lambda: None, missed="never")
+
+def test_missed_skip_moves_to_the_next_slot():
+    scheduler = Scheduler(workers=1)
+    job = late_job(scheduler, Job.MISSED_SKIP, running=1)
+
+    dispatch(scheduler, job, 135)
+
+    assert job.due == 140
+    assert job.pending == 0
+
+def test_missed_run_once_runs_now_once():
+    scheduler = Scheduler(workers=1)
+    job = late_job(scheduler, Job.MISSED_RUN_ONCE, running=1)
+
+    dispatch(scheduler, job, 135)
+    assert job.due == 135
+    assert job.pending == 1
+
+    # the run in progress is still not done
+    dispatch(scheduler, job, 135, due=135)
+    assert job.due == 145
+    assert job.pending == 1
+
+def test_missed_run_all_keeps_every_slot():
+    scheduler = Scheduler(workers=1)
+    job = late_job(scheduler, Job.MISSED_RUN_ALL, running=1)
+
+    dispatch(scheduler, job, 135)
+    assert job.due == 110
+
+    dispatch(scheduler, job, 135, due=110)
+    assert job.due == 120
+    assert job.pending == 2
+
+def test_reschedule():
+    scheduler = Scheduler(workers=1)
+    scheduler.add("job", lambda: None, interval=3600, delay=3600)
+
+    assert scheduler.reschedule("job", time.time() + 60)
+    assert abs(scheduler.next_run("job") - (time.time() + 60)) < 1
+
+    # a date in the past runs now
+    assert scheduler.reschedule("job", 0)
+    assert scheduler.next_run("job") <= time.time()
+
+    assert not scheduler.reschedule("unknown", time.time())
+
+def test_reschedule_runs_the_job():
+    scheduler = Scheduler(workers=1)
+    done = threading.Event()
+    scheduler.add("job", done.set, interval=3600, delay=3600)
+    scheduler.start()
+    try:
+        scheduler.reschedule("job", time.time())
+        assert done.wait(5)
+    finally:
+        scheduler.stopScheduler()
+        scheduler.join(5)
+
+    # the next slot is kept
+    assert scheduler.next_run("job") > time.time() + 3000
+
+def test_one_shot_job_is_replaced_by_name():
+    scheduler = Scheduler(workers=1)
+    runs = []
+    done = threading.Event()
+    scheduler.add_at("job", lambda: runs.append("first"), time.time() + 3600)
+    scheduler.add_at("job", lambda: (runs.append("second"), done.set()), time.time())
+    scheduler.start()
+    try:
+        assert done.wait(5)
+    finally:
+        scheduler.stopScheduler()
+        scheduler.join(5)
+
+    assert runs == ["second"]
+    assert scheduler.next_run("job") is None
@@ -0,0 +1,96 @@
+# Copyright (c) 2018 Yellow Pages Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Public status tests
+
+Downtimes are written on a MemoryStorage and the status jobs run on a Scheduler.
+"""
+
+import time
+
+from uptimeserver.consolidation import MemoryStorageConsolidationStatus
+from uptimeserver.scheduler import Scheduler
+from uptimeserver.services import IngressService, Service
+from uptimeserver.storage import MemoryStorage
+
+def wait(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+def test_transitions_schedule_the_public_status():
+    storage = MemoryStorage()
+    service = IngressService("ns", "a", "https://a.example.com/health")
+    storage.svc_all(service, Service.OK, None)
+    id_svc = service.storage_get(storage.storage_id_svc)
+
+    scheduler = Scheduler()
+    status = MemoryStorageConsolidationStatus(storage, {"category": "ns"}, down_time_duration=600)
+    status.schedule(scheduler)
+
+    # down for less than down_time_duration
+    storage.svc_all(service, Service.FAIL, None)
+    assert abs(scheduler.next_run(status.job_name(id_svc)) - (time.time() + 600)) < 5
+
+    storage.svc_all(service, Service.OK, None)
+    assert scheduler.next_run(status.job_name(id_svc)) <= time.time()
+
+    status.stopConsolidation()
+    assert scheduler.next_run("consolidation status") is None
+
+    # the FAIL job is not scheduled anymore
+    storage.svc_all(service, Service.FAIL, None)
+    assert scheduler.next_run(status.job_name(id_svc)) <= time.time()
+
+def test_public_status_flips():
+    storage = MemoryStorage()
+    service = IngressService("ns", "a", "https://a.example.com/health")
+    storage.svc_all(service, Service.OK, None)
+    id_svc = service.storage_get(storage.storage_id_svc)
+
+    scheduler = Scheduler()
+    status = MemoryStorageConsolidationStatus(storage, {"category": "ns"}, down_time_duration=0)
+    status.schedule(scheduler)
+    scheduler.start()
+    try:
+        storage.svc_all(service, Service.FAIL, None)
+        assert wait(lambda: storage.uptime[id_svc].get("status_public") == Service.FAIL)
+
+        storage.svc_all(service, Service.OK, None)
+        assert wait(lambda: storage.uptime[id_svc].get("status_public") == Service.OK)
+    finally:
+        status.stopConsolidation()
+        scheduler.stopScheduler()
+        scheduler.join(5)
+
+def test_resync_schedules_missed_downtimes():
+    storage = MemoryStorage()
+    service = IngressService("ns", "a", "https://a.example.com/health")
+
+    # written before the status listens to the transitions
+    storage.svc_all(service, Service.FAIL, None)
+    id_svc = service.storage_get(storage.storage_id_svc)
+
+    scheduler = Scheduler()
+    status = MemoryStorageConsolidationStatus(storage, {"category": "ns"}, down_time_duration=600)
+    status.schedule(scheduler)
+    assert scheduler.next_run(status.job_name(id_svc)) is None
+
+    status.resync()
+    assert storage.uptime[id_svc]["status_public"] == Service.OK
+    assert abs(scheduler.next_run(status.job_name(id_svc)) - (time.time() + 600)) < 5
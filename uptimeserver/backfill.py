@@ -0,0 +1,91 @@
+# Copyright (c) 2018 Yellow Pages Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Backfill module
+
+Permit to compute again the SLA of a date range from the command line
+
+eg: uptimeserver-backfill --secret secret.json 2018-01-01 2018-02-01
+"""
+
+import argparse
+import sys
+from datetime import datetime
+from .config import Config
+from .server import Server
+from .consolidation import ConsolidationSLA
+
+PERIODS = ["daily", "weekly", "monthly", "yearly"]
+
+def parse_args(argv=None):
+    """Parse the command line
+
+    Keyword Arguments:
+        argv (list): arguments (sys.argv by default)
+
+    Returns:
+        Namespace: arguments
+    """
+    parser = argparse.ArgumentParser(description="Compute again the SLA consolidations of a date range")
+    parser.add_argument("start", help="first day included (YYYY-MM-DD)")
+    parser.add_argument("end", help="last day excluded (YYYY-MM-DD)")
+    parser.add_argument("--secret", default="secret.json", help="configuration file (default: secret.json)")
+    parser.add_argument("--periods", nargs="+", choices=PERIODS, default=PERIODS, help="periods to compute (default: all)")
+    parser.add_argument("--workers", type=int, help="number of threads (default: consolidations.sla.workers)")
+
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    """Compute again the SLA consolidations of a date range
+
+    The storage and the SLA consolidation are created from the configuration like the server does.
+
+    Keyword Arguments:
+        argv (list): arguments (sys.argv by default)
+
+    Returns:
+        int: exit code
+    """
+    args = parse_args(argv)
+
+    secret = Config.load_json(args.secret)
+    if secret is None:
+        print("%s not found !" % args.secret)
+        return 1
+
+    # only the storage and the consolidations are needed
+    secret.setdefault("server", {})["with_consolidation"] = True
+    server = Server(Config(secret), donotconfig=True)
+
+    consolidations = [c for c in server.consolidations if isinstance(c, ConsolidationSLA)]
+    if len(consolidations) == 0:
+        print("No SLA consolidation available !")
+        return 1
+
+    consolidation = consolidations[0]
+    if args.workers is not None:
+        consolidation.workers = args.workers
+
+    start_date = datetime.strptime(args.start, "%Y-%m-%d").timestamp()
+    end_date = datetime.strptime(args.end, "%Y-%m-%d").timestamp()
+
+    failed = consolidation.backfill(start_date, end_date, args.periods)
+    for period, date in failed:
+        print("backfill: %s for %d [FAILED]" % (period, date))
+
+    return 1 if len(failed) > 0 else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,263 @@
+# Copyright (c) 2018 Yellow Pages Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Cache module
+
+Permit to keep some computed results
+"""
+
+from collections import OrderedDict
+import threading
+import time
+
+class SLACache:
+    """SLA cache for closed periods
+
+    The SLA of a period that ended can only change if a downtime overlapping the period is written
+    or repaired later. The storage needs to call invalidate for every downtime written.
+
+    Entries are keyed by (_id of the service, start date, duration) with a LRU eviction.
+    They can be persisted on a MongoDB collection to survive a restart.
+
+    The invalidation of the memory entries is only done on the process writing the downtime.
+    When several instances share the same database (PartitionedInstance), each instance has to
+    use a ttl and the persisted entries (invalidated on the collection by the writer):
+    a memory entry can stay stale at most ttl seconds on the other instances.
+    The collection needs to be read on the primary (a secondary can return an entry already invalidated).
+
+    This is thread safe.
+
+    Constructor
+
+    Keyword Arguments:
+        max_entries (int): Maximum number of entries in memory (and of services versions)
+        collection (Collection): MongoDB collection to persist entries (None to keep them only in memory)
+        ttl (int): Number of seconds to keep an entry in memory (None to keep it until its eviction)
+
+    """
+
+    #entries = OrderedDict()
+    #services = dict()
+    #versions = OrderedDict()
+    #generation = 0
+    #evicted = 0
+    #lock = threading.Lock()
+    #collection = None
+    max_entries = 100000
+    ttl = None
+
+    def __init__(self, max_entries=None, collection=None, ttl=None):
+        if max_entries is not None:
+            self.max_entries = max_entries
+        if ttl is not None:
+            self.ttl = ttl
+        self.collection = collection
+
+        # (id_svc, start_date, duration) -> (sla, expiration date or None)
+        self.entries = OrderedDict()
+
+        # id_svc -> set of keys
+        self.services = dict()
+
+        # id_svc -> generation of its last invalidation (LRU, bounded by max_entries)
+        self.versions = OrderedDict()
+
+        # Last generation given and highest generation evicted from versions
+        self.generation = 0
+        self.evicted = 0
+
+        self.lock = threading.Lock()
+
+        if self.collection is not None and len(self.collection.index_information()) == 0:
+            self.collection.create_index( [("_id_uptime", 1), ("start", 1), ("duration", 1)] )
+
+    def version(self, id_svc):
+        """Version of the cache for a service
+
+        Permit to detect an invalidation between the computation of a SLA and its storage in the cache.
+        A service evicted from the versions gets the highest generation evicted: an entry computed before
+        the eviction is not stored (conservative).
+
+        Args:
+            id_svc (object): _id of the service
+
+        Returns:
+            int: The version
+        """
+        return self.versions.get(id_svc, self.evicted)
+
+    def get(self, id_svc, start_date, duration):
+        """Get a SLA
+
+        Args:
+            id_svc (object): _id of the service
+            start_date (int): epoch timestamp
+            duration (int): number of seconds of the period
+
+        Returns:
+            float: The SLA or Not available (None)
+        """
+        key = (id_svc, start_date, duration)
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                sla, expiration = entry
+                if expiration is None or expiration > time.time():
+                    self.entries.move_to_end(key)
+                    return sla
+
+                self.discard(key)
+
+        if self.collection is None:
+            return None
+
+        with self.lock:
+            version = self.version(id_svc)
+
+        try:
+            result = self.collection.find_one({"_id_uptime": id_svc, "start": start_date, "duration": duration})
+        except:
+            return None
+
+        if result is None:
+            return None
+
+        with self.lock:
+            if version != self.version(id_svc):
+                # invalidated during the read, the entry can be stale
+                return None
+
+            self.add(key, result["sla"])
+
+        return result["sla"]
+
+    def set(self, id_svc, start_date, duration, sla, version=None):
+        """Set a SLA
+
+        Args:
+            id_svc (object): _id of the service
+            start_date (int): epoch timestamp
+            duration (int): number of seconds of the period
+            sla (float): 0.0-100.0 sla
+
+        Keyword Arguments:
+            version (int): version of the service read before the computation (see version). Ignored if the cache was invalidated since.
+        """
+        with self.lock:
+            if version is None:
+                version = self.version(id_svc)
+            elif version != self.version(id_svc):
+                return
+
+            self.add((id_svc, start_date, duration), sla)
+
+        if self.collection is None:
+            return
+
+        query = {"_id_uptime": id_svc, "start": start_date, "duration": duration}
+        try:
+            self.collection.update_one(query, { "$set" : {"end": start_date + duration, "sla": sla} }, upsert=True)
+        except:
+            return
+
+        with self.lock:
+            invalidated = version != self.version(id_svc)
+
+        if invalidated:
+            # the invalidation can have removed the persisted entries before our write
+            try:
+                self.collection.delete_one(query)
+            except:
+                print("sla cache: Issue to remove a stale persisted entry")
+
+    def add(self, key, sla):
+        """Add an entry in memory (lock must be held)
+
+        Args:
+            key (tuple): (id_svc, start_date, duration)
+            sla (float): 0.0-100.0 sla
+        """
+        expiration = None
+        if self.ttl is not None:
+            expiration = time.time() + self.ttl
+
+        self.entries[key] = (sla, expiration)
+        self.entries.move_to_end(key)
+        self.services.setdefault(key[0], set()).add(key)
+
+        while len(self.entries) > self.max_entries:
+            self.discard(next(iter(self.entries)))
+
+    def discard(self, key):
+        """Remove an entry from memory (lock must be held)
+
+        Args:
+            key (tuple): (id_svc, start_date, duration)
+        """
+        self.entries.pop(key, None)
+        keys = self.services.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if len(keys) == 0:
+                del self.services[key[0]]
+
+    def invalidate(self, id_svc, start_date, end_date=None):
+        """Invalidate all SLA of a service overlapping a downtime
+
+        Args:
+            id_svc (object): _id of the service
+            start_date (int): epoch timestamp of the begining of the downtime
+
+        Keyword Arguments:
+            end_date (int): epoch timestamp of the end of the downtime (None for an open downtime)
+        """
+        with self.lock:
+            self.invalidate_memory(id_svc, start_date, end_date)
+
+        if self.collection is not None:
+            query = {"_id_uptime": id_svc, "end": { "$gt" : start_date }}
+            if end_date is not None:
+                query["start"] = { "$lt" : end_date }
+
+            try:
+                self.collection.delete_many(query)
+            except:
+                print("sla cache: Issue to invalidate persisted entries")
+
+            # entries read from the collection before the delete (see get) are discarded
+            with self.lock:
+                self.invalidate_memory(id_svc, start_date, end_date)
+
+    def invalidate_memory(self, id_svc, start_date, end_date):
+        """Move the version of a service and remove its memory entries overlapping a downtime (lock must be held)
+
+        Args:
+            id_svc (object): _id of the service
+            start_date (int): epoch timestamp of the begining of the downtime
+            end_date (int): epoch timestamp of the end of the downtime (None for an open downtime)
+        """
+        self.generation = self.generation + 1
+        self.versions[id_svc] = self.generation
+        self.versions.move_to_end(id_svc)
+
+        while len(self.versions) > self.max_entries:
+            old_id_svc, old_generation = self.versions.popitem(last=False)
+            self.evicted = max(self.evicted, old_generation)
+
+        for key in list(self.services.get(id_svc, [])):
+            key_id_svc, key_start_date, key_duration = key
+            if key_start_date + key_duration > start_date and (end_date is None or key_start_date < end_date):
+                self.discard(key)
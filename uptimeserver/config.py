@@ -76,8 +76,7 @@ class Config:
             server.providers_add(provider)
         
         # Services
-        for service in self.services:
-            monitoring.add(service)
+        monitoring.add_many(self.services)
 
     def writekubeconfig(self, target=None):
         """Write the kube file configuration
@@ -18,17 +18,27 @@ Consolidation module
 The purpose is to compute stored raw data from monitoring to transform them.
 """
 
-from datetime import datetime
-from .helper import DaemonHelper
+from datetime import datetime, timezone
+from dateutil.relativedelta import relativedelta
 from .services import Service
+from .scheduler import Scheduler, Job
+import pymongo
+import itertools
 import time
 import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 class Consolidation(threading.Thread):
     """Base class for Consolidation implementation
     
     Inherit class need to know and to work with the storage object.
     
+    A consolidation runs on a Scheduler (see schedule) or on its own thread (start). Inherit class
+    that don't implement schedule are started on their own thread by schedule.
+    
+    With multiple active instances, the jobs are run only if active returns True (see PartitionedInstance).
+    
     Constructor
     
     Args:
@@ -38,21 +48,91 @@ class Consolidation(threading.Thread):
     #storage
     
     #stop_switch = False
+    #stop_event = threading.Event()
+    
+    #scheduler = None
+    #scheduler_owned = False
+    #jobs = []
+    #active = None
     
     def __init__(self, storage):
         threading.Thread.__init__(self)
         
         self.storage = storage
         self.stop_switch = True
+        self.stop_event = threading.Event()
+        
+        self.scheduler = None
+        self.scheduler_owned = False
+        self.jobs = []
+        self.active = None
         
     def run(self):
         """Start the consolidation """
         self.stop_switch = False
     
+    def run_scheduler(self):
+        """Run the jobs of the consolidation on its own scheduler (in this thread)"""
+        scheduler = Scheduler(workers=1)
+        self.scheduler_owned = True
+        self.schedule(scheduler)
+        scheduler.run()
+    
+    def schedule(self, scheduler):
+        """Add the jobs of the consolidation on a scheduler
+        
+        Inherit class need to call schedule_job to add jobs.
+        By default, the consolidation is started on its own thread.
+        
+        Args:
+            scheduler (Scheduler): the scheduler
+        """
+        self.start()
+    
+    def schedule_job(self, scheduler, name, function, interval=None, delay=0, missed=Job.MISSED_RUN_ONCE):
+        """Add a job of the consolidation on a scheduler (see Scheduler.add)"""
+        self.scheduler = scheduler
+        self.stop_switch = False
+        
+        scheduler.add(name, self.job(function), interval, delay, missed=missed)
+        self.jobs.append(name)
+    
+    def job(self, function):
+        """Function run by a job (skipped if this instance is not active)
+        
+        Args:
+            function (function): function of the job
+        
+        Returns:
+            function: The function to schedule
+        """
+        def run_job():
+            if self.active is not None and not self.active():
+                return None
+            return function()
+        
+        return run_job
+    
+    def stopping(self):
+        """A stop was requested while the consolidation is running ?
+        
+        Returns:
+            bool: Stop requested (True) or Not (False)
+        """
+        return self.stop_switch and (self.scheduler is not None or self.is_alive())
+    
     def stopConsolidation(self):
         """Stop the consolidation """
         print("stopping consolidation ...")
         self.stop_switch = True
+        self.stop_event.set()
+        
+        if self.scheduler is not None:
+            for name in self.jobs:
+                self.scheduler.remove(name)
+            
+            if self.scheduler_owned:
+                self.scheduler.stopScheduler()
 
 class ConsolidationSLA(Consolidation):
     """Base class for SLA Consolidation implementation
@@ -68,11 +148,19 @@ class ConsolidationSLA(Consolidation):
     def hook_daily_sla(self, service, sla)
     def hook_weekly_sla(self, service, sla)
     def hook_monthly_sla(self, service, sla)
+    def hook_yearly_sla(self, service, sla)
     def daily_sla_done(self)
     def weekly_sla_done(self)
     def monthly_sla_done(self)
+    def yearly_sla_done(self)
+    
+    Those functions are used to store the sla or to notify that the daily/weekly/monthly/yearly compute is done.
+    The yearly ones are optional (no-op by default) so an implementation done before the yearly period still works.
+    
+    SLA are provided by the storage (stats_get_all_*_sla) but the source can be changed by overriding get_all_*_sla.
     
-    Those functions are used to store the sla or to notify that the daily/weekly/monthly compute is done
+    With more than 1 worker, services are computed by chunks on a thread pool (see map_services) so hooks
+    need to be thread safe. *_sla_done is only called once all chunks of the period are computed.
     
     Constructor
     
@@ -81,6 +169,8 @@ class ConsolidationSLA(Consolidation):
         
     Keyword Arguments:
         waiting_seconds_between_batch (int): Number of seconds to wait between 2 workload
+        workers (int): Number of threads used to compute SLA of services
+        chunk_size (int): Number of services per task submitted to a worker
     
     """
     
@@ -93,11 +183,23 @@ class ConsolidationSLA(Consolidation):
     #date_monthly_sla
     #wip_date_monthly_sla
     
-    def __init__(self, storage, waiting_seconds_between_batch=300):
+    #date_yearly_sla
+    #wip_date_yearly_sla
+    
+    workers = 1
+    chunk_size = 100
+    backfilling = False
+    
+    def __init__(self, storage, waiting_seconds_between_batch=300, workers=None, chunk_size=None):
         super().__init__(storage)
         
         self.waiting_seconds_between_batch = waiting_seconds_between_batch
         
+        if workers is not None:
+            self.workers = workers
+        if chunk_size is not None:
+            self.chunk_size = chunk_size
+        
         # Internal variables used to control the consolidation
         # date_* indicate the new consolidation starting point
         # that means that when we reach this new consolidation starting point, we can consolidate the previous period as
@@ -109,10 +211,12 @@ class ConsolidationSLA(Consolidation):
         today = datetime(now.year, now.month, now.day)
         monday_this_week = self.storage.stats_first_date_of_week_number(today.year, week_num)
         first_this_month = datetime(now.year, now.month, 1)
+        first_this_year = datetime(now.year, 1, 1)
         
         self.date_daily_sla = self.next_date_daily_sla(today.timestamp())
         self.date_weekly_sla = self.next_date_weekly_sla(monday_this_week.timestamp())
         self.date_monthly_sla = self.next_date_monthly_sla(first_this_month.timestamp())
+        self.date_yearly_sla = self.next_date_yearly_sla(first_this_year.timestamp())
         
     # Date manipulaton for consolidation.
     # Month manipulation assume that the day is always set to 1 or at least < 29
@@ -182,9 +286,235 @@ class ConsolidationSLA(Consolidation):
             long: The previous month
         """
         return timestamp - self.storage.stats_month_duration(timestamp, end_date=True)
+    
+    def next_date_yearly_sla(self, timestamp):
+        """Get the next year from a specific date
+        
+        Args:
+            timestamp (long): a specific date
+            
+        Returns:
+            long: The next year
+        """
+        return timestamp + self.storage.stats_year_duration(timestamp)
+    
+    def previous_date_yearly_sla(self, timestamp):
+        """Get the previous year from a specific date
+        
+        Args:
+            timestamp (long): a specific date
+            
+        Returns:
+            long: The previous year
+        """
+        return timestamp - self.storage.stats_year_duration(timestamp, end_date=True)
+    
+    # Workers
+    
+    def map_services(self, items, function, checkpoint=None):
+        """Call function for every item
+        
+        Items are grouped by chunk_size. With more than 1 worker, chunks are computed on a thread pool.
+        At most 2 chunks per worker are in flight so items are read from the source as they are computed.
+        
+        Args:
+            items (iterable): services (or anything related to one service)
+            function (function): function to call for each item
+        
+        Keyword Arguments:
+            checkpoint (function): function to call with the last item of a chunk once this chunk and all previous ones are computed
+        
+        Raises:
+            Exception: An item failed. Remaining chunks are not computed.
+        """
+        def compute_chunk(chunk):
+            for item in chunk:
+                function(item)
+            return chunk[-1]
+        
+        def done(last):
+            if checkpoint is not None:
+                checkpoint(last)
+        
+        items = iter(items)
+        
+        if self.workers <= 1:
+            for chunk in iter(lambda: list(itertools.islice(items, self.chunk_size)), []):
+                done(compute_chunk(chunk))
+            return
+        
+        pending = deque()
+        
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            try:
+                for chunk in iter(lambda: list(itertools.islice(items, self.chunk_size)), []):
+                    # try to stop early if requested (the period will be computed again)
+                    if self.stopping():
+                        raise Exception("consolidation stopped")
+                    
+                    pending.append(executor.submit(compute_chunk, chunk))
+                    
+                    # bounded in-flight work
+                    if len(pending) >= self.workers * 2:
+                        done(pending.popleft().result())
+                
+                while len(pending) > 0:
+                    done(pending.popleft().result())
+            except:
+                for future in pending:
+                    future.cancel()
+                raise
+    
+    # Backfill
+    
+    def first_date_sla(self, period, timestamp):
+        """Begining of the period including a date
+        
+        Args:
+            period (String): daily, weekly, monthly or yearly
+            timestamp (int): epoch timestamp
+        
+        Returns:
+            long: The begining of the period
+        """
+        date = datetime.fromtimestamp(timestamp)
+        day = datetime(date.year, date.month, date.day)
+        
+        if period == "daily":
+            return day.timestamp()
+        if period == "weekly":
+            return (day + relativedelta(days=-day.weekday())).timestamp()
+        if period == "monthly":
+            return datetime(date.year, date.month, 1).timestamp()
+        if period == "yearly":
+            return datetime(date.year, 1, 1).timestamp()
+        
+        raise Exception("Unknown period %s" % period)
+    
+    def backfill(self, start_date, end_date, periods=["daily", "weekly", "monthly", "yearly"]):
+        """Compute again all periods between 2 dates
+        
+        Periods including start_date and starting before end_date are computed in the order of periods, back-to-back.
+        Periods not ended yet are skipped. The consolidation dates are kept as they were. While backfilling, the
+        consolidation state is only moved when the period computed is the next one of the live consolidation
+        (see backfilling) so this can run on a consolidation that was not started or is stopped.
+        
+        Args:
+            start_date (int): epoch timestamp
+            end_date (int): epoch timestamp
+        
+        Keyword Arguments:
+            periods (list): daily, weekly, monthly and/or yearly
+        
+        Returns:
+            list: (period, start date) that failed
+        """
+        failed = []
+        dates = (self.date_daily_sla, self.date_weekly_sla, self.date_monthly_sla, self.date_yearly_sla)
+        
+        self.backfilling = True
+        try:
+            for period in periods:
+                next_date = getattr(self, "next_date_%s_sla" % period)
+                compute = getattr(self, "compute_%s_sla" % period)
+                
+                date = self.first_date_sla(period, start_date)
+                while date < end_date and next_date(date) <= time.time():
+                    # compute_* works on the period before date_*
+                    setattr(self, "date_%s_sla" % period, next_date(date))
+                    if not compute():
+                        failed.append((period, date))
+                    
+                    date = next_date(date)
+        finally:
+            self.date_daily_sla, self.date_weekly_sla, self.date_monthly_sla, self.date_yearly_sla = dates
+            self.backfilling = False
+        
+        return failed
+    
+    # Source of the SLA
+    
+    def get_all_sla(self, start_date, duration, hook):
+        """Get the SLA of all services with the workers
+        
+        Args:
+            start_date (int): epoch timestamp
+            duration (int): number of seconds of the period
+            hook (function): function to call for each sla computed
+        """
+        self.map_services(self.storage.stats_iter_all_svc(), \
+            lambda service: hook(service, self.storage.stats_get_svc_sla(service, start_date, duration)))
+    
+    def get_all_daily_sla(self, start_date, hook):
+        """Get the daily SLA of all services
+        
+        Args:
+            start_date (int): epoch timestamp
+            hook (function): function to call for each sla computed
+        """
+        if self.workers > 1:
+            self.get_all_sla(start_date, self.storage.stats_day_duration(), hook)
+        else:
+            self.storage.stats_get_all_daily_sla(start_date, hook)
+    
+    def get_all_weekly_sla(self, start_date, hook):
+        """Get the weekly SLA of all services
+        
+        Args:
+            start_date (int): epoch timestamp
+            hook (function): function to call for each sla computed
+        """
+        if self.workers > 1:
+            self.get_all_sla(start_date, self.storage.stats_week_duration(), hook)
+        else:
+            self.storage.stats_get_all_weekly_sla(start_date, hook)
+    
+    def get_all_monthly_sla(self, start_date, hook):
+        """Get the monthly SLA of all services
+        
+        Args:
+            start_date (int): epoch timestamp
+            hook (function): function to call for each sla computed
+        """
+        if self.workers > 1:
+            self.get_all_sla(start_date, self.storage.stats_month_duration(start_date), hook)
+        else:
+            self.storage.stats_get_all_monthly_sla(start_date, hook)
+    
+    def get_all_yearly_sla(self, start_date, hook):
+        """Get the yearly SLA of all services
+        
+        Args:
+            start_date (int): epoch timestamp
+            hook (function): function to call for each sla computed
+        """
+        if self.workers > 1:
+            self.get_all_sla(start_date, self.storage.stats_year_duration(start_date), hook)
+        else:
+            self.storage.stats_get_all_yearly_sla(start_date, hook)
+    
+    def hook_yearly_sla(self, service, sla, down=None):
+        """Hook for yearly SLA (nothing is stored by default)
+        
+        Args:
+            service (dict): service Document
+            sla (float): 0.0-100.0 sla
+        
+        Keyword Arguments:
+            down (int): number of seconds of downtime
+        """
+        pass
+    
+    def yearly_sla_done(self):
+        """Yearly compute is done (nothing to do by default)"""
+        pass
         
     def compute_daily_sla(self):
-        """Compute the daily SLA"""
+        """Compute the daily SLA
+        
+        Returns:
+            bool: Success (True) or Failure (False)
+        """
         
         # set the wip date
         self.wip_date_daily_sla = self.previous_date_daily_sla(self.date_daily_sla)
@@ -193,19 +523,25 @@ class ConsolidationSLA(Consolidation):
         
         try:
             # get all daily sla from Storage
-            self.storage.stats_get_all_daily_sla(self.wip_date_daily_sla, self.hook_daily_sla)
+            self.get_all_daily_sla(self.wip_date_daily_sla, self.hook_daily_sla)
             
             # done
             self.daily_sla_done()
         except:
             print("consolidation: daily for %d [FAILED]" % (self.wip_date_daily_sla))
+            return False
         else:
             # success so we can set the next period
             self.date_daily_sla = self.next_date_daily_sla(self.date_daily_sla)
             print("consolidation: daily for %d [DONE]" % (self.wip_date_daily_sla))
+            return True
         
     def compute_weekly_sla(self):
-        """Compute the weekly SLA"""
+        """Compute the weekly SLA
+        
+        Returns:
+            bool: Success (True) or Failure (False)
+        """
         
         # set the wip date
         self.wip_date_weekly_sla = self.previous_date_weekly_sla(self.date_weekly_sla)
@@ -214,19 +550,25 @@ class ConsolidationSLA(Consolidation):
         
         try:
             # get all weekly sla from Storage
-            self.storage.stats_get_all_weekly_sla(self.wip_date_weekly_sla, self.hook_weekly_sla)
+            self.get_all_weekly_sla(self.wip_date_weekly_sla, self.hook_weekly_sla)
             
             # done
             self.weekly_sla_done()
         except:
             print("consolidation: weekly for %d [FAILED]" % (self.wip_date_weekly_sla))
+            return False
         else:
             # success so we can set the next period
             self.date_weekly_sla = self.next_date_weekly_sla(self.date_weekly_sla)
             print("consolidation: weekly for %d [DONE]" % (self.wip_date_weekly_sla))
+            return True
     
     def compute_monthly_sla(self):
-        """Compute the Monthly SLA"""
+        """Compute the Monthly SLA
+        
+        Returns:
+            bool: Success (True) or Failure (False)
+        """
         
         # set the wip date
         self.wip_date_monthly_sla = self.previous_date_monthly_sla(self.date_monthly_sla)
@@ -235,88 +577,156 @@ class ConsolidationSLA(Consolidation):
         
         try:
             # get all monthly sla from Storage
-            self.storage.stats_get_all_monthly_sla(self.wip_date_monthly_sla, self.hook_monthly_sla)
+            self.get_all_monthly_sla(self.wip_date_monthly_sla, self.hook_monthly_sla)
             
             # done
             self.monthly_sla_done()
         except:
             print("consolidation: monthly for %d [FAILED]" % (self.wip_date_monthly_sla))
+            return False
         else:
             # success so we can set the next period
             self.date_monthly_sla = self.next_date_monthly_sla(self.date_monthly_sla)
             print("consolidation: monthly for %d [DONE]" % (self.wip_date_monthly_sla))
+            return True
     
-    def run(self):
-        """Compute SLA"""
+    def compute_yearly_sla(self):
+        """Compute the Yearly SLA
         
-        print("starting consolidation ...")
+        Returns:
+            bool: Success (True) or Failure (False)
+        """
         
-        self.stop_switch = False
+        # set the wip date
+        self.wip_date_yearly_sla = self.previous_date_yearly_sla(self.date_yearly_sla)
         
-        while not self.stop_switch:
-            start_batch = time.time()
-            
-            # General algorithm:
-            #
-            # date_* indicate the new consolidation starting point
-            # that means that when we reach this new consolidation starting point, we can consolidate the previous period as
-            # we are starting a new one.
-            # If we are able to consolidate the previous period, we can update the date to the the next new consolidation starting point.
-            
-            # 1 Day compute
+        print("consolidation: yearly for %d [computing]" % (self.wip_date_yearly_sla))
+        
+        try:
+            # get all yearly sla
+            self.get_all_yearly_sla(self.wip_date_yearly_sla, self.hook_yearly_sla)
             
-            if start_batch >= self.date_daily_sla:
-                self.compute_daily_sla()
-                
-            # try to stop early if requested
-            if self.stop_switch:
-                break
+            # done
+            self.yearly_sla_done()
+        except:
+            print("consolidation: yearly for %d [FAILED]" % (self.wip_date_yearly_sla))
+            return False
+        else:
+            # success so we can set the next period
+            self.date_yearly_sla = self.next_date_yearly_sla(self.date_yearly_sla)
+            print("consolidation: yearly for %d [DONE]" % (self.wip_date_yearly_sla))
+            return True
+    
+    def run_batch(self):
+        """Compute SLA of periods ready
+        
+        Returns:
+            int: Number of seconds to wait before the next batch
+        """
+        start_batch = time.time()
+        success = True
+        
+        # General algorithm:
+        #
+        # date_* indicate the new consolidation starting point
+        # that means that when we reach this new consolidation starting point, we can consolidate the previous period as
+        # we are starting a new one.
+        # If we are able to consolidate the previous period, we can update the date to the the next new consolidation starting point.
+        
+        # 1 Day compute
+        
+        if start_batch >= self.date_daily_sla:
+            success = self.compute_daily_sla() and success
             
-            # 1 Week compute
+        # try to stop early if requested
+        if self.stopping():
+            return 0
+        
+        # 1 Week compute
+        
+        if start_batch >= self.date_weekly_sla:
+            success = self.compute_weekly_sla() and success
             
-            if start_batch >= self.date_weekly_sla:
-                self.compute_weekly_sla()
-                
-            # try to stop early if requested
-            if self.stop_switch:
-                break
+        # try to stop early if requested
+        if self.stopping():
+            return 0
+        
+        # 1 Month compute
+        
+        if start_batch >= self.date_monthly_sla:
+            success = self.compute_monthly_sla() and success
             
-            # 1 Month compute
+        # try to stop early if requested
+        if self.stopping():
+            return 0
+        
+        # 1 Year compute
+        
+        if start_batch >= self.date_yearly_sla:
+            success = self.compute_yearly_sla() and success
             
-            if start_batch >= self.date_monthly_sla:
-                self.compute_monthly_sla()
-                
-            # How many time do we need to wait ?
-            
-            end_batch = time.time()
-            
-            # Default waiting time to avoid overload and quick retry on a failing system
-            sleep_time = self.waiting_seconds_between_batch
-            
-            # the next event is a day or a week or a month (depending errors reported)
-            # this is not always the day that is the next event because the first day of the month, an issue can
-            # occurs with the month or week treatment
-            next_event = self.date_daily_sla
-            if next_event > self.date_weekly_sla:
-                next_event = self.date_weekly_sla
-            if next_event > self.date_monthly_sla:
-                next_event = self.date_monthly_sla
-            
-            # the next event is after the end of this batch
-            if (end_batch < next_event):
-                # duration to wait in seconds
-                next_event_in = int(next_event - end_batch)
-                if next_event_in > sleep_time:
-                    sleep_time = next_event_in
-                
-            DaemonHelper().sleep_with_stop_switch(sleep_time, self)
+        # How many time do we need to wait ?
+        
+        end_batch = time.time()
+        
+        # Default waiting time to avoid overload and quick retry on a failing system
+        sleep_time = self.waiting_seconds_between_batch
+        
+        # the next event is a day or a week or a month or a year (depending errors reported)
+        # this is not always the day that is the next event because the first day of the month, an issue can
+        # occurs with the month or week treatment
+        next_event = self.date_daily_sla
+        if next_event > self.date_weekly_sla:
+            next_event = self.date_weekly_sla
+        if next_event > self.date_monthly_sla:
+            next_event = self.date_monthly_sla
+        if next_event > self.date_yearly_sla:
+            next_event = self.date_yearly_sla
+        
+        # catch up mode: there is still a backlog (eg: the server was down) so we continue without waiting
+        # we only wait when a period failed to avoid a quick retry on a failing system
+        if success and next_event <= end_batch:
+            print("consolidation: catching up")
+            return 0
+        
+        # the next event is after the end of this batch
+        if (end_batch < next_event):
+            # duration to wait in seconds
+            next_event_in = int(next_event - end_batch)
+            if next_event_in > sleep_time:
+                sleep_time = next_event_in
+        
+        return sleep_time
+    
+    def schedule(self, scheduler):
+        """see Consolidation class
+        
+        The job runs run_batch and is scheduled again after the time it returned.
+        """
+        self.schedule_job(scheduler, "consolidation sla", self.run_batch, self.waiting_seconds_between_batch)
     
+    def run(self):
+        """Compute SLA"""
+        
+        print("starting consolidation ...")
+        
+        self.run_scheduler()
+        
         print("consolidation stopped")
 
 class ConsolidationStatus(Consolidation):
     """Base class for Status Consolidation implementation
     
-    Inherit class need to implement compute_status(self)
+    Public status are driven by the downtimes written on the storage (see Storage.transition_listener_add):
+    
+    - a downtime opened schedules a one-shot job to set the status to FAIL after down_time_duration
+    - a downtime closed replaces this job to set the status to OK immediately
+    
+    Changes are applied by the scheduler (not by the monitoring threads).
+    A full resync (compute_status) is done every waiting_seconds_between_batch as a safety net.
+    
+    Inherit class need to implement compute_status(self) and set_status_public(self, id_svc, status)
+    and should implement open_downtimes(self, since) to schedule downtimes opened before a resync.
     
     Constructor
     
@@ -325,92 +735,339 @@ class ConsolidationStatus(Consolidation):
         
     Keyword Arguments:
         down_time_duration (int): number of second to consider a service as really down.
-        waiting_seconds_between_batch (int): Number of seconds to wait between 2 workload
+        waiting_seconds_between_batch (int): Number of seconds between 2 full resync
     
     """
     
     #down_time_duration
     #waiting_seconds_between_batch
     
-    def __init__(self, storage, down_time_duration=600, waiting_seconds_between_batch=60):
+    def __init__(self, storage, down_time_duration=600, waiting_seconds_between_batch=900):
         super().__init__(storage)
         
         self.down_time_duration = down_time_duration
         self.waiting_seconds_between_batch = waiting_seconds_between_batch
     
+    def open_downtimes(self, since):
+        """Open downtimes started after a date
+        
+        Args:
+            since (int): epoch timestamp
+        
+        Returns:
+            iterable: (id_svc, down_start_date)
+        """
+        return []
+    
+    def set_status_public(self, id_svc, status):
+        """Set the public status of a service (if the service is concerned by the public status)
+        
+        Args:
+            id_svc (object): _id of the service
+            status (int): Service.OK or Service.FAIL
+        """
+        print("Please implement this method !")
+    
+    def job_name(self, id_svc):
+        """Name of the job that will set the public status of a service
+        
+        Args:
+            id_svc (object): _id of the service
+        
+        Returns:
+            String: The name
+        """
+        return "consolidation status %s" % (str(id_svc))
+    
+    def transition(self, id_svc, down_start_date, down_end_date):
+        """Listener of downtimes written on the storage
+        
+        Args:
+            id_svc (object): _id of the service
+            down_start_date (int): epoch timestamp
+            down_end_date (int): epoch timestamp (0 for an open downtime)
+        """
+        if self.scheduler is None or self.stop_switch:
+            return
+        
+        # like the resync, only the active instance sets the public status (a service can move to another
+        # instance before its job runs), the others are caught up by the next resync
+        if down_end_date == 0:
+            self.scheduler.add_at(self.job_name(id_svc), self.job(lambda: self.set_status_public(id_svc, Service.FAIL)), \
+                down_start_date + self.down_time_duration)
+        else:
+            # replace the FAIL job
+            self.scheduler.add(self.job_name(id_svc), self.job(lambda: self.set_status_public(id_svc, Service.OK)))
+    
+    def resync(self):
+        """Full resync of the public status and jobs"""
+        
+        self.compute_status()
+        
+        try:
+            for id_svc, down_start_date in self.open_downtimes(time.time() - self.down_time_duration):
+                if self.scheduler.next_run(self.job_name(id_svc)) is None:
+                    self.transition(id_svc, down_start_date, 0)
+        except:
+            print("Issue to schedule status")
+    
+    def schedule(self, scheduler):
+        """see Consolidation class"""
+        self.schedule_job(scheduler, "consolidation status", self.resync, self.waiting_seconds_between_batch, missed=Job.MISSED_SKIP)
+        self.storage.transition_listener_add(self.transition)
+    
+    def stopConsolidation(self):
+        """see Consolidation class"""
+        self.storage.transition_listener_remove(self.transition)
+        super().stopConsolidation()
+    
     def run(self):
         """Update services status"""
         
         print("starting consolidation status ...")
         
-        self.stop_switch = False
-        
-        while not self.stop_switch:
-            start_batch = time.time()
-            
-            self.compute_status()
-            
-            end_batch = time.time()
-            
-            if end_batch >= start_batch:
-                sleep_time = int(self.waiting_seconds_between_batch - ( end_batch - start_batch ))
-            else:
-                # Something wrong happened !
-                sleep_time = self.waiting_seconds_between_batch
-            
-            DaemonHelper().sleep_with_stop_switch(sleep_time, self)
+        self.run_scheduler()
         
         print("consolidation status stopped")
 
-class MongoStorageConsolidationSLA(ConsolidationSLA):
-    """SLA Consolidation with MongoStorage Backend
+class BulkWriter:
+    """Buffer of MongoDB writes flushed with unordered bulk_write
+    
+    Writes that failed are kept per batch and can be retried without recomputing them once all writes
+    of the period were added (see done).
+    Writes are attached to a date (the period computed) and failed writes of a previous date are dropped by reset.
+    
+    This is thread safe.
     
     Constructor
     
     Args:
-        storage (Storage): An instance of storage backend
-        
+        collection (Collection): MongoDB collection
+    
     Keyword Arguments:
-        waiting_seconds_between_batch (int): Number of seconds to wait between 2 workload
+        batch_size (int): Number of writes per bulk_write
     
     """
     
-    def __init__(self, storage, waiting_seconds_between_batch=300):
-        super().__init__(storage, waiting_seconds_between_batch)
+    #collection
+    #batch_size
+    #date = None
+    #buffer = []
+    #failed = []
+    #complete = False
+    #lock = threading.Lock()
+    
+    def __init__(self, collection, batch_size=1000):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.date = None
+        self.buffer = []
+        self.failed = []
+        self.complete = False
+        self.lock = threading.Lock()
+    
+    def reset(self, date):
+        """Start a new period
         
-        try:
-            # Prepare collections. We are using the MongoStorage properties to get the db and connection.
-            
-            self.daily_uptime = self.storage.db.get_collection("daily_uptime")
-            self.weekly_uptime = self.storage.db.get_collection("weekly_uptime")
-            self.monthly_uptime = self.storage.db.get_collection("monthly_uptime")
-            self.consolidation_state = self.storage.db.get_collection("consolidation_state")
+        Args:
+            date (int): epoch timestamp of the period
+        """
+        with self.lock:
+            self.date = date
+            self.buffer = []
+            self.failed = []
+            self.complete = False
+    
+    def resumable(self, date):
+        """Only failed writes are missing for this period ?
+        
+        Args:
+            date (int): epoch timestamp of the period
+        
+        Returns:
+            bool: Failed writes to retry for this period (True) or Not (False)
+        """
+        return self.date == date and self.complete and len(self.failed) > 0
+    
+    def add(self, operation):
+        """Add a write
+        
+        Args:
+            operation (UpdateOne, InsertOne ...): a write operation
+        """
+        with self.lock:
+            self.buffer.append(operation)
+            if len(self.buffer) < self.batch_size:
+                return
             
-            if len(self.daily_uptime.index_information()) == 0:
-                # collection does not exist
-                # create it and create indexes
-                self.storage.db.create_collection("daily_uptime")
-                self.daily_uptime.create_index( "_id_uptime" )
-                self.daily_uptime.create_index( "date" )
-                
-            if len(self.weekly_uptime.index_information()) == 0:
-                # collection does not exist
-                # create it and create indexes
-                self.storage.db.create_collection("weekly_uptime")
-                self.weekly_uptime.create_index( "_id_uptime" )
-                self.weekly_uptime.create_index( "date" )
-
-            if len(self.monthly_uptime.index_information()) == 0:
-                # collection does not exist
-                # create it and create indexes
-                self.storage.db.create_collection("monthly_uptime")
-                self.monthly_uptime.create_index( "_id_uptime" )
+            batch = self.buffer
+            self.buffer = []
+        
+        self.write(batch)
+    
+    def write(self, batch):
+        """Write a batch
+        
+        Failed writes are kept to be retried.
+        
+        Args:
+            batch (list): write operations
+        
+        Returns:
+            bool: Success (True) or Failure (False)
+        """
+        try:
+            self.collection.bulk_write(batch, ordered=False)
+        except pymongo.errors.BulkWriteError as e:
+            if len(e.details.get("writeConcernErrors", [])) > 0:
+                # we don't know which ones are really written
+                failed = batch
+            else:
+                failed = [batch[error["index"]] for error in e.details.get("writeErrors", [])]
+        except:
+            failed = batch
+        else:
+            return True
+        
+        print("consolidation: batch of %d writes on %s [FAILED: %d]" % (len(batch), self.collection.name, len(failed)))
+        
+        with self.lock:
+            self.failed.append(failed)
+        
+        return False
+    
+    def flush(self):
+        """Write all buffered writes
+        
+        Returns:
+            bool: Success (True) or Failure (False)
+        """
+        with self.lock:
+            batch = self.buffer
+            self.buffer = []
+        
+        if len(batch) == 0:
+            return True
+        
+        return self.write(batch)
+    
+    def retry(self):
+        """Retry all failed writes
+        
+        Returns:
+            bool: Success (True) or Failure (False)
+        """
+        with self.lock:
+            batches = self.failed
+            self.failed = []
+        
+        success = True
+        for batch in batches:
+            if not self.write(batch):
+                success = False
+        
+        return success
+    
+    def written(self):
+        """Write all buffered writes and check that all previous writes succeeded
+        
+        Returns:
+            bool: Success (True) or Failure (False)
+        """
+        return self.flush() and len(self.failed) == 0
+    
+    def done(self):
+        """All writes of the period were added. Write everything (with 1 retry for failed writes)
+        
+        Raises:
+            Exception: Some writes failed. They are kept to be retried.
+        """
+        self.complete = True
+        self.flush()
+        
+        if len(self.failed) > 0 and not self.retry():
+            raise Exception("%d batches failed on %s" % (len(self.failed), self.collection.name))
+
+class MongoStorageConsolidationSLA(ConsolidationSLA):
+    """SLA Consolidation with MongoStorage Backend
+    
+    Daily SLA are computed from the raw history and stored with the number of seconds of downtime.
+    Weekly, monthly and yearly SLA are aggregated from the daily ones (see rollup_sla). The raw history
+    is only used for days not available on daily_uptime.
+    
+    SLA are written with unordered bulk_write by batch_size. If some batches failed, the period is not done
+    and the next compute of the same period only retries the failed batches.
+    
+    Services are computed by _id. After each chunk written, the last _id is saved on consolidation_state
+    ({"state": "<period>_checkpoint", "date": ..., "last_id": ...}) so a failed period resumes after it.
+    
+    Constructor
+    
+    Args:
+        storage (Storage): An instance of storage backend
+        
+    Keyword Arguments:
+        waiting_seconds_between_batch (int): Number of seconds to wait between 2 workload
+        batch_size (int): Number of SLA per bulk_write
+        workers (int): Number of threads used to compute SLA of services
+        chunk_size (int): Number of services per task submitted to a worker
+    
+    """
+    
+    #writers = dict()
+    batch_size = 1000
+    
+    def __init__(self, storage, waiting_seconds_between_batch=300, batch_size=None, workers=None, chunk_size=None):
+        super().__init__(storage, waiting_seconds_between_batch, workers, chunk_size)
+        
+        if batch_size is not None:
+            self.batch_size = batch_size
+        
+        try:
+            # Prepare collections. We are using the MongoStorage properties to get the db and connection.
+            # Consolidations are using the stats pool to don't compete with transitions.
+            
+            self.daily_uptime = self.storage.stats_db.get_collection("daily_uptime")
+            self.weekly_uptime = self.storage.stats_db.get_collection("weekly_uptime")
+            self.monthly_uptime = self.storage.stats_db.get_collection("monthly_uptime")
+            self.yearly_uptime = self.storage.stats_db.get_collection("yearly_uptime")
+            self.consolidation_state = self.storage.stats_db.get_collection("consolidation_state")
+            
+            if len(self.daily_uptime.index_information()) == 0:
+                # collection does not exist
+                # create it and create indexes
+                self.storage.stats_db.create_collection("daily_uptime")
+                self.daily_uptime.create_index( "_id_uptime" )
+                self.daily_uptime.create_index( "date" )
+            
+            # used by the rollups
+            self.daily_uptime.create_index( [("_id_uptime", pymongo.ASCENDING), ("date", pymongo.ASCENDING)] )
+                
+            if len(self.weekly_uptime.index_information()) == 0:
+                # collection does not exist
+                # create it and create indexes
+                self.storage.stats_db.create_collection("weekly_uptime")
+                self.weekly_uptime.create_index( "_id_uptime" )
+                self.weekly_uptime.create_index( "date" )
+
+            if len(self.monthly_uptime.index_information()) == 0:
+                # collection does not exist
+                # create it and create indexes
+                self.storage.stats_db.create_collection("monthly_uptime")
+                self.monthly_uptime.create_index( "_id_uptime" )
                 self.monthly_uptime.create_index( "date" )
             
+            if len(self.yearly_uptime.index_information()) == 0:
+                # collection does not exist
+                # create it and create indexes
+                self.storage.stats_db.create_collection("yearly_uptime")
+                self.yearly_uptime.create_index( "_id_uptime" )
+                self.yearly_uptime.create_index( "date" )
+            
             if len(self.consolidation_state.index_information()) == 0:
                 # collection does not exist
                 # create it and create indexes
-                self.storage.db.create_collection("consolidation_state")
+                self.storage.stats_db.create_collection("consolidation_state")
                 
             # load consolidation_state
             result = self.consolidation_state.find_one({"state": "daily"})
@@ -424,10 +1081,246 @@ class MongoStorageConsolidationSLA(ConsolidationSLA):
             result = self.consolidation_state.find_one({"state": "monthly"})
             if result is not None:
                 self.date_monthly_sla = self.next_date_monthly_sla(result["next"])
+            
+            result = self.consolidation_state.find_one({"state": "yearly"})
+            if result is not None:
+                self.date_yearly_sla = self.next_date_yearly_sla(result["next"])
+            
+            self.writers = {
+                "daily": BulkWriter(self.daily_uptime, self.batch_size),
+                "weekly": BulkWriter(self.weekly_uptime, self.batch_size),
+                "monthly": BulkWriter(self.monthly_uptime, self.batch_size),
+                "yearly": BulkWriter(self.yearly_uptime, self.batch_size)
+                }
         except:
             raise
+    
+    # Source of the SLA
+    
+    def resume_sla(self, period, start_date):
+        """Prepare the writes of a period
         
-    def hook_daily_sla(self, service, sla):
+        Args:
+            period (String): daily, weekly, monthly or yearly
+            start_date (int): epoch timestamp
+        
+        Returns:
+            bool: Only failed writes need to be retried (True) or the SLA need to be computed (False)
+        """
+        writer = self.writers[period]
+        
+        if writer.resumable(start_date):
+            print("consolidation: %s for %d [retrying failed writes]" % (period, start_date))
+            return True
+        
+        writer.reset(start_date)
+        return False
+    
+    def state_done(self, period, start_date, next_date):
+        """Save a period as done on consolidation_state
+        
+        A backfill only moves the state when it computed the period stored as next (the one the live
+        consolidation would compute): it can't move it forward over missing periods nor create it.
+        
+        Args:
+            period (String): daily, weekly, monthly or yearly
+            start_date (int): epoch timestamp of the period computed
+            next_date (int): epoch timestamp of the period after
+        """
+        if self.backfilling:
+            self.consolidation_state.update_one({"state": period, "next": start_date}, { "$set" : { "next": next_date }})
+        else:
+            self.consolidation_state.update_one({"state": period}, { "$max" : { "next": next_date }}, upsert=True)
+    
+    def checkpoint_sla(self, period, start_date, last_id):
+        """Save the progress of a period
+        
+        The checkpoint is only saved if all SLA computed so far are written.
+        
+        Args:
+            period (String): daily, weekly, monthly or yearly
+            start_date (int): epoch timestamp
+            last_id (object): _id of the last service computed
+        """
+        if not self.writers[period].written():
+            return
+        
+        try:
+            self.consolidation_state.update_one({"state": "%s_checkpoint" % period}, \
+                { "$set" : { "date": start_date, "last_id": last_id }}, upsert=True)
+        except:
+            print("consolidation: %s for %d [checkpoint FAILED]" % (period, start_date))
+    
+    def checkpoint_query(self, period, start_date, field="_id"):
+        """Query to only get services after the checkpoint of a period
+        
+        Args:
+            period (String): daily, weekly, monthly or yearly
+            start_date (int): epoch timestamp
+        
+        Keyword Arguments:
+            field (String): field with the _id of the service
+        
+        Returns:
+            dict: The query
+        """
+        result = self.consolidation_state.find_one({"state": "%s_checkpoint" % period, "date": start_date})
+        if result is None:
+            return {}
+        
+        print("consolidation: %s for %d [resuming after %s]" % (period, start_date, str(result["last_id"])))
+        return { field: { "$gt" : result["last_id"] } }
+    
+    def checkpoint_clear(self, period):
+        """Remove the checkpoint of a period
+        
+        Args:
+            period (String): daily, weekly, monthly or yearly
+        """
+        self.consolidation_state.delete_one({"state": "%s_checkpoint" % period})
+    
+    def get_all_daily_sla(self, start_date, hook):
+        """Daily SLA of all services from the raw history
+        
+        Args:
+            start_date (int): epoch timestamp
+            hook (function): function to call for each sla computed with the number of seconds of downtime
+        """
+        if self.resume_sla("daily", start_date):
+            return
+        
+        duration = self.storage.stats_day_duration()
+        
+        def compute(service):
+            down = self.storage.stats_get_svc_down_seconds(service, start_date, duration)
+            hook(service, 100 - ( down * 100 / duration ), down)
+        
+        self.map_services(self.storage.stats_iter_all_svc(self.checkpoint_query("daily", start_date), \
+                projection={"_id": 1}, sort=[("_id", pymongo.ASCENDING)]), \
+            compute, \
+            lambda service: self.checkpoint_sla("daily", start_date, service["_id"]))
+    
+    def get_all_weekly_sla(self, start_date, hook):
+        """Weekly SLA of all services from daily SLA (see rollup_sla)"""
+        if not self.resume_sla("weekly", start_date):
+            self.rollup_sla("weekly", start_date, self.storage.stats_week_duration(), hook)
+    
+    def get_all_monthly_sla(self, start_date, hook):
+        """Monthly SLA of all services from daily SLA (see rollup_sla)"""
+        if not self.resume_sla("monthly", start_date):
+            self.rollup_sla("monthly", start_date, self.storage.stats_month_duration(start_date), hook)
+    
+    def get_all_yearly_sla(self, start_date, hook):
+        """Yearly SLA of all services from daily SLA (see rollup_sla)"""
+        if not self.resume_sla("yearly", start_date):
+            self.rollup_sla("yearly", start_date, self.storage.stats_year_duration(start_date), hook)
+    
+    def rollup_sla(self, period, start_date, duration, hook):
+        """SLA of all services aggregated from the daily SLA
+        
+        Services and daily SLA are both read sorted by service _id so we only keep the daily SLA
+        of the services in flight in memory.
+        
+        Args:
+            period (String): weekly, monthly or yearly
+            start_date (int): epoch timestamp
+            duration (int): number of seconds of the period
+            hook (function): function to call for each sla computed with the number of seconds of downtime
+        """
+        end_date = start_date + duration
+        
+        query = {"date": { "$gte" : start_date, "$lt" : end_date }, "down": { "$exists" : True }}
+        query.update(self.checkpoint_query(period, start_date, "_id_uptime"))
+        
+        dailies = self.daily_uptime.find(query, \
+            projection={"_id_uptime": 1, "date": 1, "duration": 1, "down": 1}, \
+            sort=[("_id_uptime", pymongo.ASCENDING), ("date", pymongo.ASCENDING)])
+        dailies = itertools.groupby(dailies, key=lambda daily: daily["_id_uptime"])
+        
+        def join():
+            current = next(dailies, None)
+            for service in self.storage.stats_iter_all_svc(self.checkpoint_query(period, start_date), \
+                    projection={"_id": 1}, sort=[("_id", pymongo.ASCENDING)]):
+                # daily SLA of services that don't exist anymore
+                while current is not None and current[0] < service["_id"]:
+                    current = next(dailies, None)
+                
+                rows = []
+                if current is not None and current[0] == service["_id"]:
+                    rows = list(current[1])
+                    current = next(dailies, None)
+                
+                yield service, rows
+        
+        def compute(item):
+            service, rows = item
+            down = self.rollup_down_seconds(service, start_date, end_date, rows)
+            hook(service, 100 - ( down * 100 / duration ), down)
+        
+        self.map_services(join(), compute, lambda item: self.checkpoint_sla(period, start_date, item[0]["_id"]))
+    
+    def rollup_down_seconds(self, service, start_date, end_date, dailies):
+        """Number of seconds of downtime of a service from its daily SLA
+        
+        Parts of the period that are not covered by a daily SLA are computed from the raw history.
+        
+        Args:
+            service (dict): service Document
+            start_date (int): epoch timestamp
+            end_date (int): epoch timestamp
+            dailies (list): daily SLA Documents of the service sorted by date
+        
+        Returns:
+            int: Number of seconds of downtime
+        """
+        down = 0
+        covered_until = start_date
+        
+        for daily in dailies:
+            daily_end_date = daily["date"] + daily["duration"]
+            if daily["date"] < covered_until or daily_end_date > end_date:
+                # not aligned with the period
+                continue
+            
+            if daily["date"] > covered_until:
+                # missing days
+                down = down + self.storage.stats_get_svc_down_seconds(service, covered_until, daily["date"] - covered_until)
+            
+            down = down + daily["down"]
+            covered_until = daily_end_date
+        
+        if covered_until < end_date:
+            # missing days
+            down = down + self.storage.stats_get_svc_down_seconds(service, covered_until, end_date - covered_until)
+        
+        if down > end_date - start_date:
+            down = end_date - start_date
+        
+        return down
+    
+    # Hooks
+    
+    def hook_sla(self, period, service, date, duration, sla, down):
+        """Store the SLA of a service
+        
+        Args:
+            period (String): daily, weekly, monthly or yearly
+            service (dict): service Document
+            date (int): epoch timestamp of the begining of the period
+            duration (int): number of seconds of the period
+            sla (float): 0.0-100.0 sla
+            down (int): number of seconds of downtime or Unknown (None)
+        """
+        
+        values = {"sla": sla}
+        if down is not None:
+            values["down"] = down
+            values["duration"] = duration
+        
+        # Add or update depending the status (that can be a recalculation, or restart after errors etc)
+        self.writers[period].add(pymongo.UpdateOne({"_id_uptime": service["_id"], "date" : date}, { "$set" : values}, upsert=True))
+        
+    def hook_daily_sla(self, service, sla, down=None):
         """Hook for daily SLA
         
         Insert on the DB the sla of the service
@@ -436,18 +1329,25 @@ class MongoStorageConsolidationSLA(ConsolidationSLA):
             service (dict): service Document
             sla (float): 0.0-100.0 sla
         
-        """
+        Keyword Arguments:
+            down (int): number of seconds of downtime
         
-        # Add or update depending the status (that can be a recalculation, or restart after errors etc)
-        result = self.daily_uptime.update_one({"_id_uptime": service["_id"], "date" : self.wip_date_daily_sla}, { "$set" : {"sla": sla}}, upsert=True)
+        """
+        self.hook_sla("daily", service, self.wip_date_daily_sla, self.storage.stats_day_duration(), sla, down)
         
     def daily_sla_done(self):
         """Daily compute is done"""
         
+        # all SLA need to be written before
+        self.writers["daily"].done()
+        
         # update the date in the db as done
-        self.consolidation_state.update_one({"state": "daily"}, { "$set" : { "next": self.date_daily_sla }}, upsert=True)
+        self.state_done("daily", self.wip_date_daily_sla, self.date_daily_sla)
+        
+        # the period is complete
+        self.checkpoint_clear("daily")
 
-    def hook_weekly_sla(self, service, sla):
+    def hook_weekly_sla(self, service, sla, down=None):
         """Hook for weekly SLA
         
         Insert on the DB the sla of the service
@@ -455,19 +1355,26 @@ class MongoStorageConsolidationSLA(ConsolidationSLA):
         Args:
             service (dict): service Document
             sla (float): 0.0-100.0 sla
+        
+        Keyword Arguments:
+            down (int): number of seconds of downtime
             
         """
-        
-        # Add or update depending the status (that can be a recalculation, or restart after errors etc)
-        result = self.weekly_uptime.update_one({"_id_uptime": service["_id"], "date" : self.wip_date_weekly_sla}, { "$set" : {"sla": sla}}, upsert=True)
+        self.hook_sla("weekly", service, self.wip_date_weekly_sla, self.storage.stats_week_duration(), sla, down)
         
     def weekly_sla_done(self):
         """Weekly compute is done"""
         
+        # all SLA need to be written before
+        self.writers["weekly"].done()
+        
         # update the date in the db as done
-        self.consolidation_state.update_one({"state": "weekly"}, { "$set" : { "next": self.date_weekly_sla }}, upsert=True)
+        self.state_done("weekly", self.wip_date_weekly_sla, self.date_weekly_sla)
+        
+        # the period is complete
+        self.checkpoint_clear("weekly")
 
-    def hook_monthly_sla(self, service, sla):
+    def hook_monthly_sla(self, service, sla, down=None):
         """Hook for Montlhy SLA
         
         Insert on the DB the sla of the service
@@ -475,17 +1382,51 @@ class MongoStorageConsolidationSLA(ConsolidationSLA):
         Args:
             service (dict): service Document
             sla (float): 0.0-100.0 sla
+        
+        Keyword Arguments:
+            down (int): number of seconds of downtime
             
         """
-        
-        # Add or update depending the status (that can be a recalculation, or restart after errors etc)
-        result = self.monthly_uptime.update_one({"_id_uptime": service["_id"], "date" : self.wip_date_monthly_sla}, { "$set" : {"sla": sla}}, upsert=True)
+        self.hook_sla("monthly", service, self.wip_date_monthly_sla, self.storage.stats_month_duration(self.wip_date_monthly_sla), sla, down)
         
     def monthly_sla_done(self):
         """Montlhy compute is done"""
         
+        # all SLA need to be written before
+        self.writers["monthly"].done()
+        
         # update the date in the db as done
-        self.consolidation_state.update_one({"state": "monthly"}, { "$set" : { "next": self.date_monthly_sla }}, upsert=True)
+        self.state_done("monthly", self.wip_date_monthly_sla, self.date_monthly_sla)
+        
+        # the period is complete
+        self.checkpoint_clear("monthly")
+    
+    def hook_yearly_sla(self, service, sla, down=None):
+        """Hook for Yearly SLA
+        
+        Insert on the DB the sla of the service
+        
+        Args:
+            service (dict): service Document
+            sla (float): 0.0-100.0 sla
+        
+        Keyword Arguments:
+            down (int): number of seconds of downtime
+            
+        """
+        self.hook_sla("yearly", service, self.wip_date_yearly_sla, self.storage.stats_year_duration(self.wip_date_yearly_sla), sla, down)
+        
+    def yearly_sla_done(self):
+        """Yearly compute is done"""
+        
+        # all SLA need to be written before
+        self.writers["yearly"].done()
+        
+        # update the date in the db as done
+        self.state_done("yearly", self.wip_date_yearly_sla, self.date_yearly_sla)
+        
+        # the period is complete
+        self.checkpoint_clear("yearly")
 
 
 class MongoStorageConsolidationStatus(ConsolidationStatus):
@@ -499,39 +1440,263 @@ class MongoStorageConsolidationStatus(ConsolidationStatus):
         
     Keyword Arguments:
         down_time_duration (int): number of second to consider a service as really down.
-        waiting_seconds_between_batch (int): Number of seconds to wait between 2 workload
+        waiting_seconds_between_batch (int): Number of seconds between 2 full resync
     """
     
-    def __init__(self, storage, services_filter, down_time_duration=600, waiting_seconds_between_batch=60):
+    def __init__(self, storage, services_filter, down_time_duration=600, waiting_seconds_between_batch=900):
         super().__init__(storage, down_time_duration, waiting_seconds_between_batch)
         
         self.services_filter = services_filter
+    
+    def open_downtimes(self, since):
+        """see ConsolidationStatus class"""
+        if self.storage.downtime_pointer:
+            # open downtimes are referenced by the services
+            for svc in self.storage.stats_uptime.find({"$and" : [self.services_filter, {"down_start_date" : { "$gt" : since }}]}, \
+                    projection={"_id": 1, "down_start_date": 1}):
+                yield svc["_id"], svc["down_start_date"]
+            return
+        
+        for downtime in self.storage.stats_uptime_history.find({"down_end_date" : 0, "down_start_date" : { "$gt" : since }}, \
+                projection={"_id_uptime": 1, "down_start_date": 1}):
+            yield downtime["_id_uptime"], downtime["down_start_date"]
+    
+    def set_status_public(self, id_svc, status):
+        """see ConsolidationStatus class"""
+        self.storage.stats_uptime.update_one({"$and" : [self.services_filter, {"_id" : id_svc, "status_public" : { "$ne" : status }}]}, \
+            { "$set" : {"status_public" : status} })
         
     def compute_status(self):
         """Compute status
         
         Update the status for some services to calculate which ones are down since more than "down_time_duration"
         
+        The number of queries doesn't depend on the number of services: two update_many to only change services with a
+        different status. Without the downtime pointer on the services (see MongoStorage.migrate), one more query gets
+        services with an open downtime started before "down_time_duration".
+        
         """
         
         down_start_date = time.time() - self.down_time_duration
         
         try:
-            for svc in self.storage.stats_get_all_svc(self.services_filter):
-                resultat = self.storage.uptime_history.find_one({"_id_uptime" : svc["_id"], "down_end_date" : 0, "down_start_date" : { "$lte" : down_start_date }})
-                
-                if "status_public" in svc.keys():
-                    status = svc["status_public"]
-                else:
-                    status = None
-                
-                if resultat is None:
-                    # there is no downtime so status is OK
-                    if status is None or status != Service.OK:
-                        self.storage.uptime.update_one({"_id" : svc["_id"]}, { "$set" : {"status_public" : Service.OK} })
-                else:
-                    # there is a downtime so status is FAIL
-                    if status is None or status == Service.OK:
-                        self.storage.uptime.update_one({"_id" : svc["_id"]}, { "$set" : {"status_public" : Service.FAIL} })
+            if self.storage.downtime_pointer:
+                # services down since more than down_time_duration
+                failing = {"down_start_date" : { "$lte" : down_start_date }}
+                not_failing = {"$or" : [{"down_start_date" : { "$exists" : False }}, {"down_start_date" : { "$gt" : down_start_date }}]}
+            else:
+                failing = self.storage.stats_uptime_history.distinct("_id_uptime", {"down_end_date" : 0, "down_start_date" : { "$lte" : down_start_date }})
+                not_failing = {"_id" : { "$nin" : failing }}
+                failing = {"_id" : { "$in" : failing }}
+            
+            # there is a downtime so status is FAIL
+            self.storage.stats_uptime.update_many({"$and" : [self.services_filter, failing, {"status_public" : { "$in" : [None, Service.OK] }}]}, \
+                { "$set" : {"status_public" : Service.FAIL} })
+            
+            # there is no downtime so status is OK
+            self.storage.stats_uptime.update_many({"$and" : [self.services_filter, not_failing, {"status_public" : { "$ne" : Service.OK }}]}, \
+                { "$set" : {"status_public" : Service.OK} })
         except:
             print("Issue to compute status")
+
+class MongoStorageConsolidationRetention(Consolidation):
+    """History retention with MongoStorage Backend
+    
+    Drop (and archive) the uptime_history partitions older than keep_months.
+    This requires history_partitioning on the MongoStorage.
+    
+    Constructor
+    
+    Args:
+        storage (Storage): An instance of storage backend
+        keep_months (int): Number of complete months to keep (the current month is always kept)
+        
+    Keyword Arguments:
+        archive_path (String): Directory where to archive partitions before dropping them (no archive by default)
+        waiting_seconds_between_batch (int): Number of seconds to wait between 2 workload
+    
+    """
+    
+    #keep_months
+    #archive_path
+    #waiting_seconds_between_batch
+    
+    def __init__(self, storage, keep_months, archive_path=None, waiting_seconds_between_batch=86400):
+        super().__init__(storage)
+        
+        self.keep_months = keep_months
+        self.archive_path = archive_path
+        self.waiting_seconds_between_batch = waiting_seconds_between_batch
+    
+    def compute_retention(self):
+        """Compute the retention"""
+        
+        now = datetime.now(timezone.utc)
+        before = datetime(now.year, now.month, 1, tzinfo=timezone.utc) - relativedelta(months=self.keep_months)
+        
+        try:
+            # closed downtimes not yet moved to their partition
+            self.storage.history_repair()
+            
+            self.storage.history_retention(before.timestamp(), self.archive_path)
+        except:
+            print("Issue to compute retention")
+    
+    def schedule(self, scheduler):
+        """see Consolidation class"""
+        self.schedule_job(scheduler, "consolidation retention", self.compute_retention, self.waiting_seconds_between_batch, missed=Job.MISSED_SKIP)
+    
+    def run(self):
+        """Drop old history"""
+        
+        print("starting consolidation retention ...")
+        
+        self.run_scheduler()
+        
+        print("consolidation retention stopped")
+
+class MemoryStorageConsolidationSLA(ConsolidationSLA):
+    """SLA Consolidation with MemoryStorage Backend
+    
+    SLA are stored in memory on dictionaries keyed by (_id of the service, start date of the period)
+    
+    Constructor
+    
+    Args:
+        storage (Storage): An instance of storage backend
+        
+    Keyword Arguments:
+        waiting_seconds_between_batch (int): Number of seconds to wait between 2 workload
+    
+    """
+    
+    def __init__(self, storage, waiting_seconds_between_batch=300):
+        super().__init__(storage, waiting_seconds_between_batch)
+        
+        self.daily_uptime = dict()
+        self.weekly_uptime = dict()
+        self.monthly_uptime = dict()
+        self.yearly_uptime = dict()
+        self.consolidation_state = dict()
+    
+    def state_done(self, period, start_date, next_date):
+        """Save a period as done (see MongoStorageConsolidationSLA.state_done)
+        
+        Args:
+            period (String): daily, weekly, monthly or yearly
+            start_date (int): epoch timestamp of the period computed
+            next_date (int): epoch timestamp of the period after
+        """
+        if self.backfilling:
+            if self.consolidation_state.get(period) == start_date:
+                self.consolidation_state[period] = next_date
+        else:
+            self.consolidation_state[period] = max(self.consolidation_state.get(period, 0), next_date)
+    
+    def hook_daily_sla(self, service, sla):
+        """Hook for daily SLA
+        
+        Args:
+            service (dict): service Document
+            sla (float): 0.0-100.0 sla
+        
+        """
+        self.daily_uptime[(service["_id"], self.wip_date_daily_sla)] = sla
+    
+    def daily_sla_done(self):
+        """Daily compute is done"""
+        self.state_done("daily", self.wip_date_daily_sla, self.date_daily_sla)
+    
+    def hook_weekly_sla(self, service, sla):
+        """Hook for weekly SLA
+        
+        Args:
+            service (dict): service Document
+            sla (float): 0.0-100.0 sla
+        
+        """
+        self.weekly_uptime[(service["_id"], self.wip_date_weekly_sla)] = sla
+    
+    def weekly_sla_done(self):
+        """Weekly compute is done"""
+        self.state_done("weekly", self.wip_date_weekly_sla, self.date_weekly_sla)
+    
+    def hook_monthly_sla(self, service, sla):
+        """Hook for monthly SLA
+        
+        Args:
+            service (dict): service Document
+            sla (float): 0.0-100.0 sla
+        
+        """
+        self.monthly_uptime[(service["_id"], self.wip_date_monthly_sla)] = sla
+    
+    def monthly_sla_done(self):
+        """Monthly compute is done"""
+        self.state_done("monthly", self.wip_date_monthly_sla, self.date_monthly_sla)
+    
+    def hook_yearly_sla(self, service, sla):
+        """Hook for yearly SLA
+        
+        Args:
+            service (dict): service Document
+            sla (float): 0.0-100.0 sla
+        
+        """
+        self.yearly_uptime[(service["_id"], self.wip_date_yearly_sla)] = sla
+    
+    def yearly_sla_done(self):
+        """Yearly compute is done"""
+        self.state_done("yearly", self.wip_date_yearly_sla, self.date_yearly_sla)
+
+class MemoryStorageConsolidationStatus(ConsolidationStatus):
+    """Status Consolidation with MemoryStorage Backend
+    
+    Constructor
+    
+    Args:
+        storage (Storage): An instance of storage backend
+        services_filter (dict): Filter which services need to expose a status
+        
+    Keyword Arguments:
+        down_time_duration (int): number of second to consider a service as really down.
+        waiting_seconds_between_batch (int): Number of seconds between 2 full resync
+    """
+    
+    def __init__(self, storage, services_filter, down_time_duration=600, waiting_seconds_between_batch=900):
+        super().__init__(storage, down_time_duration, waiting_seconds_between_batch)
+        
+        self.services_filter = services_filter
+    
+    def open_downtimes(self, since):
+        """see ConsolidationStatus class"""
+        for id_svc, id_downtime in list(self.storage.open_downtimes.items()):
+            down_start_date = self.storage.uptime_history[id_downtime]["down_start_date"]
+            if down_start_date > since:
+                yield id_svc, down_start_date
+    
+    def set_status_public(self, id_svc, status):
+        """see ConsolidationStatus class"""
+        svc = self.storage.uptime.get(id_svc)
+        if svc is not None and all(svc.get(key) == value for key, value in self.services_filter.items()):
+            svc["status_public"] = status
+    
+    def compute_status(self):
+        """Compute status
+        
+        Update the status for some services to calculate which ones are down since more than "down_time_duration"
+        
+        """
+        
+        down_start_date = time.time() - self.down_time_duration
+        
+        for svc in self.storage.stats_get_all_svc(self.services_filter):
+            downtime = self.storage.query_exec_find_current_downtime(None, svc["_id"])
+            
+            if downtime is None or downtime["down_start_date"] > down_start_date:
+                status = Service.OK
+            else:
+                status = Service.FAIL
+            
+            if svc.get("status_public") != status:
+                self.storage.uptime[svc["_id"]]["status_public"] = status
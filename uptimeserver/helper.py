@@ -24,28 +24,31 @@ class DaemonHelper:
         """Sleep but wake up some time to check if a stop was requested
         
         If stop_switch is set to True, we will quit the sleep.
+        If obj has a stop_event (threading.Event), we will quit the sleep as soon as it is set.
         
         This is useful for long sleep and thread not set as a daemon.
         
         Args:
-            sleep_time (int): duration in seconds
+            sleep_time (float): duration in seconds
             obj (object): object with a stop_switch bool variable
             
         Keyword Arguments:
-            sleep_inc (int): deep sleep time in seconds
+            sleep_inc (int): deep sleep time in seconds (without stop_event)
         
         """
         
-        if sleep_time > 0:
-            sleep_done = 0
-            while(sleep_done < sleep_time):
-                # try to stop early if requested
-                if obj.stop_switch:
-                    break
-
-                if (sleep_time - sleep_done < sleep_inc):
-                    time.sleep(sleep_time - sleep_done)
-                else:
-                    time.sleep(sleep_inc)
-                sleep_done = sleep_done + sleep_inc
-                
+        if sleep_time <= 0:
+            return
+        
+        stop_event = getattr(obj, "stop_event", None)
+        if stop_event is not None:
+            stop_event.wait(sleep_time)
+            return
+        
+        deadline = time.monotonic() + sleep_time
+        while not obj.stop_switch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            
+            time.sleep(min(remaining, sleep_inc))
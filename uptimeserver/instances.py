@@ -15,13 +15,17 @@
 """
 Instances module
 
-Permit to manage some lock about multiple instances
+Permit to manage some lock about multiple instances or to share the services between them
 """
 
 import threading
 import time
 import os
 import signal
+import socket
+import bisect
+import hashlib
+import pymongo
 
 class OneInstanceLock(threading.Thread):
     """One active instance only
@@ -30,28 +34,59 @@ class OneInstanceLock(threading.Thread):
     that only one instance will be active on the same database.
     
     Currently, the implementation of the server do not support multiple instances if there is
-    an overlapping of some services to check.
+    an overlapping of some services to check (see PartitionedInstance to share the services).
     
     This class permit to start the server with a lock and permit CI/CD integration, or standby server mode
     with automatic switch to active one if the previous active one is in failure...
     
+    The lock is a short lease with a fencing token: the token is incremented each time an instance takes the lock
+    and the lease is renewed only with the current token, so an instance that lost the lock (eg: paused) can't renew
+    it. An active instance stops its checks and consolidations as soon as its lease expires locally, before another
+    instance can take the lock.
+    
+    The standby is warm: the server is started (providers, services, storage caches) but nothing is checked or
+    consolidated until the lock is taken.
+    
+    stopInstance (SIGINT, SIGTERM) stops the server gracefully. An active instance hands over to a standby:
+    the server is drained then the lock is released with the state of the services (failure counters and statuses)
+    and the next runs of the scheduler jobs. The standby polls the lock every standby_poll seconds to take it.
+    If the lock is lost, the server is stopped and the process receives SIGTERM to exit.
+    
     Constructor
     
     Args:
         server (Server): a server
     
     Keyword Arguments:
-        alive (int): number of seconds to check if the server is alive
+        alive (int): number of seconds between 2 heartbeats
         inactive_during (int): number of seconds to wait before considering a server as dead
+        standby_poll (float): number of seconds between 2 tries of the standby
+    
+    Raises:
+        Exception: inactive_during is not greater than alive
     """
     
-    def __init__(self, server, alive=60, inactive_during=180):
+    #id = None
+    #token = None
+    #lease_until = 0
+    
+    def __init__(self, server, alive=3, inactive_during=9, standby_poll=0.5):
         threading.Thread.__init__(self)
+        
+        if inactive_during <= alive:
+            raise Exception("inactive_during needs to be greater than alive")
+        
         self.server = server
         self.alive = alive
         self.inactive_during = inactive_during
+        self.standby_poll = standby_poll
         self.isActive = False
         self.isRunning = False
+        self.stop_event = threading.Event()
+        
+        self.id = None
+        self.token = None
+        self.lease_until = 0
         
         self.instance_state = self.server.storage.db.get_collection("instance_state")
         if len(self.instance_state.index_information()) == 0:
@@ -60,76 +95,551 @@ class OneInstanceLock(threading.Thread):
             self.server.storage.db.create_collection("instance_state")
             self.instance_state.create_index( "date" )
         
+        # nothing is checked or consolidated while this instance is not active
+        self.server.monitoring.partition = self
+        for consolidation in self.server.consolidations:
+            consolidation.active = self.active
+    
+    def start(self, nosignalhandling=False):
+        """Start the instance
+        
+        Keyword Arguments:
+            nosignalhandling (bool): Do not stop the instance on terminate signal (SIGINT, SIGTERM)
+        """
+        if not nosignalhandling:
+            signal.signal(signal.SIGINT, self.terminate_signal)
+            signal.signal(signal.SIGTERM, self.terminate_signal)
+        
+        threading.Thread.start(self)
+    
+    def terminate_signal(self, signum, frame):
+        """stop the instance on a specific signal (SIGINT, SIGTERM)"""
+        self.stopInstance()
+    
+    def active(self):
+        """Is this instance active with a valid lease ?
+        
+        Returns:
+            bool: Active (True) or Not (False)
+        """
+        return self.isActive and time.monotonic() < self.lease_until
+    
+    def owns(self, service):
+        """Is the service checked by this instance ?
+        
+        Args:
+            service (Service): a Service
+        
+        Returns:
+            bool: Owned (True) or Not (False)
+        """
+        return self.active()
+    
+    def prepare(self):
+        """Start the server as a standby
+        
+        Providers and tasks are started and the storage caches are loaded so taking the lock only enables the checks.
+        """
+        self.server.startMonitoring(nosignalhandling=True)
+        
+        for service in self.server.monitoring.services():
+            if self.stop_event.is_set():
+                return
+            self.server.storage.preload(service)
+    
     def switch_this_instance_to_be_active(self):
         """Try to switch this instance as the active one
         
         Returns:
             bool: agree to switch (True) or not (False) 
         """
-        result = self.instance_state.find_one({})
+        start = time.monotonic()
+        when = int(time.time())
+        
+        try:
+            if self.id is None:
+                result = self.instance_state.find_one({"member": {"$exists": False}})
+                if result is None:
+                    result = self.instance_state.insert_one({"date" : 0, "token" : 0})
+                    self.id = result.inserted_id
+                else:
+                    self.id = result["_id"]
+            
+            # the lock is expired or released
+            result = self.instance_state.find_one_and_update({"_id": self.id, \
+                "$or" : [ {"date" : { "$lte" : when - self.inactive_during }}, {"released" : True} ]}, \
+                { "$set" : {"date" : when, "host" : socket.gethostname(), "pid" : os.getpid(), "released" : False}, \
+                "$inc" : {"token" : 1}, "$unset" : {"handoff" : ""} }, \
+                return_document=pymongo.ReturnDocument.BEFORE)
+        except:
+            return False
+        
         if result is None:
-            result = self.instance_state.insert_one({"date" : int(time.time())})
-            self.id = result.inserted_id
-        else:
-            self.id = result["_id"]
+            return False
         
-        return self.heartbeat(self.inactive_during)
+        self.token = result.get("token", 0) + 1
+        self.lease_until = start + self.inactive_during - self.alive
+        
+        handoff = result.get("handoff") if result.get("released") else None
+        if handoff is None:
+            # the previous active instance failed
+            handoff = {}
+        
+        self.handoff_services(handoff)
+        self.isActive = True
+        self.handoff_jobs(handoff)
+        
+        # tasks of a standby are sleeping with nothing owned
+        self.server.monitoring.wake()
+        
+        print("handoff: %d services, %d jobs" % (len(handoff.get("services", [])), len(handoff.get("jobs", []))))
+        return True
     
-    def heartbeat(self, seconds_before):
-        """Heartbeat check
+    def heartbeat(self):
+        """Renew the lease
         
-        Args:
-            seconds_before (int): lastest maximum expected heartbeat update in seconds
-            
         Returns:
-            bool: OK (True) or NOT (False)
+            bool: Renewed (True), Not renewed (False) or Lock taken by another instance (None)
         """
+        start = time.monotonic()
         when = int(time.time())
         
         try:
-            result = self.instance_state.update_one({"_id": self.id, "date" : { "$lte" : when - seconds_before }}, { "$set" : {"date" : when} }, upsert=True)
-            if result is not None:
-                return True
+            result = self.instance_state.update_one({"_id": self.id, "token" : self.token}, { "$set" : {"date" : when} })
         except:
-            pass
+            return False
+        
+        if result.matched_count == 0:
+            # fenced
+            return None
         
-        return False
+        # stop before another instance can take the lock
+        self.lease_until = start + self.inactive_during - self.alive
+        return True
+
+    def handoff_state(self):
+        """State handed over to the next active instance
+        
+        Only services failing are handed over (the document needs to stay under the BSON size limit),
+        the others are checked again from a clean state.
+        
+        Returns:
+            dict: services (key, failure_counter, status) and jobs (name, date)
+        """
+        services = []
+        for service in self.server.monitoring.services():
+            if service.checked and service.failure_counter > 0:
+                services.append({"key": service.identity_key(), "failure_counter": service.failure_counter, "status": service.status})
+        
+        jobs = []
+        for name, date in self.server.scheduler.next_runs().items():
+            if date is not None:
+                jobs.append({"name": name, "date": date})
+        
+        return {"services": services, "jobs": jobs}
+    
+    def handoff_services(self, handoff):
+        """Restore the state of the services of the previous active instance
+        
+        Args:
+            handoff (dict): see handoff_state
+        """
+        services = {item["key"]: item for item in handoff.get("services", [])}
+        for service in self.server.monitoring.services():
+            item = services.get(service.identity_key())
+            if item is not None:
+                service.failure_counter = item["failure_counter"]
+                service.status = item["status"]
+    
+    def handoff_jobs(self, handoff):
+        """Restore the next runs of the jobs of the previous active instance
+        
+        Jobs not handed over (all of them if the previous active instance failed) run now.
+        Jobs handed over but unknown here (eg: created on the fly by a consolidation) are ignored.
+        
+        Args:
+            handoff (dict): see handoff_state
+        """
+        jobs = {item["name"]: item["date"] for item in handoff.get("jobs", [])}
+        
+        for name in self.server.scheduler.next_runs():
+            self.server.scheduler.reschedule(name, jobs.get(name, time.time()))
+    
+    def release(self, handoff):
+        """Release the lock for a standby
+        
+        Args:
+            handoff (dict): see handoff_state
+        
+        Returns:
+            bool: Released (True) or Not (False)
+        """
+        try:
+            result = self.instance_state.update_one({"_id": self.id, "token" : self.token}, \
+                { "$set" : {"released" : True, "handoff" : handoff} })
+        except:
+            return False
+        
+        return result.matched_count == 1
+    
+    def stopInstance(self):
+        """Stop the instance (and the server if active)"""
+        print("stopping instance ...")
+        self.stop_event.set()
 
     def run(self):
         """Start
         
+        - Start the server as a standby
         - Check if we can be the active instance or not
         - Check heartbeat
-        - Stop us if heartbeat failed
+        - Stop us if the lock is lost or if a stop is requested
         """
         try:
             self.isRunning = True
             
+            print("Sarting the server as a standby ...")
+            
+            self.prepare()
+            
             print("Try to be the active instance ...")
             
             # Try to be the active instance
             while not self.switch_this_instance_to_be_active():
-                time.sleep(self.alive)
+                if self.stop_event.wait(self.standby_poll):
+                    return
+            
+            print("Active instance with token %d" % (self.token))
+            
+            print("Heartbeat loop ...")
+            
+            # Heartbeat
+            while not self.stop_event.wait(self.alive):
+                renewed = self.heartbeat()
+                if renewed is None:
+                    print("Lock taken by another instance, stopping the server ...")
+                    break
+                if not renewed and not self.active():
+                    print("Heartbeat issue, stopping the server ...")
+                    break
+        except:
+            pass
+        finally:
+            handoff = None
+            if self.active() and self.stop_event.is_set():
+                # the scheduler jobs are removed by the stop
+                handoff = self.handoff_state()
             
-            print("Sarting the server ...")
+            # stop Monitoring
+            self.server.stopMonitoring()
+            
+            if handoff is not None:
+                # checks are finished so the failure counters are final
+                handoff["services"] = self.handoff_state()["services"]
+                if self.release(handoff):
+                    print("Lock released")
+            self.isActive = False
+            self.isRunning = False
             
-            # start Monitoring
+            if not self.stop_event.is_set():
+                # another instance can be active now so this process needs to exit
+                os.kill(os.getpid(), signal.SIGTERM)
+
+class HashRing:
+    """Consistent hashing of keys over members
+    
+    Each member is placed many times (virtual nodes) on the ring so keys are evenly shared and only the keys of
+    a member that joins or leaves are moved.
+    
+    Constructor
+    
+    Args:
+        members (list): members (String)
+    
+    Keyword Arguments:
+        vnodes (int): number of virtual nodes per member
+    """
+    
+    #members = []
+    #hashes = []
+    #nodes = []
+    vnodes = 128
+    
+    def __init__(self, members, vnodes=None):
+        if vnodes is not None:
+            self.vnodes = vnodes
+        
+        self.members = sorted(members)
+        
+        ring = sorted((HashRing.hash("%s-%d" % (member, i)), member) for member in self.members for i in range(self.vnodes))
+        self.hashes = [h for h, member in ring]
+        self.nodes = [member for h, member in ring]
+    
+    @staticmethod
+    def hash(key):
+        """Hash of a key
+        
+        Args:
+            key (String): a key
+        
+        Returns:
+            int: 64 bits hash (stable between processes)
+        """
+        return int(hashlib.md5(key.encode("utf-8")).hexdigest()[:16], 16)
+    
+    def owner(self, key):
+        """Member owning a key
+        
+        Args:
+            key (String): a key
+        
+        Returns:
+            String: member or No member (None)
+        """
+        if len(self.nodes) == 0:
+            return None
+        
+        i = bisect.bisect(self.hashes, HashRing.hash(key))
+        if i == len(self.hashes):
+            i = 0
+        
+        return self.nodes[i]
+
+class PartitionedInstance(threading.Thread):
+    """Active instances sharing the services
+    
+    Every instance loads all services but checks only the ones it owns. Each instance is a member with a lease
+    (heartbeat) on the instance_state collection and the services are shared between the live members with a
+    consistent hashing of Service.identity_key(). The partitions are rebalanced when an instance joins or leaves.
+    
+    To avoid a service to be checked twice during a rebalance:
+    
+    - a service moved to another member is not checked anymore as soon as the change is seen
+    - a service moved to this member is checked only once all members had time to see the change (settle)
+    - a member that can not renew its lease stops checking before the other members consider it as dead
+    
+    The consolidations are run only by one member (the oldest one).
+    
+    stopInstance stops the server gracefully and removes the member so the other members take its services.
+    
+    Constructor
+    
+    Args:
+        server (Server): a server
+    
+    Keyword Arguments:
+        alive (int): number of seconds between 2 heartbeats
+        inactive_during (int): number of seconds to wait before considering a member as dead
+        vnodes (int): number of virtual nodes per member on the ring
+    
+    Raises:
+        Exception: inactive_during is not greater than alive
+    """
+    
+    #id = None
+    #ring = None
+    #pending = None
+    #pending_at = None
+    #lease_until = 0
+    #lock = threading.Lock()
+    vnodes = None
+    
+    def __init__(self, server, alive=10, inactive_during=30, vnodes=None):
+        threading.Thread.__init__(self)
+        
+        if inactive_during <= alive:
+            raise Exception("inactive_during needs to be greater than alive")
+        
+        self.server = server
+        self.alive = alive
+        self.inactive_during = inactive_during
+        if vnodes is not None:
+            self.vnodes = vnodes
+        self.isRunning = False
+        self.stop_event = threading.Event()
+        
+        self.id = None
+        self.ring = None
+        self.pending = None
+        self.pending_at = None
+        self.lease_until = 0
+        self.lock = threading.Lock()
+        
+        self.instance_state = self.server.storage.db.get_collection("instance_state")
+        if len(self.instance_state.index_information()) == 0:
+            # collection does not exist
+            # create it and create indexes
+            self.server.storage.db.create_collection("instance_state")
+            self.instance_state.create_index( "date" )
+        
+        # checks and consolidations are limited to this member
+        self.server.monitoring.partition = self
+        for consolidation in self.server.consolidations:
+            consolidation.active = self.leader
+    
+    def register(self):
+        """Add this instance as a member"""
+        result = self.instance_state.insert_one({"member": True, "host": socket.gethostname(), "pid": os.getpid(), "date": int(time.time())})
+        self.id = result.inserted_id
+        self.lease_until = time.monotonic() + self.inactive_during - self.alive
+    
+    def unregister(self):
+        """Remove this instance from the members"""
+        try:
+            self.instance_state.delete_one({"_id": self.id})
+        except:
+            pass
+    
+    def heartbeat(self):
+        """Renew the lease of this member
+        
+        Returns:
+            bool: Renewed (True) or Not (False)
+        """
+        start = time.monotonic()
+        when = int(time.time())
+        
+        try:
+            # upsert: the member can be removed as dead by another one
+            self.instance_state.update_one({"_id": self.id}, { "$set" : {"member": True, "date" : when} }, upsert=True)
+        except:
+            return False
+        
+        # stop before the other members consider us as dead
+        self.lease_until = start + self.inactive_during - self.alive
+        return True
+    
+    def members(self):
+        """Live members
+        
+        Returns:
+            list: members (String) or Not available (None)
+        """
+        when = int(time.time())
+        
+        try:
+            # dead members
+            self.instance_state.delete_many({"member": True, "date" : { "$lt" : when - 2 * self.inactive_during }})
+            
+            return [str(result["_id"]) for result in self.instance_state.find({"member": True, "date" : { "$gte" : when - self.inactive_during }}, {"_id": 1})]
+        except:
+            return None
+    
+    def rebalance(self, members):
+        """Update the partitions with the live members
+        
+        Args:
+            members (list): live members
+        """
+        now = time.monotonic()
+        promoted = False
+        
+        with self.lock:
+            if self.pending is not None and now >= self.pending_at:
+                # every member saw the change
+                self.ring = self.pending
+                self.pending = None
+                promoted = True
+            
+            current = self.pending if self.pending is not None else self.ring
+            if current is None or current.members != sorted(members):
+                print("members: %d" % (len(members)))
+                self.pending = HashRing(members, self.vnodes)
+                # the other members see the change on their next heartbeat
+                self.pending_at = now + 2 * self.alive
+        
+        if promoted:
+            # check the services owned with the new partitions now
+            self.server.monitoring.wake()
+    
+    def owned(self, key):
+        """Is the key owned by this member ?
+        
+        During a rebalance, the key needs to be owned with the previous and the new partitions.
+        
+        Args:
+            key (String): a key
+        
+        Returns:
+            bool: Owned (True) or Not (False)
+        """
+        if self.id is None or time.monotonic() > self.lease_until:
+            return False
+        
+        with self.lock:
+            ring = self.ring
+            pending = self.pending
+        
+        if ring is None or ring.owner(key) != str(self.id):
+            return False
+        
+        return pending is None or pending.owner(key) == str(self.id)
+    
+    def owns(self, service):
+        """Is the service checked by this member ?
+        
+        Args:
+            service (Service): a Service
+        
+        Returns:
+            bool: Owned (True) or Not (False)
+        """
+        return self.owned(service.identity_key())
+    
+    def leader(self):
+        """Is this member running the consolidations ?
+        
+        Returns:
+            bool: Leader (True) or Not (False)
+        """
+        if self.id is None or time.monotonic() > self.lease_until:
+            return False
+        
+        with self.lock:
+            rings = [ring for ring in (self.ring, self.pending) if ring is not None]
+        
+        return len(rings) > 0 and all(ring.members[0] == str(self.id) for ring in rings)
+    
+    def stopInstance(self):
+        """Stop the instance and the server"""
+        print("stopping instance ...")
+        self.stop_event.set()
+    
+    def run(self):
+        """Start
+        
+        - Add this instance as a member
+        - Start the server (only owned services are checked)
+        - Heartbeat and rebalance the partitions until a stop is requested
+        """
+        try:
+            self.isRunning = True
+            
+            self.register()
+            
+            print("Sarting the server as member %s ..." % (str(self.id)))
+            
+            self.rebalance(self.members() or [str(self.id)])
             self.server.startMonitoring(nosignalhandling=True)
             
             print("Heartbeat loop ...")
             
-            # Heartbeat
-            time.sleep(self.alive + 1)
-            while self.heartbeat(self.alive):
-                time.sleep(self.alive + 1)
+            while not self.stop_event.wait(self.alive):
+                if not self.heartbeat():
+                    print("Heartbeat issue, the lease will expire ...")
+                    continue
                 
-            print("Heartbeat issue, stopping the server ...")
+                members = self.members()
+                if members is not None:
+                    self.rebalance(members)
         except:
             pass
         finally:
             # stop Monitoring
             self.server.stopMonitoring()
+            if self.id is not None:
+                self.unregister()
             self.isRunning = False
-            # kill myself (temporary workaround)
-            os.kill(os.getpid(), 9)
-    
+            
+            if not self.stop_event.is_set():
+                os.kill(os.getpid(), signal.SIGTERM)
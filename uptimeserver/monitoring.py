@@ -19,7 +19,6 @@ Monitoring Manager, thread management etc.
 """
 
 from .services import Service
-from .helper import DaemonHelper
 import threading
 import time
 from datetime import datetime
@@ -35,6 +34,7 @@ class ServicesMonitoring:
     - start/stop monitoring
     - Manage fast retry after a first service FAIL detection
     - Notify the backend to update a service status
+    - Check only the services owned by this instance when a partition is set (see PartitionedInstance)
     
     This is thread safe and so it is possible to add/remove services from any other threads.
     It is possible to add/delete services on the fly (running state or not)
@@ -54,6 +54,8 @@ class ServicesMonitoring:
     #isRunning = False
     #backend_notify = None
     #fast_retry_every_seconds = 3
+    #partition = None
+    #owners = dict()
 
     def __init__(self, backend_notify = None, max_services = 10, check_every_seconds = 300, fast_retry_every_seconds = 3):
         self.providers = dict()
@@ -64,35 +66,49 @@ class ServicesMonitoring:
         self.max_services = max_services
         self.check_every_seconds = check_every_seconds
         self.fast_retry_every_seconds = fast_retry_every_seconds
+        self.partition = None
+        # identity key of the service (services don't need to be hashable) -> provider
+        self.owners = dict()
 
-    def add(self, service, provider="default"):
-        """Add a service to the Monitoring
+    def owns(self, service):
+        """Is the service checked by this instance ?
         
         Args:
             service (Service): a Service
         
+        Returns:
+            bool: Owned (True) or Not (False)
+        """
+        return self.partition is None or self.partition.owns(service)
+
+    def services(self, provider=None):
+        """Services of a provider or of all providers
+        
         Keyword Arguments:
-            provider (String): Name of the provider
+            provider (String): Name of the provider (None for all providers)
         
+        Returns:
+            list: services
         """
         
         # protect self.providers
         with self.lock:
-            if self.providers.get(provider) is None:
-                self.providers[provider] = []
-    
-            # Look for an existing service in a provider
-            service_already_set_on_a_provider = False
-            for key in self.providers:
-                if service in self.providers[key]:
-                    service_already_set_on_a_provider = True
-                    break
-    
-            if not service_already_set_on_a_provider:
-                # Add the service to the provider
-                self.providers[provider].append(service)
-                # Add the service to a task
-                self.task_add(service)
+            if provider is not None:
+                return list(self.providers.get(provider, []))
+            
+            return [service for key in self.providers for service in self.providers[key]]
+
+    def add(self, service, provider="default"):
+        """Add a service to the Monitoring
+        
+        Args:
+            service (Service): a Service
+        
+        Keyword Arguments:
+            provider (String): Name of the provider
+        
+        """
+        self.add_many([service], provider)
 
     def remove(self, service, provider="default"):
         """Remove a service to the Monitoring
@@ -103,18 +119,108 @@ class ServicesMonitoring:
         Keyword Arguments:
             provider (String): Name of the provider
         
+        """
+        self.remove_many([service], provider)
+
+    def add_many(self, services, provider="default"):
+        """Add services to the Monitoring in one batch
+        
+        Services already monitored (by any provider) or repeated in the batch are ignored.
+        
+        Args:
+            services (list): Services to add
+        
+        Keyword Arguments:
+            provider (String): Name of the provider
+        
         """
         
         # protect self.providers
         with self.lock:
-            if self.providers.get(provider) is None:
-                return
+            self.provider_add(services, provider)
 
-            if service in self.providers[provider]:
-                # remove the service
-                self.providers[provider].remove(service)
-                # remove the service from a task
-                self.task_remove(service)
+    def remove_many(self, services, provider="default"):
+        """Remove services of a provider from the Monitoring in one batch
+        
+        Args:
+            services (list): Services to remove
+        
+        Keyword Arguments:
+            provider (String): Name of the provider
+        
+        """
+        
+        # protect self.providers
+        with self.lock:
+            self.provider_remove(services, provider)
+
+    def update(self, added, removed, provider="default"):
+        """Remove and add services to the Monitoring in one batch
+        
+        The lock is taken once for the whole batch.
+        
+        Args:
+            added (list): Services to add
+            removed (list): Services to remove
+        
+        Keyword Arguments:
+            provider (String): Name of the provider
+        
+        """
+        
+        # protect self.providers
+        with self.lock:
+            self.provider_remove(removed, provider)
+            self.provider_add(added, provider)
+
+    def provider_add(self, services, provider):
+        """Add services to a provider and to tasks (lock must be held)
+        
+        Args:
+            services (list): Services
+            provider (String): Name of the provider
+        
+        """
+        if self.providers.get(provider) is None:
+            self.providers[provider] = []
+
+        # Look for services already set on a provider (or twice in the batch)
+        new_services = []
+        for service in services:
+            key = service.identity_key()
+            if key not in self.owners:
+                self.owners[key] = provider
+                new_services.append(service)
+
+        if len(new_services) > 0:
+            # Add the services to the provider
+            self.providers[provider].extend(new_services)
+            # Add the services to tasks
+            self.tasks_add(new_services)
+
+    def provider_remove(self, services, provider):
+        """Remove services from a provider and from their tasks (lock must be held)
+        
+        Args:
+            services (list): Services
+            provider (String): Name of the provider
+        
+        """
+        if self.providers.get(provider) is None:
+            return
+
+        removed = set()
+        for service in services:
+            key = service.identity_key()
+            if self.owners.get(key) == provider:
+                del self.owners[key]
+                removed.add(key)
+
+        if len(removed) > 0:
+            # remove the services
+            self.providers[provider] = [service for service in self.providers[provider] if service.identity_key() not in removed]
+            # remove the services from tasks
+            self.tasks_remove(removed)
 
     def remove_provider(self, provider="default"):
         """Remove all services of the provider to the Monitoring
@@ -129,11 +235,9 @@ class ServicesMonitoring:
             if self.providers.get(provider) is None:
                 return
 
-            for service in self.providers[provider]:
-                # remove the service from a task
-                self.task_remove(service)
+            self.provider_remove(self.providers[provider], provider)
 
-            # remove the provider and all services on it
+            # remove the provider
             del self.providers[provider]
 
     def remove_delegation(self, hook, extra, provider="default"):
@@ -153,56 +257,53 @@ class ServicesMonitoring:
             if self.providers.get(provider) is None:
                 return
 
-            # We need to work on a copy [:] to remove services on the real variable
-            # during an iteration on it.
-            for service in self.providers[provider][:]:
-                if hook(service, extra):
-                    # remove the service
-                    self.providers[provider].remove(service)
-                    # remove the service from a task
-                    self.task_remove(service)
+            self.provider_remove([service for service in self.providers[provider] if hook(service, extra)], provider)
 
-    def task_add(self, service):
-        """Add the service to a task
+    def tasks_add(self, services):
+        """Add services to tasks (lock must be held)
         
         Args:
-            service (Service): a Service
+            services (list): Services
         
         """
         
-        # try to add the service on an existing taks if we have enough room
+        # try to add the services on existing tasks if we have enough room
+        start = 0
         for task in self.tasks:
-            if task.add(service):
+            if start == len(services):
                 return
+            start = start + task.add_many(services, start)
 
-        # We don't have enough room and we need to create a new task to handle the service
-        t = TaskMonitoring(self.backend_notify, self.max_services, self.check_every_seconds, self.fast_retry_every_seconds)
-        t.add(service)
-        self.tasks.append(t)
+        # We don't have enough room and we need to create new tasks to handle the services
+        while start < len(services):
+            t = TaskMonitoring(self.backend_notify, self.max_services, self.check_every_seconds, self.fast_retry_every_seconds, self.owns)
+            start = start + t.add_many(services, start)
+            self.tasks.append(t)
 
-        # start the task if the monitoring is already running
-        if self.isRunning:
-            t.start()
+            # start the task if the monitoring is already running
+            if self.isRunning:
+                t.start()
 
-    def task_remove(self, service):
-        """Remove the service from a task
+    def tasks_remove(self, keys):
+        """Remove services from tasks (lock must be held)
         
         Args:
-            service (Service): a Service
+            keys (set): identity keys of the services
             
         """
-        task_ret = None
-
-        # Find and remove the service from a task
-        for task in self.tasks:
-            if task.remove(service):
-                task_ret = task
-                break
+        for task in self.tasks[:]:
+            if task.remove_many(keys) > 0 and task.isEmpty():
+                # the task is empty, we can remove it to freedom unused resources
+                task.stopTask()
+                self.tasks.remove(task)
 
-        # if the task is empty, we can remove it to freedom unused resources
-        if task_ret is not None and task_ret.isEmpty():
-            task_ret.stopTasks()
-            self.tasks.remove(task_ret)
+    def wake(self):
+        """Check the services now (eg: services that became owned by this instance)"""
+        
+        # protect self.tasks
+        with self.lock:
+            for task in self.tasks:
+                task.wake()
 
     def startMonitoring(self):
         """Sarting all tasks"""
@@ -217,7 +318,10 @@ class ServicesMonitoring:
                 print("Monitoring started")
 
     def stopMonitoring(self):
-        """Stopping all tasks"""
+        """Stopping all tasks
+        
+        Checks in progress are finished then transitions that failed to be notified are sent again to the backend.
+        """
         
         # protect self.providers and self.isRunning
         with self.lock:
@@ -228,7 +332,10 @@ class ServicesMonitoring:
                 for task in self.tasks:
                     task.stopTask()
                 for task in self.tasks:
-                    task.join()
+                    if task.is_alive():
+                        task.join()
+                for task in self.tasks:
+                    task.flush()
                 print("Monitoring stopped")
 
 class TaskMonitoring(threading.Thread):
@@ -243,24 +350,34 @@ class TaskMonitoring(threading.Thread):
         max_services (int): Number of services to check per thread
         check_every_seconds (int): Check a service every X seconds
         fast_retry_every_seconds (int): Fast check retry when a service is going down after X seconds
+        owns (function address): Function that tells if a service is checked by this instance (all services if None)
     """
     
     #backend_notify = None
     #max_services = 0
     #check_every_seconds = 300
     #fast_retry_every_seconds = 3
+    #owns = None
     #services = []
     #stop_switch = False
+    #stop_event = threading.Event()
+    #wake_event = threading.Event()
+    #pending = dict()
     #lock = threading.Lock()
 
-    def __init__(self, backend_notify = None, max_services = 10, check_every_seconds = 300, fast_retry_every_seconds = 3):
+    def __init__(self, backend_notify = None, max_services = 10, check_every_seconds = 300, fast_retry_every_seconds = 3, owns = None):
         threading.Thread.__init__(self)
         self.backend_notify = backend_notify
         self.max_services = max_services
         self.check_every_seconds = check_every_seconds
         self.fast_retry_every_seconds = fast_retry_every_seconds
+        self.owns = owns
         self.services = []
         self.stop_switch = False
+        self.stop_event = threading.Event()
+        self.wake_event = threading.Event()
+        # transitions that failed to be notified: id(service) -> (service, status, extra)
+        self.pending = dict()
         self.lock = threading.Lock()
 
     def add(self, service):
@@ -303,6 +420,46 @@ class TaskMonitoring(threading.Thread):
 
         return ret
 
+    def add_many(self, services, start=0):
+        """Add services while there is some room
+        
+        Args:
+            services (list): Services
+        
+        Keyword Arguments:
+            start (int): index of the first service to add
+            
+        Returns:
+            int: Number of services added (from start)
+        """
+
+        # protect self.services
+        with self.lock:
+            count = min(len(services) - start, self.max_services - len(self.services))
+            if count > 0:
+                self.services.extend(services[start:start + count])
+                return count
+
+        return 0
+
+    def remove_many(self, keys):
+        """Remove services
+        
+        Args:
+            keys (set): identity keys of the services (see Service.identity_key)
+            
+        Returns:
+            int: Number of services removed
+        """
+
+        # protect self.services
+        with self.lock:
+            count = len(self.services)
+            self.services = [service for service in self.services if service.identity_key() not in keys]
+            count = count - len(self.services)
+
+        return count
+
     def isEmpty(self):
         """Is empty ?
         
@@ -316,6 +473,23 @@ class TaskMonitoring(threading.Thread):
         """Request the task to stop"""
         print("stopping task ...")
         self.stop_switch = True
+        self.stop_event.set()
+        self.wake_event.set()
+    
+    def wake(self):
+        """Start the next batch now"""
+        self.wake_event.set()
+    
+    def flush(self):
+        """Notify the backend again of transitions that failed to be notified
+        
+        Used when the task is stopped as the next check will not happen.
+        """
+        for key, (service, status, extra) in list(self.pending.items()):
+            if self.backend_notify(service, status, extra):
+                self.pending.pop(key, None)
+            else:
+                print("%s transition lost for %s : %s" % (datetime.today().strftime("[%Y-%m-%d %H:%M:%S]"), str(type(service)), str(service)))
         
     def checkService(self, service):
         """Check a service
@@ -332,11 +506,14 @@ class TaskMonitoring(threading.Thread):
         if ( status == Service.OK and ( previous_status is None or previous_status == Service.FAIL ) ) or \
             ( service.isHardFailure() and ( previous_status is None or previous_status == Service.OK )):
                 # Send to backend
-                if self.backend_notify is not None \
-                        and not self.backend_notify(service, status, extra):
+                if self.backend_notify is not None:
+                    if self.backend_notify(service, status, extra):
+                        self.pending.pop(id(service), None)
+                    else:
                         # Notify failed so we reset status to None to get the chance to update
-                        # the status on the next check for this service
+                        # the status on the next check for this service (or during the stop)
                         service.reset_status()
+                        self.pending[id(service)] = (service, status, extra)
         
         # fast retry ?
         if service.isSoftFailure():
@@ -345,7 +522,9 @@ class TaskMonitoring(threading.Thread):
             # TODO: improve it to have fastretry thread to don't delay checks of all other services in this task.
             #       with a fastretry thread we need to put on hold the check of this service in the task thread and
             #       to re-introduce once the status is enforced to be FAIL or OK
-            time.sleep(self.fast_retry_every_seconds)
+            if self.stop_event.wait(self.fast_retry_every_seconds):
+                # stop requested, the retry will not change the status stored
+                return
             self.checkService(service)
 
     def run(self):
@@ -353,10 +532,9 @@ class TaskMonitoring(threading.Thread):
         
         print("starting task ...")
 
-        self.stop_switch = False
-
         while not self.stop_switch:
             start_batch = time.time()
+            self.wake_event.clear()
 
             # We are using a copy of services [:] to avoid conflict with add and remove function that can be triggered from another
             # thread. So the addition or suppression of service will be take into account only after this running batch and NOT in
@@ -365,6 +543,13 @@ class TaskMonitoring(threading.Thread):
                 # try to stop early if requested
                 if self.stop_switch:
                     break
+                if self.owns is not None and not self.owns(service):
+                    if service.checked:
+                        # moved to another instance
+                        self.pending.pop(id(service), None)
+                        service.release()
+                    continue
+                service.checked = True
                 self.checkService(service)
 
             end_batch = time.time()
@@ -372,7 +557,7 @@ class TaskMonitoring(threading.Thread):
             # Recalculate the time to sleep to provide something near the check_every_seconds for all checks
             
             if end_batch >= start_batch:
-                sleep_time = int(self.check_every_seconds - ( end_batch - start_batch ))
+                sleep_time = self.check_every_seconds - ( end_batch - start_batch )
             else:
                 print("Something goes wrong with the time reported. We will use the check_every_seconds value to be safe")
                 sleep_time = self.check_every_seconds
@@ -380,6 +565,7 @@ class TaskMonitoring(threading.Thread):
             if sleep_time < 0:
                 print("The thread is full and the time to run every checks is longer than the check_every_seconds. Please review the number of check per thread or the check_every_seconds")
             else:
-                DaemonHelper().sleep_with_stop_switch(sleep_time, self)
+                # woken up by a stop or when services become owned (see ServicesMonitoring.wake)
+                self.wake_event.wait(sleep_time)
 
         print("task stopped")
@@ -23,8 +23,11 @@ The remote source can be Kubernetes (for IngressProvider), a file, an unix socke
 
 from kubernetes import client, config, watch
 from .services import IngressService
+from collections import OrderedDict
+from urllib.parse import urlsplit
 import threading
 import time
+import re
 
 class Provider(threading.Thread):
     """Base class for Provider implementation
@@ -35,6 +38,9 @@ class Provider(threading.Thread):
     def stopProvider(self):
     def run(self):
     
+    stopProvider should set stop_event to interrupt waits. Providers are daemon threads as they can be
+    blocked on a remote source: the server only waits them a short time.
+    
     Constructor
     
     Args:
@@ -48,12 +54,15 @@ class Provider(threading.Thread):
     #name = None
     #monitoring
     #category
+    #stop_event = threading.Event()
 
     def __init__(self, name, monitoring, category = None):
         threading.Thread.__init__(self)
+        self.daemon = True
         self.name = name
         self.monitoring = monitoring
         self.category = category
+        self.stop_event = threading.Event()
 
     def services_add(self, services):
         """Add services
@@ -62,8 +71,7 @@ class Provider(threading.Thread):
             services (list): list of Services to add
         
         """
-        for service in services:
-            self.monitoring.add(service, self.name)
+        self.monitoring.add_many(services, self.name)
 
     def services_remove(self, services):
         """Remove services
@@ -72,8 +80,25 @@ class Provider(threading.Thread):
             services (list): list of Services to remove
         
         """
-        for service in services:
-            self.monitoring.remove(service, self.name)
+        self.monitoring.remove_many(services, self.name)
+
+    def services_update(self, added, removed):
+        """Remove and add services in one batch
+        
+        Args:
+            added (list): list of Services to add
+            removed (list): list of Services to remove
+        
+        """
+        self.monitoring.update(added, removed, self.name)
+
+    def services(self):
+        """Services of this provider
+        
+        Returns:
+            list: services
+        """
+        return self.monitoring.services(self.name)
 
     def services_cleanup(self):
         """Remove all services of this provider"""
@@ -106,6 +131,20 @@ class IngressProvider(Provider):
     Permit to collect ingress events/entries to create Services to monitor.
     We are using Kubernetes in this provider.
     
+    The ingresses are listed (by pages of list_limit) then watched from the resourceVersion of the list or of the
+    last event. A watch that ends is resumed from there. If the resourceVersion is too old (410 Gone), the ingresses
+    are listed again and only the difference with the services of the provider is applied, so the services
+    that didn't change keep their state (failure counters, storage cache ...).
+    
+    The services created are indexed per ingress (namespace, name). An event only adds the urls that appeared and removes
+    the urls that disappeared (or with new headers) for its ingress.
+    
+    Events are debounced: the events received during debounce_seconds are merged per ingress (the latest state wins)
+    and applied to the monitoring in one batch.
+    
+    The ingresses can be filtered by Kubernetes (namespaces, label and field selectors) so only the ingresses to monitor
+    are received. With namespaces, there is one watch (thread) per namespace.
+    
     Constructor
     
     Args:
@@ -115,24 +154,54 @@ class IngressProvider(Provider):
     Keyword Arguments:
         category (String): Used during a service creation (eg: ns, infra, client1 ...)
         ingress_config (IngressProviderConfig): A custom config to configure this ingress provider
+        namespaces (list): namespaces to watch (None for all namespaces)
+        label_selector (String): Kubernetes label selector (eg: "uptime=enabled")
+        field_selector (String): Kubernetes field selector (eg: "metadata.namespace!=kube-system")
     
     """
     #k8s = None
-    #w = None
+    #watches = dict()
     #isRunning = False
     #ingress_config = None
+    #namespaces = None
+    #label_selector = None
+    #field_selector = None
+    #resource_versions = dict()
+    #ingresses = dict()
+    #events = dict()
+    #timer = None
+    #lock = threading.Lock()
     restart_timeout = 30
+    restart_min_seconds = 1
     watch_timeout_seconds = 86400
+    list_limit = 500
+    debounce_seconds = 1
 
-    def __init__(self, name, context, monitoring, category = None, ingress_config=None):
+    def __init__(self, name, context, monitoring, category = None, ingress_config=None, namespaces=None, label_selector=None, field_selector=None):
         super().__init__(name, monitoring, category)
         
         self.ingress_config = ingress_config
+        self.namespaces = namespaces
+        self.label_selector = label_selector
+        self.field_selector = field_selector
 
         # Kubernetes API
         self.k8s = client.ExtensionsV1beta1Api(api_client=config.new_client_from_config(context=context))
-        self.w = None
         self.isRunning = False
+        
+        # namespace (None for all namespaces) -> Watch in progress
+        self.watches = dict()
+        
+        # namespace (None for all namespaces) -> resourceVersion to resume the watch
+        self.resource_versions = dict()
+        
+        # (ns, name) -> services created for the ingress
+        self.ingresses = dict()
+        
+        # (ns, name) -> latest event not applied yet
+        self.events = dict()
+        self.timer = None
+        self.lock = threading.Lock()
 
     def ingress_event_to_services(self, event, ns, name, services):
         """Transform an event to an IngressService
@@ -176,66 +245,139 @@ class IngressProvider(Provider):
                 else:
                     services.append(IngressService(ns, name, url, headers=headers))
 
-    def ingress_event_deleted(self, event, ns, name):
-        """Remove Ingress Services from ServicesMonitoring
+    def ingress_diff(self, ns, name, services):
+        """Difference between the services of an ingress and the ones indexed (lock must be held)
+        
+        The index is updated with the services of the ingress.
         
         Args:
-            event (yaml): Kubernetes Ingress event
             ns (String): Namespace
             name (String): Name of the ingress object
+            services (list): services of the ingress (empty if the ingress is deleted)
+        
+        Returns:
+            list, list: services to add, services to remove
         """
-        services = []
-        self.ingress_event_to_services(event, ns, name, services)
-        self.services_remove(services)
+        key = (ns, name)
+        
+        current = {service.url: service for service in self.ingresses.get(key, [])}
+        
+        desired = dict()
+        for service in services:
+            desired.setdefault(service.url, service)
+        
+        removed = [service for url, service in current.items() if url not in desired or desired[url].headers != service.headers]
+        added = [service for url, service in desired.items() if url not in current or current[url].headers != service.headers]
+        
+        if len(removed) == 0 and len(added) == 0:
+            return added, removed
+        
+        kept = [service for url, service in current.items() if url in desired and desired[url].headers == service.headers]
+        if len(kept) + len(added) > 0:
+            self.ingresses[key] = kept + added
+        else:
+            self.ingresses.pop(key, None)
+        
+        return added, removed
     
-    def ingress_event_added(self, event, ns, name):
-        """Add Ingress Services to ServicesMonitoring
+    def ingress_apply(self, ingresses):
+        """Apply the services of ingresses in one batch (lock must be held)
         
         Args:
-            event (yaml): Kubernetes Ingress event
-            ns (String): Namespace
-            name (String): Name of the ingress object
+            ingresses (dict): (ns, name) -> services of the ingress (empty if the ingress is deleted)
+        
+        Returns:
+            int, int: number of services added, number of services removed
+        
+        Raises:
+            Exception: The monitoring was not updated (the index is restored)
         """
-        services = []
-        self.ingress_event_to_services(event, ns, name, services)
-        self.services_add(services)
-    
-    def ingress_event_modified(self, event, ns, name):
-        """Modify Ingress Services in ServicesMonitoring
+        added = []
+        removed = []
+        previous = {key: self.ingresses.get(key) for key in ingresses.keys()}
+        
+        for (ns, name), services in ingresses.items():
+            ingress_added, ingress_removed = self.ingress_diff(ns, name, services)
+            added.extend(ingress_added)
+            removed.extend(ingress_removed)
         
-        In fact this is mainly a remove/re-add mecanism because we don't have the status of the
-        event before it was modified.
+        if len(added) > 0 or len(removed) > 0:
+            try:
+                self.services_update(added, removed)
+            except:
+                # keep the index in line with the monitoring
+                for key, services in previous.items():
+                    if services is None:
+                        self.ingresses.pop(key, None)
+                    else:
+                        self.ingresses[key] = services
+                raise
+        
+        return len(added), len(removed)
+    
+    def ingress_event_services(self, event, ns, name):
+        """Services of an ingress event
         
         Args:
             event (yaml): Kubernetes Ingress event
             ns (String): Namespace
             name (String): Name of the ingress object
-        """
         
-        # extra is used to know what we need to compare/delete and to be thread-safe
-        extra = dict()
-        extra["ns"] = ns
-        extra["name"] = name
-
-        self.services_remove_delegation(self.ingress_event_modified_remove_hook, extra)
-        self.ingress_event_added(event, ns, name)
-
-    def ingress_event_modified_remove_hook(self, service, extra):
-        """Remove a Service based on extra criteria
+        Returns:
+            list: services (empty for a DELETED event)
+        """
+        services = []
+        if event['type'] != "DELETED":
+            self.ingress_event_to_services(event, ns, name, services)
+        return services
+    
+    def ingress_flush(self):
+        """Apply the events received during the debounce window
         
-        This function is called by the ServicesMonitoring as a hook of the remove_delegation
+        An ingress that can't be converted keeps its services (the next event of the ingress retries it).
+        If the monitoring can't be updated, the events are queued again for the next window.
+        """
+        with self.lock:
+            self.timer = None
+            events = self.events
+            self.events = dict()
+            
+            if len(events) == 0:
+                return
+            
+            ingresses = dict()
+            for key, event in events.items():
+                try:
+                    ingresses[key] = self.ingress_event_services(event, key[0], key[1])
+                except Exception as e:
+                    print("%s issue with the ingress %s ns=%s: %s" % (self.name, key[1], key[0], str(e)))
+            
+            try:
+                added, removed = self.ingress_apply(ingresses)
+            except Exception as e:
+                print("%s issue to update the monitoring: %s" % (self.name, str(e)))
+                
+                # newer events received in the meantime win
+                for key, event in events.items():
+                    self.events.setdefault(key, event)
+                self.ingress_flush_later(max(self.debounce_seconds, 1))
+                return
         
-        Args:
-            service (IngressService): a service
-            extra (dict): details about the service
+        print("%s %d ingresses updated: %d services added, %d services removed" % (self.name, len(events), added, removed))
+    
+    def ingress_flush_later(self, delay=None):
+        """Apply the events at the end of the debounce window (lock must be held)
         
-        Returns:
-            bool: Remove the service (True) or Do NOT remove the service (False)
+        Keyword Arguments:
+            delay (float): number of seconds before applying the events (default is debounce_seconds)
         """
-        if type(service) is IngressService and service.ns == extra["ns"] and service.name == extra["name"]:
-            return True
-
-        return False
+        if delay is None:
+            delay = self.debounce_seconds
+        
+        if self.timer is None and not self.stop_event.is_set():
+            self.timer = threading.Timer(delay, self.ingress_flush)
+            self.timer.daemon = True
+            self.timer.start()
     
     def dispatch_ingress_event(self, event):
         """Dispatch new events
@@ -255,45 +397,216 @@ class IngressProvider(Provider):
     
         print("%s Event: %s %s ns=%s" % (self.name, action, name, ns))
     
-        # Dispatch per action
-        if action == "ADDED":
-            self.ingress_event_added(event, ns, name)
-        elif action == "DELETED":
-            self.ingress_event_deleted(event, ns, name)
-        elif action == "MODIFIED":
-            self.ingress_event_modified(event, ns, name)
-    
-    def ingress_events(self):
-        """Ingress events loop"""
-        
-        print("\ningress_event call\n")
-        self.w = watch.Watch()
-        for event in self.w.stream(self.k8s.list_ingress_for_all_namespaces, timeout_seconds=self.watch_timeout_seconds):
-            self.dispatch_ingress_event(event)
-        self.w = None
+        if action not in ("ADDED", "MODIFIED", "DELETED"):
+            return
+        
+        # Keep the latest state of the ingress until the end of the debounce window
+        with self.lock:
+            self.events[(ns, name)] = event
+            
+            if self.debounce_seconds > 0:
+                self.ingress_flush_later()
+        
+        if self.debounce_seconds <= 0:
+            self.ingress_flush()
+    
+    def ingress_request(self, ns):
+        """Kubernetes list function and arguments for a namespace
+        
+        Args:
+            ns (String): Namespace (None for all namespaces)
+        
+        Returns:
+            function, dict: list function, arguments (selectors)
+        """
+        kwargs = dict()
+        if self.label_selector is not None:
+            kwargs["label_selector"] = self.label_selector
+        if self.field_selector is not None:
+            kwargs["field_selector"] = self.field_selector
+        
+        if ns is None:
+            return self.k8s.list_ingress_for_all_namespaces, kwargs
+        
+        kwargs["namespace"] = ns
+        return self.k8s.list_namespaced_ingress, kwargs
+    
+    def ingress_list(self, ns=None):
+        """List all ingresses (with pagination)
+        
+        Keyword Arguments:
+            ns (String): Namespace (None for all namespaces)
+        
+        Returns:
+            list, String: ingresses, resourceVersion of the list
+        
+        Raises:
+            ApiException: Kubernetes API issue (410 if a page expired)
+        """
+        function, kwargs = self.ingress_request(ns)
+        ingresses = []
+        _continue = None
+        
+        while True:
+            if _continue is None:
+                result = function(limit=self.list_limit, **kwargs)
+            else:
+                result = function(limit=self.list_limit, _continue=_continue, **kwargs)
+            
+            ingresses.extend(result.items)
+            
+            _continue = result.metadata._continue
+            if not _continue:
+                return ingresses, result.metadata.resource_version
+    
+    def ingress_relist(self, ns=None):
+        """List all ingresses and apply the difference with the services of the provider
+        
+        An ingress that can't be converted keeps its services.
+        
+        Keyword Arguments:
+            ns (String): Namespace (None for all namespaces)
+        """
+        
+        print("%s relist (ns=%s)" % (self.name, ns))
+        
+        try:
+            ingresses, resource_version = self.ingress_list(ns)
+        except client.rest.ApiException as e:
+            if e.status != 410:
+                raise
+            # a page expired during the list, start again
+            ingresses, resource_version = self.ingress_list(ns)
+        
+        desired = dict()
+        failed = set()
+        for ingress in ingresses:
+            key = (ingress.metadata.namespace, ingress.metadata.name)
+            services = []
+            try:
+                self.ingress_event_to_services({"object": ingress}, key[0], key[1], services)
+            except Exception as e:
+                print("%s issue with the ingress %s ns=%s: %s" % (self.name, key[1], key[0], str(e)))
+                failed.add(key)
+                continue
+            desired.setdefault(key, []).extend(services)
+        
+        with self.lock:
+            # the events not applied yet are older than the list
+            self.events = {key: event for key, event in self.events.items() if ns is not None and key[0] != ns}
+            
+            # an ingress that can't be converted keeps its services (the next event of the ingress retries it)
+            for key in failed:
+                desired[key] = list(self.ingresses.get(key, []))
+            
+            for key in self.ingresses.keys():
+                if key not in desired and (ns is None or key[0] == ns):
+                    desired[key] = []
+            
+            added, removed = self.ingress_apply(desired)
+        
+        print("%s relist (ns=%s): %d ingresses, %d services added, %d services removed" % (self.name, ns, len(ingresses), added, removed))
+        
+        self.resource_versions[ns] = resource_version
+
+    def ingress_events(self, ns=None):
+        """Ingress events loop
+        
+        Resume the watch from the last resourceVersion seen.
+        
+        Keyword Arguments:
+            ns (String): Namespace (None for all namespaces)
+        
+        Raises:
+            ApiException: Kubernetes API issue
+        """
+        
+        print("\ningress_event call (ns=%s, resourceVersion=%s)\n" % (ns, self.resource_versions.get(ns)))
+        function, kwargs = self.ingress_request(ns)
+        
+        w = watch.Watch()
+        self.watches[ns] = w
+        try:
+            for event in w.stream(function, resource_version=self.resource_versions.get(ns), \
+                timeout_seconds=self.watch_timeout_seconds, **kwargs):
+                
+                if event['type'] == 'ERROR':
+                    if event['raw_object'].get('code') == 410:
+                        # resourceVersion too old
+                        print("%s resourceVersion %s expired (ns=%s)" % (self.name, self.resource_versions.get(ns), ns))
+                        self.resource_versions[ns] = None
+                        break
+                    raise client.rest.ApiException(status=event['raw_object'].get('code'), reason=event['raw_object'].get('message'))
+                
+                self.dispatch_ingress_event(event)
+                self.resource_versions[ns] = event['object'].metadata.resource_version
+        finally:
+            self.watches.pop(ns, None)
 
     def stopProvider(self):
         """Stop a provider"""
         print(str(self) + " stopping")
-        if self.w is not None:
-            self.w.stop()
-        self.w = None
         self.isRunning = False
+        self.stop_event.set()
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        for w in list(self.watches.values()):
+            w.stop()
+
+    def watch_loop(self, ns=None):
+        """List and watch the ingresses of a namespace until the provider is stopped
+        
+        Keyword Arguments:
+            ns (String): Namespace (None for all namespaces)
+        """
+        while self.isRunning:
+            start_watch = time.monotonic()
+            try:
+                if self.resource_versions.get(ns) is None:
+                    # Sync Ingress Services with the ingresses
+                    self.ingress_relist(ns)
+
+                # Parse ingress events
+                self.ingress_events(ns)
+                
+                # the watch ended normally (timeout), resume it
+                # (not in a loop if the API closes the stream right away)
+                self.stop_event.wait(self.restart_min_seconds - (time.monotonic() - start_watch))
+                continue
+            except client.rest.ApiException as e:
+                print("%s Kubernetes API issue (ns=%s): %s" % (self.name, ns, str(e)))
+                if e.status == 410:
+                    self.resource_versions[ns] = None
+            except Exception as e:
+                print("%s issue (ns=%s): %s" % (self.name, ns, str(e)))
+            
+            # Avoid storm in case of a k8s issue
+            self.stop_event.wait(self.restart_timeout)
 
     def run(self):
         """Start a provider"""
         print(str(self) + " started")
-        self.isRunning = True
+        self.isRunning = not self.stop_event.is_set()
 
-        while self.isRunning:
-            # Clean up Ingress Services
-            self.services_cleanup()
-
-            # Parse ingress events
-            self.ingress_events()
+        if self.namespaces is None:
+            self.watch_loop()
+        else:
+            # one watch per namespace
+            threads = []
+            for ns in self.namespaces:
+                t = threading.Thread(target=self.watch_loop, args=(ns,))
+                t.daemon = True
+                t.start()
+                threads.append(t)
             
-            # Avoid storm in case of a k8s issue
-            time.sleep(self.restart_timeout)
+            self.stop_event.wait()
+            
+            # one deadline for all the watches
+            deadline = time.monotonic() + 1
+            for t in threads:
+                t.join(max(0, deadline - time.monotonic()))
 
         print(str(self) + " stopped")
 
@@ -326,3 +639,171 @@ class IngressProviderConfig:
         """
         return {}
     
+
+class RulesIngressProviderConfig(IngressProviderConfig):
+    """Ingress Provider Config based on rules
+    
+    A rule matches an url with any combination of:
+    
+    - host_suffix (String): the host is the suffix or a sub domain of it (eg: ypcloud.io)
+    - path_prefix (String): the path starts with the prefix (eg: /api/)
+    - regex (String): the regex matches the url (re.match)
+    
+    and decides to exclude the url or not (exclude) and/or sets its headers (headers).
+    For each decision, the first rule that matches the url (in order) and that provides the decision wins.
+    
+    Rules are compiled: host suffixes on a trie of labels so only the rules of the host (and the rules without
+    host_suffix) are evaluated. Decisions are cached per url (LRU).
+    
+    eg:
+    
+    RulesIngressProviderConfig([
+        {"host_suffix": "aws.ypcloud.io", "exclude": True},
+        {"host_suffix": "ypapi.ypcloud.io", "headers": {"apikey": "secret"}},
+        {"regex": ".*ypcloud.io.*", "exclude": False}
+    ], default_exclude=True)
+    
+    Constructor
+    
+    Args:
+        rules (list): rules (dict)
+    
+    Keyword Arguments:
+        default_exclude (bool): decision if no rule matches
+        default_headers (dict): headers if no rule matches
+        max_entries (int): maximum number of decisions cached
+    
+    Raises:
+        Exception: Invalid rule
+    """
+    
+    #rules = []
+    #trie = dict()
+    #others = []
+    #decisions = OrderedDict()
+    #lock = threading.Lock()
+    max_entries = 10000
+    
+    def __init__(self, rules, default_exclude=False, default_headers=None, max_entries=None):
+        if max_entries is not None:
+            self.max_entries = max_entries
+        self.default_exclude = default_exclude
+        self.default_headers = default_headers if default_headers is not None else {}
+        
+        self.rules = []
+        
+        # reversed labels of the host suffix -> rules (a "" key holds the rules of the node)
+        self.trie = dict()
+        
+        # rules without host suffix
+        self.others = []
+        
+        for index, rule in enumerate(rules):
+            if rule.get("host_suffix") is None and rule.get("path_prefix") is None and rule.get("regex") is None:
+                raise Exception("rule %d needs a host_suffix, a path_prefix or a regex" % (index))
+            if "exclude" not in rule and "headers" not in rule:
+                raise Exception("rule %d needs exclude or headers" % (index))
+            
+            compiled = {
+                "index": index,
+                "path_prefix": rule.get("path_prefix"),
+                "regex": re.compile(rule["regex"]) if rule.get("regex") is not None else None,
+                "exclude": rule.get("exclude"),
+                "headers": rule.get("headers")
+            }
+            self.rules.append(compiled)
+            
+            if rule.get("host_suffix") is not None:
+                node = self.trie
+                for label in reversed(rule["host_suffix"].lower().strip(".").split(".")):
+                    node = node.setdefault(label, dict())
+                node.setdefault("", []).append(compiled)
+            else:
+                self.others.append(compiled)
+        
+        # url -> (exclude, headers)
+        self.decisions = OrderedDict()
+        self.lock = threading.Lock()
+    
+    def candidates(self, host):
+        """Rules that can match a host
+        
+        Args:
+            host (String): a host
+        
+        Returns:
+            list: compiled rules (in order)
+        """
+        rules = list(self.others)
+        
+        node = self.trie
+        for label in reversed(host.split(".")):
+            node = node.get(label)
+            if node is None:
+                break
+            rules.extend(node.get("", []))
+        
+        rules.sort(key=lambda rule: rule["index"])
+        return rules
+    
+    def evaluate(self, url):
+        """Evaluate the rules for an url
+        
+        Args:
+            url (String): an url
+        
+        Returns:
+            bool, dict: exclude, headers
+        """
+        parsed = urlsplit(url)
+        host = (parsed.hostname or "").lower()
+        path = parsed.path or "/"
+        
+        exclude = None
+        headers = None
+        for rule in self.candidates(host):
+            if rule["path_prefix"] is not None and not path.startswith(rule["path_prefix"]):
+                continue
+            if rule["regex"] is not None and rule["regex"].match(url) is None:
+                continue
+            
+            if exclude is None and rule["exclude"] is not None:
+                exclude = rule["exclude"]
+            if headers is None and rule["headers"] is not None:
+                headers = rule["headers"]
+            if exclude is not None and headers is not None:
+                break
+        
+        return (exclude if exclude is not None else self.default_exclude, headers if headers is not None else self.default_headers)
+    
+    def decision(self, url):
+        """Decision for an url (cached)
+        
+        Args:
+            url (String): an url
+        
+        Returns:
+            bool, dict: exclude, headers
+        """
+        with self.lock:
+            decision = self.decisions.get(url)
+            if decision is not None:
+                self.decisions.move_to_end(url)
+                return decision
+        
+        decision = self.evaluate(url)
+        
+        with self.lock:
+            self.decisions[url] = decision
+            while len(self.decisions) > self.max_entries:
+                self.decisions.popitem(last=False)
+        
+        return decision
+    
+    def exclude(self, url):
+        """ see IngressProviderConfig class """
+        return self.decision(url)[0]
+    
+    def headers(self, url):
+        """ see IngressProviderConfig class """
+        return dict(self.decision(url)[1])
@@ -0,0 +1,334 @@
+# Copyright (c) 2018 Yellow Pages Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Scheduler module
+
+Permit to run background jobs (consolidations, housekeeping ...) from one thread and a shared pool of workers
+"""
+
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+class Job:
+    """A job run by the Scheduler
+
+    Missed runs (the job was still running, or the scheduler was late) are managed with a policy:
+
+    - MISSED_SKIP: missed runs are dropped, the job runs on the next slot
+    - MISSED_RUN_ONCE: missed runs are run once, as soon as possible
+    - MISSED_RUN_ALL: missed runs are all run, back-to-back
+
+    Constructor
+
+    Args:
+        name (String): unique name of the job
+        function (function): function to run. If it returns a number, the next run is in that many seconds.
+
+    Keyword Arguments:
+        interval (int): number of seconds between 2 runs (None for a one-shot job)
+        max_concurrency (int): maximum number of runs at the same time
+        missed (String): policy for missed runs
+
+    """
+
+    MISSED_SKIP = "skip"
+    MISSED_RUN_ONCE = "run_once"
+    MISSED_RUN_ALL = "run_all"
+
+    #name
+    #function
+    #interval
+    #max_concurrency
+    #missed
+    #due = None (monotonic time of the next run)
+    #running = 0
+    #pending = 0
+    #last_run = None (epoch timestamp)
+    #last_error = None
+
+    def __init__(self, name, function, interval=None, max_concurrency=1, missed=MISSED_RUN_ONCE):
+        if missed not in (Job.MISSED_SKIP, Job.MISSED_RUN_ONCE, Job.MISSED_RUN_ALL):
+            raise Exception("missed policy %s is not supported" % (missed))
+
+        self.name = name
+        self.function = function
+        self.interval = interval
+        self.max_concurrency = max_concurrency
+        self.missed = missed
+
+        self.due = None
+        self.running = 0
+        self.pending = 0
+        self.last_run = None
+        self.last_error = None
+
+    def __str__(self):
+        return self.name
+
+class Scheduler(threading.Thread):
+    """Run jobs on a shared pool of workers
+
+    Jobs are kept on a min-heap ordered by monotonic time so changes of the system clock don't affect them.
+    The scheduler thread sleeps until the next job is due.
+
+    Constructor
+
+    Keyword Arguments:
+        workers (int): number of threads to run jobs
+
+    """
+
+    #jobs = dict()
+    #heap = []
+    #condition = threading.Condition()
+    #executor = ThreadPoolExecutor()
+    #stop_switch = False
+    workers = 4
+
+    def __init__(self, workers=None):
+        threading.Thread.__init__(self)
+
+        if workers is not None:
+            self.workers = workers
+
+        self.jobs = dict()
+        self.heap = []
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        self.stop_switch = False
+
+    # Jobs
+
+    def add(self, name, function, interval=None, delay=0, max_concurrency=1, missed=Job.MISSED_RUN_ONCE):
+        """Add a job (or replace the job with the same name)
+
+        Args:
+            name (String): unique name of the job
+            function (function): function to run (see Job)
+
+        Keyword Arguments:
+            interval (int): number of seconds between 2 runs (None for a one-shot job)
+            delay (int): number of seconds before the first run
+            max_concurrency (int): maximum number of runs at the same time
+            missed (String): policy for missed runs (see Job)
+
+        Returns:
+            Job: the job
+        """
+        job = Job(name, function, interval, max_concurrency, missed)
+
+        with self.condition:
+            self.jobs[name] = job
+            self.push(job, time.monotonic() + delay)
+
+        return job
+
+    def add_at(self, name, function, date, max_concurrency=1):
+        """Add a one-shot job (or replace the job with the same name)
+
+        Args:
+            name (String): unique name of the job
+            function (function): function to run
+            date (int): epoch timestamp of the run
+
+        Keyword Arguments:
+            max_concurrency (int): maximum number of runs at the same time
+
+        Returns:
+            Job: the job
+        """
+        return self.add(name, function, delay=max(0, date - time.time()), max_concurrency=max_concurrency)
+
+    def reschedule(self, name, date):
+        """Move the next run of a job
+        
+        Args:
+            name (String): name of the job
+            date (float): epoch timestamp of the next run
+        
+        Returns:
+            bool: Moved (True) or Not scheduled (False)
+        """
+        with self.condition:
+            job = self.jobs.get(name)
+            if job is None or job.due is None:
+                return False
+            
+            self.push(job, time.monotonic() + max(0, date - time.time()))
+            return True
+
+    def remove(self, name):
+        """Remove a job (a run in progress is not interrupted)
+
+        Args:
+            name (String): name of the job
+        """
+        with self.condition:
+            self.jobs.pop(name, None)
+
+    def next_run(self, name):
+        """When the job will run
+
+        Args:
+            name (String): name of the job
+
+        Returns:
+            float: epoch timestamp or Not scheduled (None)
+        """
+        with self.condition:
+            job = self.jobs.get(name)
+            if job is None or job.due is None:
+                return None
+
+            return time.time() + (job.due - time.monotonic())
+
+    def next_runs(self):
+        """When all jobs will run
+
+        Returns:
+            dict: name -> epoch timestamp (None if not scheduled)
+        """
+        with self.condition:
+            return {name: self.next_run(name) for name in self.jobs.keys()}
+
+    # Internal
+
+    def push(self, job, due):
+        """Schedule the next run of a job (condition must be held)
+
+        Args:
+            job (Job): the job
+            due (float): monotonic time
+        """
+        job.due = due
+        heapq.heappush(self.heap, (due, next(self.counter), job))
+        self.condition.notify()
+
+    def submit(self, job):
+        """Run a job on the workers (condition must be held)
+
+        Args:
+            job (Job): the job
+        """
+        job.running += 1
+        job.last_run = time.time()
+
+        future = self.executor.submit(job.function)
+        future.add_done_callback(lambda future: self.finished(job, future))
+
+    def dispatch(self, job, now):
+        """A job is due (condition must be held)
+
+        Args:
+            job (Job): the job
+            now (float): monotonic time
+        """
+        due = job.due
+        job.due = None
+
+        if job.interval is not None:
+            # next slot (before the run as the run can ask for another one)
+            next_due = due + job.interval
+            if next_due <= now:
+                # the scheduler is late
+                if job.missed == Job.MISSED_SKIP:
+                    next_due = next_due + ((now - next_due) // job.interval + 1) * job.interval
+                elif job.missed == Job.MISSED_RUN_ONCE:
+                    next_due = now
+
+            self.push(job, next_due)
+
+        if job.running < job.max_concurrency:
+            self.submit(job)
+        elif job.missed == Job.MISSED_RUN_ALL:
+            job.pending += 1
+        elif job.missed == Job.MISSED_RUN_ONCE:
+            job.pending = 1
+
+    def finished(self, job, future):
+        """A run of a job is done
+
+        Args:
+            job (Job): the job
+            future (Future): the run
+        """
+        with self.condition:
+            job.running -= 1
+
+            result = None
+            try:
+                result = future.result()
+                job.last_error = None
+            except Exception as e:
+                job.last_error = e
+                print("scheduler: job %s [FAILED: %s]" % (job.name, str(e)))
+
+            if self.jobs.get(job.name) is not job:
+                # removed or replaced
+                return
+
+            if job.pending > 0 and not self.stop_switch:
+                job.pending -= 1
+                self.submit(job)
+                return
+
+            if isinstance(result, (int, float)) and not isinstance(result, bool):
+                # the job asked for its next run
+                self.push(job, time.monotonic() + max(0, result))
+            elif job.interval is None and job.due is None and job.running == 0:
+                # one-shot job done
+                del self.jobs[job.name]
+
+    def run(self):
+        """Run jobs when they are due"""
+
+        print("starting scheduler ...")
+
+        with self.condition:
+            while not self.stop_switch:
+                now = time.monotonic()
+
+                while len(self.heap) > 0 and self.heap[0][0] <= now:
+                    due, counter, job = heapq.heappop(self.heap)
+
+                    if self.jobs.get(job.name) is not job or job.due != due:
+                        # removed, replaced or rescheduled
+                        continue
+
+                    self.dispatch(job, now)
+
+                timeout = None
+                if len(self.heap) > 0:
+                    timeout = self.heap[0][0] - time.monotonic()
+
+                if timeout is None or timeout > 0:
+                    self.condition.wait(timeout)
+
+        # wait the runs in progress
+        self.executor.shutdown(wait=True)
+
+        print("scheduler stopped")
+
+    def stopScheduler(self):
+        """Stop the scheduler (runs in progress are completed)"""
+        print("stopping scheduler ...")
+
+        with self.condition:
+            self.stop_switch = True
+            self.condition.notify()
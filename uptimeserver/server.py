@@ -19,13 +19,14 @@ Configuring Services and Providers
 Start/Stop Monitoring
 """
 
-from .storage import MongoStorage
-from .consolidation import MongoStorageConsolidationSLA, MongoStorageConsolidationStatus
+from .storage import MongoStorage, MemoryStorage
+from .consolidation import MongoStorageConsolidationSLA, MongoStorageConsolidationStatus, MongoStorageConsolidationRetention
+from .consolidation import MemoryStorageConsolidationSLA, MemoryStorageConsolidationStatus
 from .config import Config
 from .monitoring import ServicesMonitoring
+from .scheduler import Scheduler
 import signal
 import sys
-import os
 
 class Server:
     """Server is responsible to manage monitoring, providers and storage backend.
@@ -34,6 +35,7 @@ class Server:
     - 1 Storage (storage backend)
     - X providers (components to add/remove/modify services on the fly)
     - X consolidations (components to consolidate some data based on uptime checks)
+    - 1 Scheduler (consolidation jobs on a shared pool of workers)
     - 1 ServicesMonitoring (monitoring management)
     
     A server will start/stop the Monitoring, Providers and Consolidations
@@ -52,12 +54,15 @@ class Server:
     #isRunning = False
     #providers = []
     #consolidations = []
+    #scheduler = None
+    provider_stop_timeout = 1
 
     def __init__(self, config, donotconfig=False):
         self.storage = None
         self.isRunning = False
         self.providers = []
         self.consolidations = []
+        self.scheduler = Scheduler(config.getserver("scheduler_workers"))
         
         # mainly to configure the backend
         self.configure(config)
@@ -94,11 +99,14 @@ class Server:
         
         """
         
-        # We only support MongoStorage for now
         if config.getstorage("backend") == "MongoStorage":
             self.configure_mongostorage(config, config.getserver("with_consolidation"))
             return
         
+        if config.getstorage("backend") == "MemoryStorage":
+            self.configure_memorystorage(config, config.getserver("with_consolidation"))
+            return
+        
         raise Exception("No configuration done !")
 
     def configure_mongostorage(self, config, with_consolidation=False):
@@ -118,15 +126,64 @@ class Server:
         if self.storage is not None:
             raise Exception("Storage is already defined !")
 
-        self.storage = MongoStorage(config.getstorage("uri"), config.getstorage("db"))
+        self.storage = MongoStorage(config.getstorage("uri"), config.getstorage("db"), \
+            history_partitioning=config.getstorage("history_partitioning"), \
+            extra_policy=config.getstorage("extra_policy"), \
+            pools=config.getstorage("pools"), \
+            sla_cache=config.getstorage("sla_cache"))
         if not self.storage.isReady():
             self.exit(1, "Storage is not ready !")
         
+        try:
+            self.storage.migrate()
+        except:
+            self.exit(1, "Storage migration failed !")
+        
         if with_consolidation:
-            self.consolidations.append(MongoStorageConsolidationSLA(self.storage))
+            sla = config.getconsolidations().get("sla", {})
+            self.consolidations.append(MongoStorageConsolidationSLA(self.storage, \
+                batch_size=sla.get("batch_size"), \
+                workers=sla.get("workers"), \
+                chunk_size=sla.get("chunk_size")))
             self.consolidations.append(MongoStorageConsolidationStatus(self.storage, \
                 config.getconsolidations()["status"]["filter"], \
-                config.getconsolidations()["status"]["down_since"]))
+                config.getconsolidations()["status"]["down_since"], \
+                config.getconsolidations()["status"].get("resync_seconds", 900)))
+            
+            retention = config.getconsolidations().get("retention")
+            if retention is not None:
+                self.consolidations.append(MongoStorageConsolidationRetention(self.storage, \
+                    retention["keep_months"], \
+                    retention.get("archive_path")))
+
+    def configure_memorystorage(self, config, with_consolidation=False):
+        """Set the storage backend with MemoryStorage
+        
+        Nothing is persisted. This is designed for dry runs and benchmarks of the monitoring.
+        
+        Args:
+            config (Config): Configuration
+        
+        Keyword Arguments:
+            with_consolidation (bool): Use default consolidation associated to MemoryStorage or not.
+            
+        Raises:
+            Exception: Storage is already defined.
+        
+        """
+        
+        if self.storage is not None:
+            raise Exception("Storage is already defined !")
+        
+        self.storage = MemoryStorage(config.getstorage("latency"), config.getstorage("failure_rate"), \
+            sla_cache=config.getstorage("sla_cache"))
+        
+        if with_consolidation:
+            self.consolidations.append(MemoryStorageConsolidationSLA(self.storage))
+            self.consolidations.append(MemoryStorageConsolidationStatus(self.storage, \
+                config.getconsolidations()["status"]["filter"], \
+                config.getconsolidations()["status"]["down_since"], \
+                config.getconsolidations()["status"].get("resync_seconds", 900)))
 
     def storage_get_notify(self):
         """Get the storage notify function
@@ -164,12 +221,11 @@ class Server:
         """
         return self.isRunning
 
-    def terminate_signal(self, signal, frame):
-        """terminate the program on a specific signal"""
+    def terminate_signal(self, signum, frame):
+        """terminate the program on a specific signal (SIGINT, SIGTERM)"""
         print("")
         self.stopMonitoring()
-        #self.exit(0, "Bye !")
-        os.kill(os.getpid(), 9)
+        self.exit(0, "Bye !")
 
     def startMonitoring(self, nosignalhandling=False):
         """Start the monitoring and all relative components (providers, consolidations ...)
@@ -182,29 +238,46 @@ class Server:
             for provider in self.providers:
                 provider.start()
             for consolidation in self.consolidations:
-                consolidation.start()
+                consolidation.schedule(self.scheduler)
+            self.scheduler.start()
             self.monitoring.startMonitoring()
             self.isRunning = True
         
         if not nosignalhandling:
             signal.signal(signal.SIGINT, self.terminate_signal)
+            signal.signal(signal.SIGTERM, self.terminate_signal)
             print('Press Ctrl+C to exit')
             signal.pause()
 
     def stopMonitoring(self):
         """Stop the monitoring
         
-        This action can be long depending what is going on (eg: consolidation in progress). We don't force a shutdown to
-        try to have a clean shutdown on all components.
+        Components are drained in order:
+        - providers (no more services added or removed)
+        - monitoring (checks in progress are finished and transitions not stored yet are sent again to the storage)
+        - consolidations and scheduler (jobs in progress are interrupted as soon as possible)
         
         """
+        if not self.isRunning:
+            return
+        
         print("Stopping ...")
         if self.monitoring is not None:
             for provider in self.providers:
                 provider.stopProvider()
+            for provider in self.providers:
+                # a provider can be blocked on its remote source (daemon thread)
+                if provider.is_alive():
+                    provider.join(self.provider_stop_timeout)
+            
+            self.monitoring.stopMonitoring()
+            
             for consolidation in self.consolidations:
                 consolidation.stopConsolidation()
-            self.monitoring.stopMonitoring()
+            self.scheduler.stopScheduler()
+            if self.scheduler.is_alive():
+                self.scheduler.join()
             for consolidation in self.consolidations:
-                consolidation.join()
+                if consolidation.is_alive():
+                    consolidation.join()
             self.isRunning = False
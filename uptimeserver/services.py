@@ -18,6 +18,10 @@ Services module
 Class that permit to create a Service check.
 """
 
+# Service
+import hashlib
+import json
+
 # KubernetesService
 from kubernetes import client, config
 
@@ -38,10 +42,14 @@ class Service:
     
     def __str__(self)
     def __eq__(self, other)
+    def __hash__(self)
     def checkMe(self)
     
     checkMe() is the main function that will permit to check the status of the service.
     
+    identity_key() identifies the service between instances (see PartitionedInstance) and in the monitoring. It needs to cover
+    every field compared by __eq__: a derived Service needs to override it if __str__ doesn't show all of them.
+    
     A storage can add some specific information on the service object with the storage_* functions
     
     Constructor
@@ -60,6 +68,7 @@ class Service:
     #category = None
     #failure_counter = 0
     #attempt_before_status_fail
+    #checked = False (checked by this instance)
     OK = 0
     FAIL = 1
 
@@ -71,6 +80,7 @@ class Service:
         self.category = category
         self.failure_counter = 0
         self.attempt_before_status_fail = attempt_before_status_fail
+        self.checked = False
 
     def storage_add(self, key, value):
         """add a value to storage
@@ -170,6 +180,41 @@ class Service:
     def reset_status(self):
         """Reset the status to an undefined one"""
         self.status = None
+    
+    def identity_key(self):
+        """Key of the service shared by all instances
+        
+        Two services have the same key only if they are equal (__eq__).
+        
+        Returns:
+            String: The key
+        """
+        return type(self).__name__ + ":" + str(self)
+    
+    def identity_digest(self, *values):
+        """Digest of fields to add on identity_key
+        
+        The key is written on the storage (see OneInstanceLock.handoff_state) so fields that can contain
+        secrets (uri, auth ...) are only added as a digest.
+        
+        Args:
+            values (object): JSON serializable values
+        
+        Returns:
+            String: The digest
+        """
+        return hashlib.sha1(json.dumps(values, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+    
+    def release(self):
+        """The service is checked by another instance
+        
+        Forget the status and what the storage tracked so they are loaded again if the service comes back.
+        """
+        self.status = None
+        self.previous_status = None
+        self.failure_counter = 0
+        self.storage = dict()
+        self.checked = False
 
 class IngressService(Service):
     """Kubernetes Ingress Service
@@ -210,6 +255,9 @@ class IngressService(Service):
     def __eq__(self, other):
         return type(other) is IngressService and self.ns == other.ns and self.name == other.name and self.url == other.url
 
+    def __hash__(self):
+        return hash((IngressService, self.ns, self.name, self.url))
+
     def checkMe(self):
         ret = Service.FAIL
         extra = None
@@ -258,6 +306,13 @@ class MongoService(Service):
     def __eq__(self, other):
         return type(other) is MongoService and self.name == other.name and self.uri == other.uri
 
+    def __hash__(self):
+        return hash((MongoService, self.name, self.uri))
+
+    def identity_key(self):
+        # the uri is not on __str__ (credentials)
+        return super().identity_key() + ", uri=" + self.identity_digest(self.uri)
+
     def checkMe(self):
         ret = Service.FAIL
         extra = None
@@ -304,6 +359,12 @@ class KubernetesService(Service):
     def __eq__(self, other):
         return type(other) is KubernetesService and self.name == other.name and self.context == other.context and self.availability == other.availability
     
+    def __hash__(self):
+        return hash((KubernetesService, self.name, self.context, self.availability))
+    
+    def identity_key(self):
+        return super().identity_key() + ", availability=" + str(self.availability)
+    
     def checkMe(self):
         ret = Service.FAIL
         extra = None
@@ -380,7 +441,15 @@ class ElasticsearchService(Service):
         return "name=" + self.name
     
     def __eq__(self, other):
-        return type(other) is ElasticsearchService and self.name == other.name and self.host == other.host and self.auth == other.auth and self.port == other.port and self.ssl == other.ssl
+        return type(other) is ElasticsearchService and self.name == other.name and self.hosts == other.hosts and self.auth == other.auth and self.port == other.port and self.ssl == other.ssl
+    
+    def __hash__(self):
+        # hosts and auth can be a list or a dict
+        return hash((ElasticsearchService, self.name, self.port, self.ssl))
+    
+    def identity_key(self):
+        # hosts and auth are not on __str__ (credentials)
+        return super().identity_key() + ", connection=" + self.identity_digest(self.hosts, self.auth, self.port, self.ssl)
     
     def checkMe(self):
         ret = Service.FAIL
@@ -19,10 +19,19 @@ Store the content of all services.
 """
 
 import pymongo
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from dateutil.relativedelta import *
 import time
+import random
+import gzip
+import os
+import bson
+import heapq
+import itertools
+import hashlib
+import zlib
 from .services import *
+from .cache import SLACache
 from bson.objectid import ObjectId
 
 class Storage:
@@ -41,11 +50,75 @@ class Storage:
     
     def isReady(self)
     def svc_all(self, service, status)  -- or any svc_* for specific management per Service type (MongoService, IngressService, ...)
+    def stats_iter_all_svc(self, query={}, projection=None, batch_size=None, sort=None, limit=0)
+    def stats_iter_svc_downtimes(self, service, start_date, duration, projection=None, batch_size=None, sort=None, limit=0)
+    
+    The stats_iter_* default implementations apply the projection, sort and limit on the python side.
+    
+    A SLACache can be set on sla_cache to memoize SLA of closed periods. In that case, the backend needs to call
+    sla_cache_invalidate for every downtime written and to set storage_id_svc.
+    
+    Components can follow downtimes opened and closed with transition_listener_add. The backend needs to call
+    transition_notify for every downtime written.
     
     """
+    
+    # Fields needed to compute a SLA from a downtime
+    stats_downtime_fields = {"_id": 1, "_id_uptime": 1, "down_start_date": 1, "down_end_date": 1}
+    
+    # Key used by the backend to cache the _id of the service on the Service object
+    storage_id_svc = None
+    
+    # Cache of SLA for closed periods (SLACache)
+    sla_cache = None
+    
+    #transition_listeners = []
 
     def __init__(self):
-        pass
+        self.transition_listeners = []
+    
+    # TRANSITIONS
+    
+    def transition_listener_add(self, listener):
+        """Follow downtimes opened and closed
+        
+        The listener is called by the thread that wrote the downtime so it should be quick.
+        
+        Args:
+            listener (function): function(id_svc, down_start_date, down_end_date) with down_end_date set to 0 for an open downtime
+        """
+        # a backend can skip Storage.__init__
+        if getattr(self, "transition_listeners", None) is None:
+            self.transition_listeners = []
+        
+        self.transition_listeners.append(listener)
+    
+    def transition_listener_remove(self, listener):
+        """Stop to follow downtimes
+        
+        Args:
+            listener (function): function added with transition_listener_add
+        """
+        try:
+            getattr(self, "transition_listeners", []).remove(listener)
+        except ValueError:
+            pass
+    
+    def transition_notify(self, id_svc, down_start_date, down_end_date=0):
+        """Notify listeners about a downtime written
+        
+        Args:
+            id_svc (object): _id of the service
+            down_start_date (int): epoch timestamp of the begining of the downtime
+        
+        Keyword Arguments:
+            down_end_date (int): epoch timestamp of the end of the downtime (0 for an open downtime)
+        """
+        for listener in list(getattr(self, "transition_listeners", [])):
+            try:
+                listener(id_svc, down_start_date, down_end_date)
+            except:
+                print("storage: transition listener failed")
 
     # STORE
 
@@ -158,6 +231,17 @@ class Storage:
         """
         return True
     
+    def preload(self, service):
+        """Load what the storage tracks about a service before its first check
+
+        Used by a standby instance to be ready to take over.
+
+        Args:
+            service (Service): a Service
+
+        """
+        pass
+    
     # STATS: Date Manipulation
     
     def stats_day_duration(self):
@@ -217,7 +301,7 @@ class Storage:
             new_date = date + relativedelta(years=1)
             return (new_date - date).total_seconds()
         else:
-            new_date = date + relativedelta(months=-1)
+            new_date = date + relativedelta(years=-1)
             return (date - new_date).total_seconds()
         
     def stats_first_date_of_week_number(self, year, num):
@@ -394,7 +478,7 @@ class Storage:
         
     def stats_get_all_status(self):
         """Display a status list of ALL services"""
-        for svc in self.stats_get_all_svc():
+        for svc in self.stats_iter_all_svc():
             print(svc)
 
     def stats_get_all_status_for_ns(self, ns):
@@ -404,7 +488,7 @@ class Storage:
             ns (String): Namespace filter
         
         """
-        for svc in self.stats_get_all_svc({"ns" : ns}):
+        for svc in self.stats_iter_all_svc({"ns" : ns}):
             print(svc)
     
     def stats_get_svc_status(self, service):
@@ -429,7 +513,83 @@ class Storage:
             Number: An SLA number between 0 and 100. (%)
         
         """
-        downtimes = self.stats_get_all_downtimes_svc(service, start_date, duration)
+        
+        # A closed period can be cached
+        id_svc = None
+        if self.sla_cache is not None and start_date + duration <= time.time():
+            id_svc = self.stats_svc_id(service)
+        
+        if id_svc is None:
+            return self.stats_compute_svc_sla(service, start_date, duration)
+        
+        sla = self.sla_cache.get(id_svc, start_date, duration)
+        if sla is None:
+            version = self.sla_cache.version(id_svc)
+            sla = self.stats_compute_svc_sla(service, start_date, duration)
+            self.sla_cache.set(id_svc, start_date, duration, sla, version)
+        
+        return sla
+    
+    def stats_svc_id(self, service):
+        """Identifier of a service for the SLA cache
+        
+        Args:
+            service (object): anything supported by the backend on the function self.stats_get_all_downtimes_svc
+        
+        Returns:
+            object: _id of the service or Unknown (None)
+        """
+        if type(service) is dict:
+            return service.get("_id")
+        elif isinstance(service, Service):
+            if self.storage_id_svc is None:
+                return None
+            return service.storage_get(self.storage_id_svc)
+        
+        return service
+    
+    def sla_cache_invalidate(self, id_svc, start_date, end_date=None):
+        """Invalidate the SLA cache for a downtime written or repaired
+        
+        Args:
+            id_svc (object): _id of the service
+            start_date (int): epoch timestamp of the begining of the downtime
+        
+        Keyword Arguments:
+            end_date (int): epoch timestamp of the end of the downtime (None for an open downtime)
+        """
+        if self.sla_cache is not None:
+            self.sla_cache.invalidate(id_svc, start_date, end_date)
+    
+    def stats_compute_svc_sla(self, service, start_date, duration):
+        """Compute SLA for a service during a defined period without cache
+        
+        Args:
+            service (object): anything supported by the backend on the function self.stats_get_all_downtimes_svc
+            start_date (int): epoch timestamp
+            duration (int): number of seconds to analyze since start_date
+
+        Returns:
+            Number: An SLA number between 0 and 100. (%)
+        
+        """
+        down = self.stats_get_svc_down_seconds(service, start_date, duration)
+
+        return 100 - ( down * 100 / duration )
+    
+    def stats_get_svc_down_seconds(self, service, start_date, duration):
+        """Number of seconds a service was down during a defined period
+        
+        Args:
+            service (object): anything supported by the backend on the function self.stats_get_all_downtimes_svc
+            start_date (int): epoch timestamp
+            duration (int): number of seconds to analyze since start_date
+
+        Returns:
+            int: Number of seconds between 0 and duration
+        
+        """
+        downtimes = self.stats_iter_svc_downtimes(service, start_date, duration, projection=self.stats_downtime_fields)
         
         down = 0
         for downtime in downtimes:
@@ -454,7 +614,7 @@ class Storage:
         if down > duration:
             down = duration
 
-        return 100 - ( down * 100 / duration )
+        return down
 
     def stats_get_svc_downtimes(self, service, start_date, duration):
         """Display a list of downtimes for a service during a defined period
@@ -465,8 +625,7 @@ class Storage:
             duration (int): number of seconds to analyze since start_date
         
         """
-        downtimes = self.stats_get_all_downtimes_svc(service, start_date, duration)
-        for downtime in downtimes:
+        for downtime in self.stats_iter_svc_downtimes(service, start_date, duration):
             print(downtime)
 
     def stats_get_all_downtimes(self, start_date, duration):
@@ -477,8 +636,161 @@ class Storage:
             duration (int): number of seconds to analyze since start_date
         
         """
-        for svc in self.stats_get_all_svc():
-            self.stats_get_svc_downtimes(svc, start_date, duration)
+        for downtime in self.stats_iter_all_downtimes(start_date, duration):
+            print(downtime)
+    
+    # STATS STREAMING API
+    # Generators that permit to consume stats with a bounded memory usage.
+    #
+    # projection: list of fields or dict like a MongoDB projection ({"extra": 0}, {"status": 1}, ...)
+    # batch_size: number of documents to get per round trip with the backend (if supported)
+    # sort: list of (field, direction) with direction 1 (ascending) or -1 (descending)
+    # limit: maximum number of documents (0 for no limit)
+    
+    def stats_project(self, document, projection):
+        """Apply a projection on a document
+        
+        Args:
+            document (dict): a document
+            projection (list, dict): fields to include (list or {field: 1}) or to exclude ({field: 0})
+        
+        Returns:
+            dict: A new document with the projection applied
+        """
+        if projection is None:
+            return document
+        
+        if type(projection) is not dict:
+            projection = dict.fromkeys(projection, 1)
+        
+        excluded = [field for field, value in projection.items() if not value]
+        included = [field for field, value in projection.items() if value]
+        
+        if len(included) == 0:
+            return {field: value for field, value in document.items() if field not in excluded}
+        
+        if "_id" not in excluded and "_id" not in included:
+            # like MongoDB, _id is always returned except if explicitly excluded
+            included.append("_id")
+        
+        return {field: document[field] for field in included if field in document}
+    
+    def stats_sort_key(self, sort):
+        """Key function to sort documents
+        
+        Args:
+            sort (list): list of (field, direction)
+        
+        Returns:
+            function: key function usable with sorted or heapq.merge
+        """
+        return lambda document: _SortKey([document.get(field) for field, direction in sort], [direction for field, direction in sort])
+    
+    def stats_apply(self, documents, projection=None, sort=None, limit=0):
+        """Apply projection, sort and limit on documents
+        
+        A sort needs to load all documents in memory so this should be done by the backend if possible.
+        
+        Args:
+            documents (iterable): documents
+        
+        Keyword Arguments:
+            projection (list, dict): see stats_project
+            sort (list): list of (field, direction)
+            limit (int): maximum number of documents (0 for no limit)
+        
+        Returns:
+            generator: documents
+        """
+        if sort:
+            documents = sorted(documents, key=self.stats_sort_key(sort))
+        
+        if limit:
+            documents = itertools.islice(documents, limit)
+        
+        for document in documents:
+            yield self.stats_project(document, projection)
+    
+    def stats_iter_all_svc(self, query={}, projection=None, batch_size=None, sort=None, limit=0):
+        """Iterate over all services
+        
+        Keyword Arguments:
+            query (dict): Filter supported by the backend on the function self.stats_get_all_svc
+            projection (list, dict): fields to include or to exclude
+            batch_size (int): number of documents per round trip with the backend
+            sort (list): list of (field, direction)
+            limit (int): maximum number of services (0 for no limit)
+        
+        Returns:
+            generator: Documents that represent a service
+        """
+        return self.stats_apply(self.stats_get_all_svc(query), projection, sort, limit)
+    
+    def stats_iter_svc_downtimes(self, service, start_date, duration, projection=None, batch_size=None, sort=None, limit=0):
+        """Iterate over downtimes of a service during a defined period
+        
+        Args:
+            service (object): anything supported by the backend on the function self.stats_get_all_downtimes_svc
+            start_date (int): epoch timestamp
+            duration (int): number of seconds to analyze since start_date
+        
+        Keyword Arguments:
+            projection (list, dict): fields to include or to exclude
+            batch_size (int): number of documents per round trip with the backend
+            sort (list): list of (field, direction)
+            limit (int): maximum number of downtimes (0 for no limit)
+        
+        Returns:
+            generator: Documents that represent a downtime
+        """
+        return self.stats_apply(self.stats_get_all_downtimes_svc(service, start_date, duration), projection, sort, limit)
+    
+    def stats_iter_all_downtimes(self, start_date, duration, query={}, projection=None, batch_size=None, limit=0):
+        """Iterate over downtimes of ALL services during a defined period
+        
+        Services are read with only their _id so memory usage does not depend on the number of services.
+        
+        Args:
+            start_date (int): epoch timestamp
+            duration (int): number of seconds to analyze since start_date
+        
+        Keyword Arguments:
+            query (dict): Filter on services
+            projection (list, dict): fields of the downtimes to include or to exclude
+            batch_size (int): number of documents per round trip with the backend
+            limit (int): maximum number of downtimes (0 for no limit)
+        
+        Returns:
+            generator: Documents that represent a downtime
+        """
+        downtimes = (downtime \
+            for svc in self.stats_iter_all_svc(query, projection={"_id": 1}, batch_size=batch_size) \
+            for downtime in self.stats_iter_svc_downtimes(svc, start_date, duration, projection=projection, batch_size=batch_size))
+        
+        if limit:
+            downtimes = itertools.islice(downtimes, limit)
+        
+        return downtimes
+
+class _SortKey:
+    """Comparable key for a multi-fields sort with mixed directions"""
+    
+    __slots__ = ("values", "directions")
+    
+    def __init__(self, values, directions):
+        self.values = values
+        self.directions = directions
+    
+    def __lt__(self, other):
+        for value, other_value, direction in zip(self.values, other.values, self.directions):
+            if value == other_value:
+                continue
+            if value is None or other_value is None:
+                # missing fields first (like MongoDB)
+                return (value is None) == (direction > 0)
+            return (value < other_value) == (direction > 0)
+        
+        return False
 
 class MongoStorage(Storage):
     """Mongo Storage
@@ -490,6 +802,40 @@ class MongoStorage(Storage):
     We DON'T store:
     - all check status as we consider only 2 status for a service: OK and FAIL.
     
+    With history_partitioning set to "monthly":
+    - uptime_history only keeps the open downtimes (and closed ones not yet moved)
+    - a closed downtime is moved to the partition of its start date (uptime_history_YYYYMM in UTC)
+    - uptime_history_partitions is the catalog of partitions with the max down_end_date stored on each of them
+    so a range query only reads uptime_history and the partitions that can overlap the range and the retention
+    is done by dropping old partitions (see history_retention).
+    
+    With an extra_policy, the extra data of a downtime is bounded:
+    - max_size: every string of extra is truncated to max_size characters (eg: IngressService response text)
+    - compress: extra is stored as a zlib compressed BSON binary (extra_z field)
+    - dedup: extra is stored once per content hash on the uptime_extra collection (extra_ref field)
+    stats_iter_svc_downtimes returns the extra decoded. The retention archives the extra referenced by a partition
+    with it and removes the ones not referenced anymore (see extra_gc).
+    
+    The uptime document of a service references its open downtime (down_id and down_start_date) so the current
+    status and the down time are known from the uptime collection only. Deployments created before need to call
+    migrate once (Server does it) to populate them. Until then, uptime_history is used.
+    A downtime is closed before its reference is removed. An open downtime not referenced by a service OK
+    (written by a previous version) is looked for once per process.
+    
+    With pools, 2 MongoClient are used:
+    - transitions: status changes reported by services (svc_all). Keep it small with a tuned write concern.
+    - stats: stats_*, consolidations and status computation. Reads can be routed to secondaries with larger batches.
+    db, uptime and uptime_history are on the transitions pool and stats_db, stats_uptime and stats_uptime_history
+    on the stats pool (same client without pools).
+    
+    A pool is a dict with the following optional keys:
+    - max_pool_size (int), min_pool_size (int)
+    - timeout (int): server selection timeout in seconds
+    - connect_timeout (int), socket_timeout (int): in seconds
+    - w (int, String), wtimeout (int): write concern (wtimeout in seconds)
+    - read_preference (String): eg: secondaryPreferred
+    - batch_size (int): default batch size of the stats queries (stats pool only)
+    
     Constructor
     
     Args:
@@ -498,6 +844,10 @@ class MongoStorage(Storage):
 
     Keyword Arguments:
         timeout (int): timeout in second to wait an answer from Mongo (default is 5s)
+        history_partitioning (String): None (default) or "monthly"
+        extra_policy (dict): None (default, extra is stored as is) or {"max_size": int, "compress": bool, "dedup": bool}
+        pools (dict): None (default, one client for everything) or {"transitions": dict, "stats": dict}
+        sla_cache (dict): None (default, no cache) or {"max_entries": int, "persist": bool, "ttl": int} (persisted on the sla_cache collection)
     
     """
     #uri = None
@@ -505,22 +855,55 @@ class MongoStorage(Storage):
     #db = None
     #uptime = None
     #uptime_history = None
+    #uptime_history_partitions = None
+    #history_partitioning = None
+    #extra_policy = None
+    #uptime_extra = None
+    #stats_client = None
+    #stats_db = None
+    #stats_uptime = None
+    #stats_uptime_history = None
+    #stats_batch_size = None
+    #storage_state = None
+    downtime_pointer = False
     timeout = 5000
     storage_id_svc = "_id_uptime"
     storage_id_downtime = "_id_uptime_history"
+    # Key set on the service once an open downtime without reference was looked for
+    storage_downtime_checked = "_uptime_downtime_checked"
+    history_partition_prefix = "uptime_history_"
 
-    def __init__(self, uri, db_name, timeout=None):
+    def __init__(self, uri, db_name, timeout=None, history_partitioning=None, extra_policy=None, pools=None, sla_cache=None):
         super().__init__()
         self.uri = uri
         if timeout is not None:
             self.timeout = timeout * 1000
+        
+        if history_partitioning not in (None, "monthly"):
+            raise Exception("history_partitioning %s is not supported" % (history_partitioning))
+        self.history_partitioning = history_partitioning
+        
+        self.extra_policy = extra_policy
+        
+        if pools is None:
+            pools = dict()
+        self.stats_client = None
+        self.stats_batch_size = pools.get("stats", {}).get("batch_size")
 
         try:
             # Init Mongo and create DB and collections objects
-            self.client = pymongo.MongoClient(self.uri, serverSelectionTimeoutMS=self.timeout)
+            self.client = self.pool_client(pools.get("transitions"))
             self.db = self.client[db_name]
             self.uptime = self.db.get_collection("uptime")
             self.uptime_history = self.db.get_collection("uptime_history")
+            
+            if pools.get("stats") is not None:
+                self.stats_client = self.pool_client(pools["stats"])
+                self.stats_db = self.stats_client[db_name]
+            else:
+                self.stats_db = self.db
+            self.stats_uptime = self.stats_db.get_collection("uptime")
+            self.stats_uptime_history = self.stats_db.get_collection("uptime_history")
 
             if len(self.uptime.index_information()) == 0:
                 # collection "uptime" does not exist
@@ -534,10 +917,65 @@ class MongoStorage(Storage):
                 # create it and create indexes
                 self.db.create_collection("uptime_history")
                 self.uptime_history.create_index("_id_uptime")
+            
+            if self.history_partitioning is not None:
+                self.uptime_history_partitions = self.db.get_collection("uptime_history_partitions")
+                
+                if len(self.uptime_history_partitions.index_information()) == 0:
+                    # collection "uptime_history_partitions" does not exist
+                    # create it and create indexes
+                    self.db.create_collection("uptime_history_partitions")
+                    self.uptime_history_partitions.create_index("start")
+            
+            self.uptime_extra = self.db.get_collection("uptime_extra")
+            
+            # migrations done
+            self.storage_state = self.db.get_collection("storage_state")
+            self.downtime_pointer = self.storage_state.find_one({"migration": "downtime_pointer"}) is not None
+            
+            if sla_cache is not None:
+                if sla_cache.get("persist", False):
+                    # stats_db can read on secondaries, an invalidation needs to be seen right away
+                    self.sla_cache = SLACache(sla_cache.get("max_entries"), \
+                        self.stats_db.get_collection("sla_cache", read_preference=pymongo.ReadPreference.PRIMARY), sla_cache.get("ttl"))
+                else:
+                    self.sla_cache = SLACache(sla_cache.get("max_entries"), ttl=sla_cache.get("ttl"))
 
         except:
             self.client = None
 
+    def pool_client(self, pool):
+        """Create a MongoClient for a pool
+        
+        Args:
+            pool (dict): pool configuration (see MongoStorage) or None for default settings
+        
+        Returns:
+            MongoClient: a client
+        """
+        if pool is None:
+            pool = dict()
+        
+        options = {"serverSelectionTimeoutMS": self.timeout}
+        if pool.get("timeout") is not None:
+            options["serverSelectionTimeoutMS"] = pool["timeout"] * 1000
+        if pool.get("connect_timeout") is not None:
+            options["connectTimeoutMS"] = pool["connect_timeout"] * 1000
+        if pool.get("socket_timeout") is not None:
+            options["socketTimeoutMS"] = pool["socket_timeout"] * 1000
+        if pool.get("max_pool_size") is not None:
+            options["maxPoolSize"] = pool["max_pool_size"]
+        if pool.get("min_pool_size") is not None:
+            options["minPoolSize"] = pool["min_pool_size"]
+        if pool.get("w") is not None:
+            options["w"] = pool["w"]
+        if pool.get("wtimeout") is not None:
+            options["wTimeoutMS"] = pool["wtimeout"] * 1000
+        if pool.get("read_preference") is not None:
+            options["readPreference"] = pool["read_preference"]
+        
+        return pymongo.MongoClient(self.uri, **options)
+
     def isReady(self):
         """ see Storage class """
         try:
@@ -549,6 +987,63 @@ class MongoStorage(Storage):
 
         return False
 
+    def preload(self, service):
+        """ see Storage class """
+        if service.storage_get(self.storage_id_svc) is not None:
+            return
+        
+        try:
+            self.query_exec_find_svc(service)
+        except:
+            pass
+
+    def migrate(self):
+        """Migrate an existing deployment
+        
+        This can be called on every start (idempotent).
+        Closed downtimes still available on uptime_history are moved to their partitions (see history_repair).
+        
+        Raises:
+            Exception: MongoDB issue
+        """
+        if not self.downtime_pointer:
+            self.migrate_downtime_pointer()
+        
+        moved = self.history_repair()
+        if moved > 0:
+            print("storage: %d closed downtimes moved to their partitions" % (moved))
+    
+    def migrate_downtime_pointer(self):
+        """Reference the open downtimes on the uptime documents (down_id and down_start_date)
+        
+        Downtimes written during the migration already maintain the reference. If multiple downtimes are open
+        for a service (inconsistent state), the most recent one is referenced.
+        
+        Raises:
+            Exception: MongoDB issue
+        """
+        print("storage: migrating downtime pointer ...")
+        
+        self.uptime.create_index("down_start_date", sparse=True)
+        
+        open_ids = []
+        for downtime in self.uptime_history.find({"down_end_date" : 0}, projection={"_id_uptime": 1, "down_start_date": 1}, \
+                sort=[("down_start_date", pymongo.ASCENDING)]):
+            open_ids.append(downtime["_id"])
+            # whatever the status: a downtime open on a service OK is closed by the next check (and a downtime
+            # closed in the meantime is not closed again, see query_exec_end_downtime)
+            self.uptime.update_one({"_id" : downtime["_id_uptime"]}, \
+                { "$set" : { "down_id" : downtime["_id"], "down_start_date" : downtime["down_start_date"] } })
+        
+        # references of downtimes closed
+        self.uptime.update_many({"down_id" : { "$exists" : True, "$nin" : open_ids }, "status" : Service.OK}, \
+            { "$unset" : { "down_id" : "", "down_start_date" : "" } })
+        
+        self.storage_state.update_one({"migration": "downtime_pointer"}, { "$set" : { "date" : time.time() } }, upsert=True)
+        self.downtime_pointer = True
+        
+        print("storage: migrating downtime pointer [DONE]")
+
     def query_exec_find_svc(self, service):
         """Query the DB to find a service
 
@@ -667,7 +1162,7 @@ class MongoStorage(Storage):
     def query_exec_new_downtime(self, service, id_svc, extra):
         """Query the DB to create a new service downtime
 
-        Update the status of the service and create a new downtime record.
+        Update the status of the service (with a reference to the downtime) and create a new downtime record.
         Cache the downtime _id on the service object
 
         Args:
@@ -683,16 +1178,31 @@ class MongoStorage(Storage):
 
         """
         try:
+            down_start_date = time.time()
+            id_downtime = ObjectId()
+            
             # update status to down
-            self.uptime.update_one({"_id" : id_svc}, { "$set": { "status" : Service.FAIL} })
+            self.uptime.update_one({"_id" : id_svc}, { "$set": { "status" : Service.FAIL, "down_id" : id_downtime, "down_start_date" : down_start_date } })
 
             # add downtime entry
-            if extra is None:
-                result = self.uptime_history.insert_one({"_id_uptime": id_svc, "down_start_date": time.time(), "down_end_date": 0})
-            else:
-                result = self.uptime_history.insert_one({"_id_uptime": id_svc, "down_start_date": time.time(), "down_end_date": 0, "extra": extra})
+            downtime = {"_id": id_downtime, "_id_uptime": id_svc, "down_start_date": down_start_date, "down_end_date": 0}
+            if extra is not None:
+                downtime.update(self.extra_encode(extra))
+            
+            try:
+                result = self.uptime_history.insert_one(downtime)
+            except:
+                # don't keep a reference to a downtime that doesn't exist (the next try will create it)
+                try:
+                    self.uptime.update_one({"_id" : id_svc, "down_id" : id_downtime}, { "$unset": { "down_id" : "", "down_start_date" : "" } })
+                except:
+                    pass
+                raise
         except:
             raise
+        
+        self.sla_cache_invalidate(id_svc, down_start_date)
+        self.transition_notify(id_svc, down_start_date)
 
         if result is not None:
             # store the downtime _id for re-use as the downtime is open
@@ -701,6 +1211,112 @@ class MongoStorage(Storage):
 
         raise Exception("Failed to create a new downtime")
 
+    def extra_truncate(self, extra, max_size):
+        """Truncate all strings of extra
+        
+        Args:
+            extra (object): extra data
+            max_size (int): maximum number of characters per string
+        
+        Returns:
+            object: extra data truncated
+        """
+        if type(extra) is str:
+            return extra[:max_size]
+        elif type(extra) is dict:
+            return {key: self.extra_truncate(value, max_size) for key, value in extra.items()}
+        elif type(extra) is list or type(extra) is tuple:
+            return [self.extra_truncate(value, max_size) for value in extra]
+        
+        return extra
+    
+    def extra_encode(self, extra):
+        """Apply the extra_policy on extra
+        
+        Args:
+            extra (object): extra data
+        
+        Returns:
+            dict: fields to set on the downtime Document
+        
+        Raises:
+            Exception: MongoDB issue
+        
+        """
+        if self.extra_policy is None:
+            return {"extra": extra}
+        
+        if self.extra_policy.get("max_size") is not None:
+            extra = self.extra_truncate(extra, self.extra_policy["max_size"])
+        
+        if not self.extra_policy.get("compress", False) and not self.extra_policy.get("dedup", False):
+            return {"extra": extra}
+        
+        data = bson.encode({"extra": extra})
+        if self.extra_policy.get("compress", False):
+            data = zlib.compress(data)
+        data = bson.Binary(data)
+        
+        if not self.extra_policy.get("dedup", False):
+            return {"extra_z": data}
+        
+        ref = hashlib.sha1(data).hexdigest()
+        # last_used protects the entry from a garbage collection in progress (see extra_gc)
+        self.uptime_extra.update_one({"_id": ref}, { "$setOnInsert" : {"data": data, "compressed": self.extra_policy.get("compress", False)}, \
+            "$set" : {"last_used": time.time()} }, upsert=True)
+        
+        return {"extra_ref": ref}
+    
+    def extra_decode(self, downtime):
+        """Restore the extra field of a downtime stored with an extra_policy
+        
+        Args:
+            downtime (dict): downtime Document
+        
+        Returns:
+            dict: the downtime Document with extra decoded
+        
+        Raises:
+            Exception: MongoDB issue
+        
+        """
+        if "extra_ref" in downtime:
+            result = self.stats_db.get_collection("uptime_extra").find_one({"_id": downtime.pop("extra_ref")})
+            if result is None:
+                return downtime
+            data = result["data"]
+            if result.get("compressed", False):
+                data = zlib.decompress(data)
+        elif "extra_z" in downtime:
+            data = zlib.decompress(downtime.pop("extra_z"))
+        else:
+            return downtime
+        
+        downtime["extra"] = bson.decode(data)["extra"]
+        return downtime
+    
+    def extra_projection(self, projection):
+        """Translate "extra" on a projection to the fields used by the extra_policy
+        
+        Args:
+            projection (list, dict): fields to include or to exclude
+        
+        Returns:
+            list, dict: The projection for MongoDB
+        """
+        if projection is None or self.extra_policy is None or "extra" not in projection:
+            return projection
+        
+        if type(projection) is not dict:
+            projection = dict.fromkeys(projection, 1)
+        
+        projection = dict(projection)
+        value = projection["extra"]
+        projection["extra_z"] = value
+        projection["extra_ref"] = value
+        
+        return projection
+
     def query_exec_end_downtime(self, service, id_svc, id_downtime):
         """Query the DB to close a service downtime
 
@@ -720,11 +1336,27 @@ class MongoStorage(Storage):
 
         """
         try:
+            # end downtime first: if it fails, the service keeps the reference and the next check closes it
+            # (a downtime already closed is not closed again)
+            down_end_date = time.time()
+            if self.history_partitioning is None:
+                # we only need the dates (no extra)
+                projection = self.stats_downtime_fields
+            else:
+                # the whole document needs to be moved to its partition
+                projection = None
+            downtime = self.uptime_history.find_one_and_update({"_id" : id_downtime, "down_end_date" : 0}, \
+                { "$set": { "down_end_date" : down_end_date } }, projection=projection, return_document=pymongo.ReturnDocument.AFTER)
+            
             # update status to up
-            self.uptime.update_one({"_id" : id_svc}, { "$set": { "status" : Service.OK } })
+            self.uptime.update_one({"_id" : id_svc}, { "$set": { "status" : Service.OK }, "$unset": { "down_id" : "", "down_start_date" : "" } })
             
-            # end downtime
-            result = self.uptime_history.update_one({"_id" : id_downtime}, { "$set": { "down_end_date" : time.time() } })
+            if downtime is not None:
+                self.sla_cache_invalidate(id_svc, downtime["down_start_date"], down_end_date)
+                self.transition_notify(id_svc, downtime["down_start_date"], down_end_date)
+                
+                if self.history_partitioning is not None:
+                    self.history_move_downtime(downtime)
         except:
             raise
         
@@ -779,10 +1411,23 @@ class MongoStorage(Storage):
             #       future...
 
             if id_downtime is None:
-                # try to find it
-                result = self.query_exec_find_current_downtime(service, id_svc)
-                if result is not None:
-                    id_downtime = result["_id"]
+                if self.downtime_pointer:
+                    # the open downtime is referenced by the service
+                    id_downtime = result_svc.get("down_id")
+                    if id_downtime is not None:
+                        service.storage_add(self.storage_id_downtime, id_downtime)
+                    elif result_svc["status"] == Service.OK and not service.storage_get(self.storage_downtime_checked):
+                        # an open downtime without reference on a service OK can only come from a writer closing
+                        # downtimes in the old order or from an interrupted migration: look for it once per process
+                        result = self.query_exec_find_current_downtime(service, id_svc)
+                        if result is not None:
+                            id_downtime = result["_id"]
+                        service.storage_add(self.storage_downtime_checked, True)
+                else:
+                    # try to find it
+                    result = self.query_exec_find_current_downtime(service, id_svc)
+                    if result is not None:
+                        id_downtime = result["_id"]
 
             if result_svc["status"] == status:
                 # The status on the db is the same than the one reported.
@@ -827,14 +1472,47 @@ class MongoStorage(Storage):
     # STATS (SLA, Status, incidents ...)
     #
 
-    def query_exec_find_all_downtimes(self, service, down_start_date, duration):
-        """Query the DB to find all downtimes of a service in a range of time
+    def query_find_options(self, projection=None, batch_size=None, sort=None, limit=0):
+        """Options for a find query
+        
+        Keyword Arguments:
+            projection (list, dict): fields to include or to exclude
+            batch_size (int): number of documents per round trip
+            sort (list): list of (field, direction)
+            limit (int): maximum number of documents (0 for no limit)
+        
+        Returns:
+            dict: keyword arguments for Collection.find
+        """
+        if batch_size is None:
+            batch_size = self.stats_batch_size
+        
+        options = dict()
+        if projection is not None:
+            options["projection"] = projection
+        if batch_size is not None:
+            options["batch_size"] = batch_size
+        if sort:
+            options["sort"] = sort
+        if limit:
+            options["limit"] = limit
+        
+        return options
+
+    def query_exec_find_all_downtimes(self, service, down_start_date, duration, projection=None, batch_size=None, sort=None, limit=0):
+        """Query the DB to find all downtimes of a service in a range of time
 
         Args:
             service (Service, dict, ObjectId): Service, MongoDB Document of the service, ObjectId of the service
             down_start_date (int): epoch timestamp
             duration (int): number of seconds to check if we have downtimes since down_start_date
 
+        Keyword Arguments:
+            projection (list, dict): fields to include or to exclude
+            batch_size (int): number of documents per round trip
+            sort (list): list of (field, direction)
+            limit (int): maximum number of documents (0 for no limit)
+
         Returns:
             list: List of Documents that represent a downtime between down_start_date and down_start_date + duration
 
@@ -853,35 +1531,292 @@ class MongoStorage(Storage):
             id_svc = self.query_exec_find_svc(service)["_id"]
         
         down_end_date = down_start_date + duration
+        
+        query = {
+            "$and" : [ 
+                { "_id_uptime" : id_svc }, 
+                { "$and" : [
+                    { "down_start_date" : { "$lt" : down_end_date} },
+                    { "$or" : [ { "down_end_date" : { "$gt" : down_start_date } }, { "down_end_date" : 0 } ]}
+                    ]} 
+                ]
+            }
+
+        options = self.query_find_options(projection, batch_size, sort, limit)
 
         try:
-            return self.uptime_history.find({  
-                "$and" : [ 
-                    { "_id_uptime" : id_svc }, 
-                    { "$and" : [
-                        { "down_start_date" : { "$lt" : down_end_date} },
-                        { "$or" : [ { "down_end_date" : { "$gt" : down_start_date } }, { "down_end_date" : 0 } ]}
-                        ]} 
-                    ]
-                })
+            if self.history_partitioning is None:
+                return self.stats_uptime_history.find(query, **options)
+            
+            downtimes = self.history_find(query, self.history_partitions_for_range(down_start_date, down_end_date), options)
+            if limit:
+                downtimes = itertools.islice(downtimes, limit)
+            
+            return downtimes
         except:
             raise
 
         return []
+    
+    #
+    # HISTORY PARTITIONING
+    #
+    
+    def history_partition_name(self, timestamp):
+        """Name of the partition for a date
+        
+        Args:
+            timestamp (int): epoch timestamp
+        
+        Returns:
+            String: Name of the collection (eg: uptime_history_201801)
+        """
+        date = datetime.fromtimestamp(timestamp, timezone.utc)
+        return self.history_partition_prefix + date.strftime("%Y%m")
+    
+    def history_partition_bounds(self, timestamp):
+        """Start and end of the partition for a date
+        
+        Args:
+            timestamp (int): epoch timestamp
+        
+        Returns:
+            float, float: start and end epoch timestamp of the partition (end excluded)
+        """
+        date = datetime.fromtimestamp(timestamp, timezone.utc)
+        start = datetime(date.year, date.month, 1, tzinfo=timezone.utc)
+        end = start + relativedelta(months=1)
+        return start.timestamp(), end.timestamp()
+    
+    def history_partition(self, downtime):
+        """Get the partition of a downtime
+        
+        The partition is created if needed (it can be dropped by another instance at any time so
+        this is not cached). The catalog is updated by history_move_downtime.
+        
+        Args:
+            downtime (dict): downtime Document
+        
+        Returns:
+            Collection: The partition
+        
+        Raises:
+            Exception: MongoDB issue
+        
+        """
+        name = self.history_partition_name(downtime["down_start_date"])
+        partition = self.db.get_collection(name)
+        partition.create_index( [("_id_uptime", pymongo.ASCENDING), ("down_start_date", pymongo.ASCENDING)] )
+        if self.extra_policy is not None and self.extra_policy.get("dedup", False):
+            partition.create_index("extra_ref", sparse=True)
+        
+        return partition
+    
+    def history_move_downtime(self, downtime):
+        """Move a closed downtime from uptime_history to its partition
+        
+        The move is idempotent (same _id) so it can be replayed if something failed in the middle.
+        
+        Args:
+            downtime (dict): closed downtime Document
+        
+        Raises:
+            Exception: MongoDB issue
+        
+        """
+        partition = self.history_partition(downtime)
+        partition.replace_one({"_id": downtime["_id"]}, downtime, upsert=True)
+        
+        # always registered on the catalog as the partition can be dropped by another instance
+        # a downtime can end after the end of its partition so we need to remember it for range queries
+        start, end = self.history_partition_bounds(downtime["down_start_date"])
+        self.uptime_history_partitions.update_one({"_id": partition.name}, \
+            { "$setOnInsert" : {"start": start, "end": end}, "$max" : {"max_down_end_date": max(end, downtime["down_end_date"])} }, upsert=True)
+        
+        self.uptime_history.delete_one({"_id": downtime["_id"]})
+    
+    def history_repair(self):
+        """Move all closed downtimes still available on uptime_history to their partitions
+        
+        That can happen if MongoDB was not available during a move or for downtimes written before the partitioning was enabled.
+        
+        Returns:
+            int: Number of downtimes moved
+        
+        Raises:
+            Exception: MongoDB issue
+        
+        """
+        if self.history_partitioning is None:
+            return 0
+        
+        moved = 0
+        for downtime in self.uptime_history.find({"down_end_date" : { "$ne" : 0 }}):
+            self.history_move_downtime(downtime)
+            moved = moved + 1
+        
+        return moved
+    
+    def history_partitions_for_range(self, start_date, end_date):
+        """Partitions that can contain a downtime overlapping the range
+        
+        Args:
+            start_date (int): epoch timestamp
+            end_date (int): epoch timestamp
+        
+        Returns:
+            list: List of partition names (oldest first)
+        
+        Raises:
+            Exception: MongoDB issue
+        
+        """
+        partitions = self.stats_db.get_collection("uptime_history_partitions").find({ "start" : { "$lt" : end_date }, "max_down_end_date" : { "$gt" : start_date } }, \
+            {"_id": 1}).sort("start", pymongo.ASCENDING)
+        
+        return [partition["_id"] for partition in partitions]
+    
+    def history_find(self, query, partitions, options={}):
+        """Find downtimes on partitions and on uptime_history
+        
+        A downtime can be available twice if a move was interrupted so we only return it once.
+        With a sort, every collection is sorted by MongoDB and we merge them.
+        
+        Args:
+            query (dict): MongoDB filter
+            partitions (list): List of partition names
+        
+        Keyword Arguments:
+            options (dict): see query_find_options
+        
+        Returns:
+            generator: Documents that represent a downtime
+        
+        Raises:
+            Exception: MongoDB issue
+        
+        """
+        cursors = [self.stats_db.get_collection(name).find(query, **options) for name in partitions]
+        cursors.append(self.stats_uptime_history.find(query, **options))
+        
+        if options.get("sort"):
+            downtimes = heapq.merge(*cursors, key=self.stats_sort_key(options["sort"]))
+        else:
+            downtimes = itertools.chain(*cursors)
+        
+        seen = set()
+        for downtime in downtimes:
+            if "_id" in downtime:
+                if downtime["_id"] in seen:
+                    continue
+                seen.add(downtime["_id"])
+            yield downtime
+    
+    def history_retention(self, before, archive_path=None):
+        """Drop all partitions that end before a date
+        
+        Retention is done per partition and not per document. Partitions can be archived first on
+        the cold format: a gzip file with all BSON documents (same format than mongodump --gzip).
+        The extra referenced by the partition (extra_policy dedup) are archived on <partition>.uptime_extra.bson.gz
+        and the ones not referenced anymore are removed from uptime_extra.
+        
+        Args:
+            before (int): epoch timestamp
+        
+        Keyword Arguments:
+            archive_path (String): Directory where to archive partitions before dropping them (no archive by default)
+        
+        Returns:
+            list: List of partition names dropped
+        
+        Raises:
+            Exception: MongoDB or archive issue
+        
+        """
+        if self.history_partitioning is None:
+            print("history retention: history_partitioning is not enabled")
+            return []
+        
+        # entries used after this date are kept (a downtime referencing them can be written right now)
+        used_before = time.time() - 300
+        
+        dropped = []
+        refs = set()
+        for partition in self.uptime_history_partitions.find({ "end" : { "$lte" : before } }):
+            name = partition["_id"]
+            partition_refs = [ref for ref in self.db.get_collection(name).distinct("extra_ref") if ref is not None]
+            
+            if archive_path is not None:
+                with gzip.open(os.path.join(archive_path, name + ".bson.gz"), "wb") as f:
+                    for downtime in self.db.get_collection(name).find():
+                        f.write(bson.encode(downtime))
+                
+                if len(partition_refs) > 0:
+                    with gzip.open(os.path.join(archive_path, name + ".uptime_extra.bson.gz"), "wb") as f:
+                        for extra in self.uptime_extra.find({"_id": { "$in" : partition_refs }}):
+                            f.write(bson.encode(extra))
+            
+            refs.update(partition_refs)
+            self.db.drop_collection(name)
+            self.uptime_history_partitions.delete_one({"_id": name})
+            dropped.append(name)
+            
+            print("history retention: %s dropped" % (name))
+        
+        if len(refs) > 0:
+            removed = self.extra_gc(refs, used_before)
+            print("history retention: %d extra removed" % (removed))
+        
+        return dropped
+    
+    def extra_gc(self, refs, used_before):
+        """Remove extra of uptime_extra that are not referenced anymore
+        
+        Args:
+            refs (set): extra_ref to check
+            used_before (float): epoch timestamp, only the entries not used since are removed
+        
+        Returns:
+            int: Number of extra removed
+        
+        Raises:
+            Exception: MongoDB issue
+        
+        """
+        collections = [self.uptime_history]
+        for partition in self.uptime_history_partitions.find({}, {"_id": 1}):
+            collections.append(self.db.get_collection(partition["_id"]))
+        
+        for collection in collections:
+            collection.create_index("extra_ref", sparse=True)
+        
+        removed = 0
+        for ref in refs:
+            if any(collection.find_one({"extra_ref": ref}, {"_id": 1}) is not None for collection in collections):
+                continue
+            
+            result = self.uptime_extra.delete_one({"_id": ref, "last_used": { "$not" : { "$gte" : used_before } }})
+            removed = removed + result.deleted_count
+        
+        return removed
 
     # STATS
 
-    def stats_get_all_svc(self, query={}):
+    def stats_get_all_svc(self, query={}, projection=None, batch_size=None, sort=None, limit=0):
         """Get all services
         
         Keyword Arguments:
             query (dict): Filter to pass to MongoDB query
+            projection (list, dict): fields to include or to exclude
+            batch_size (int): number of documents per round trip
+            sort (list): list of (field, direction)
+            limit (int): maximum number of documents (0 for no limit)
 
         Returns:
             list: List of Documents that represent the content of the uptime collection
         """
         try:
-            return self.uptime.find(query)
+            return self.stats_uptime.find(query, **self.query_find_options(projection, batch_size, sort, limit))
         except:
             raise
         
@@ -892,6 +1827,19 @@ class MongoStorage(Storage):
     def stats_get_all_downtimes_svc(self, service, start_date, duration):
         """see query_exec_find_all_downtimes"""
         return self.query_exec_find_all_downtimes(service, start_date, duration)
+    
+    def stats_iter_all_svc(self, query={}, projection=None, batch_size=None, sort=None, limit=0):
+        """see Storage class (projection, sort and limit are done by MongoDB)"""
+        return self.stats_get_all_svc(query, projection, batch_size, sort, limit)
+    
+    def stats_iter_svc_downtimes(self, service, start_date, duration, projection=None, batch_size=None, sort=None, limit=0):
+        """see Storage class (projection, sort and limit are done by MongoDB)"""
+        downtimes = self.query_exec_find_all_downtimes(service, start_date, duration, self.extra_projection(projection), batch_size, sort, limit)
+        
+        if self.extra_policy is None:
+            return downtimes
+        
+        return (self.extra_decode(downtime) for downtime in downtimes)
 
     # Clean Up
 
@@ -900,9 +1848,341 @@ class MongoStorage(Storage):
             try:
                 self.uptime = None
                 self.uptime_history = None
+                self.stats_uptime = None
+                self.stats_uptime_history = None
                 self.db = None
+                self.stats_db = None
                 self.client.close()
+                if self.stats_client is not None:
+                    self.stats_client.close()
             except:
                 pass
     
 
+class MemoryStorage(Storage):
+    """Memory Storage
+    
+    Store services and downtimes in memory with the same documents layout than MongoStorage.
+    This is useful to run the Server without MongoDB (dry run) or to profile the monitoring
+    without the storage latency (benchmark).
+    
+    Nothing is persisted and everything is lost when the process stops.
+    
+    There is no lock on this storage:
+    - a service is always checked by only one task so its documents are only updated by one thread.
+    - new documents are added with a single dict assignment (atomic for CPython)
+    - stats are working on a snapshot of the documents
+    
+    Constructor
+    
+    Keyword Arguments:
+        latency (float): number of seconds to wait on every query to simulate a remote backend (default is 0)
+        failure_rate (float): probability (0.0-1.0) that a query will fail to simulate a backend issue (default is 0)
+        sla_cache (dict): None (default, no cache) or {"max_entries": int, "ttl": int}
+    
+    """
+    #uptime = dict()
+    #uptime_history = dict()
+    #uptime_index = dict()
+    #open_downtimes = dict()
+    latency = 0
+    failure_rate = 0
+    storage_id_svc = "_id_uptime"
+    storage_id_downtime = "_id_uptime_history"
+    
+    def __init__(self, latency=None, failure_rate=None, sla_cache=None):
+        super().__init__()
+        if latency is not None:
+            self.latency = latency
+        if failure_rate is not None:
+            self.failure_rate = failure_rate
+        if sla_cache is not None:
+            self.sla_cache = SLACache(sla_cache.get("max_entries"), ttl=sla_cache.get("ttl"))
+        
+        # _id -> Document
+        self.uptime = dict()
+        self.uptime_history = dict()
+        
+        # service identity -> _id of the service
+        self.uptime_index = dict()
+        
+        # _id of the service -> list of _id of downtimes
+        self.history_index = dict()
+        
+        # _id of the service -> _id of the current downtime
+        self.open_downtimes = dict()
+    
+    def query_inject(self):
+        """Simulate the backend latency and failures
+        
+        Raises:
+            Exception: Injected failure
+        
+        """
+        if self.latency > 0:
+            time.sleep(self.latency)
+        
+        if self.failure_rate > 0 and random.random() < self.failure_rate:
+            raise Exception("Injected failure")
+    
+    def query_svc_key(self, service):
+        """Identity of a service
+        
+        Args:
+            service (Service): a specific service
+        
+        Returns:
+            tuple: identity (same fields than the MongoStorage query) or type(service) is not supported (None)
+        """
+        if type(service) is MongoService:
+            return (service.category, "Mongo", None, service.name)
+        elif type(service) is IngressService:
+            return (service.category, "Ingress", service.ns, service.url)
+        elif type(service) is KubernetesService:
+            return (service.category, "Kubernetes", None, service.name)
+        elif type(service) is ElasticsearchService:
+            return (service.category, "Elasticsearch", None, service.name)
+        
+        return None
+    
+    def query_exec_find_svc(self, service):
+        """Find a service
+        
+        Args:
+            service (Service): a specific service
+        
+        Returns:
+            dict: Document of the service or Not available (None)
+        
+        Raises:
+            Exception: Injected failure
+        
+        """
+        self.query_inject()
+        
+        id_svc = self.uptime_index.get(self.query_svc_key(service))
+        if id_svc is None:
+            return None
+        
+        # Store the ObjectId on the service itself for caching
+        service.storage_add(self.storage_id_svc, id_svc)
+        
+        return self.uptime[id_svc]
+    
+    def query_exec_new_svc(self, service):
+        """Create a new service
+        
+        Args:
+            service (Service): service object
+        
+        Returns:
+            ObjectId: _id of the service or type(service) is not supported (None)
+        
+        Raises:
+            Exception: Injected failure
+        
+        """
+        self.query_inject()
+        
+        key = self.query_svc_key(service)
+        if key is None:
+            return None
+        
+        category, kind, ns, description = key
+        document = {"_id": ObjectId(), "category": category, "kind": kind, "description": description, "status": Service.OK}
+        if ns is not None:
+            document["ns"] = ns
+        
+        # Only the first writer wins if the same service is created twice
+        id_svc = self.uptime_index.setdefault(key, document["_id"])
+        if id_svc == document["_id"]:
+            self.history_index[id_svc] = []
+            self.uptime[id_svc] = document
+        
+        # Store the ObjectId on the service itself for caching
+        service.storage_add(self.storage_id_svc, id_svc)
+        
+        return id_svc
+    
+    def query_exec_new_downtime(self, service, id_svc, extra):
+        """Create a new service downtime
+        
+        Args:
+            service (Service): Service object
+            id_svc (ObjectId): _id of the service
+            extra (object): extra data
+        
+        Returns:
+            ObjectId: The current downtime _id
+        
+        Raises:
+            Exception: Injected failure
+        
+        """
+        self.query_inject()
+        
+        document = {"_id": ObjectId(), "_id_uptime": id_svc, "down_start_date": time.time(), "down_end_date": 0}
+        if extra is not None:
+            document["extra"] = extra
+        
+        self.uptime_history[document["_id"]] = document
+        self.history_index[id_svc].append(document["_id"])
+        self.open_downtimes[id_svc] = document["_id"]
+        self.uptime[id_svc].update({"status": Service.FAIL, "down_id": document["_id"], "down_start_date": document["down_start_date"]})
+        self.sla_cache_invalidate(id_svc, document["down_start_date"])
+        self.transition_notify(id_svc, document["down_start_date"])
+        
+        # store the downtime _id for re-use as the downtime is open
+        service.storage_add(self.storage_id_downtime, document["_id"])
+        
+        return document["_id"]
+    
+    def query_exec_end_downtime(self, service, id_svc, id_downtime):
+        """Close a service downtime
+        
+        Args:
+            service (Service): Service object
+            id_svc (ObjectId): _id of the service
+            id_downtime (ObjectId): _id of the downtime to close
+        
+        Returns:
+            None: Specific usage to reset the id_downtime to None directly.
+        
+        Raises:
+            Exception: Injected failure
+        
+        """
+        self.query_inject()
+        
+        self.uptime_history[id_downtime]["down_end_date"] = time.time()
+        self.open_downtimes.pop(id_svc, None)
+        self.uptime[id_svc]["status"] = Service.OK
+        self.uptime[id_svc].pop("down_id", None)
+        self.uptime[id_svc].pop("down_start_date", None)
+        self.sla_cache_invalidate(id_svc, self.uptime_history[id_downtime]["down_start_date"], self.uptime_history[id_downtime]["down_end_date"])
+        self.transition_notify(id_svc, self.uptime_history[id_downtime]["down_start_date"], self.uptime_history[id_downtime]["down_end_date"])
+        
+        # remove the cached _id as the downtime is closed
+        service.storage_remove(self.storage_id_downtime)
+        
+        return None
+    
+    def svc_all(self, service, status, extra):
+        """see Storage class
+        
+        Every query is injecting the failure before any write so the memory is always consistent
+        and we don't need to recover from a partial update like MongoStorage.
+        """
+        
+        super().svc_all(service, status, extra)
+        try:
+            id_svc = service.storage_get(self.storage_id_svc)
+            
+            if id_svc is None:
+                result_svc = self.query_exec_find_svc(service)
+                if result_svc is None:
+                    id_svc = self.query_exec_new_svc(service)
+                    if id_svc is None:
+                        return False
+                else:
+                    id_svc = result_svc["_id"]
+            
+            if self.uptime[id_svc]["status"] == status:
+                # Nothing todo as everything is inline with Monitoring and Storage
+                return True
+            
+            if status != Service.OK:
+                self.query_exec_new_downtime(service, id_svc, extra)
+            else:
+                self.query_exec_end_downtime(service, id_svc, self.open_downtimes[id_svc])
+        except:
+            return False
+        else:
+            return True
+    
+    def query_exec_find_current_downtime(self, service, id_svc):
+        """Find the current downtime of a service
+        
+        Args:
+            service (Service): Service object or None
+            id_svc (ObjectId): _id of the service
+        
+        Returns:
+            dict: The current downtime record for the service or No current downtime (None)
+        
+        """
+        id_downtime = self.open_downtimes.get(id_svc)
+        if id_downtime is None:
+            return None
+        
+        if service is not None:
+            service.storage_add(self.storage_id_downtime, id_downtime)
+        
+        return self.uptime_history.get(id_downtime)
+    
+    def query_exec_find_all_downtimes(self, service, down_start_date, duration):
+        """Find all downtimes of a service in a range of time
+        
+        Args:
+            service (Service, dict, ObjectId): Service, Document of the service, ObjectId of the service
+            down_start_date (int): epoch timestamp
+            duration (int): number of seconds to check if we have downtimes since down_start_date
+        
+        Returns:
+            list: List of Documents that represent a downtime between down_start_date and down_start_date + duration
+        
+        """
+        if type(service) is ObjectId:
+            id_svc = service
+        elif type(service) is dict:
+            id_svc = service["_id"]
+        else:
+            id_svc = self.uptime_index.get(self.query_svc_key(service))
+        
+        down_end_date = down_start_date + duration
+        
+        downtimes = []
+        for id_downtime in self.history_index.get(id_svc, [])[:]:
+            downtime = self.uptime_history[id_downtime]
+            if downtime["down_start_date"] < down_end_date and \
+                    (downtime["down_end_date"] > down_start_date or downtime["down_end_date"] == 0):
+                downtimes.append(dict(downtime))
+        
+        return downtimes
+    
+    # STATS
+    
+    def stats_get_all_svc(self, query={}, projection=None, batch_size=None, sort=None, limit=0):
+        """Get all services
+        
+        Keyword Arguments:
+            query (dict): Filter (equality only) on the service Documents
+            projection (list, dict): fields to include or to exclude
+            batch_size (int): not used
+            sort (list): list of (field, direction)
+            limit (int): maximum number of documents (0 for no limit)
+        
+        Returns:
+            list: List of Documents that represent the content of the uptime collection
+        """
+        services = (dict(svc) for svc in list(self.uptime.values()) \
+            if all(svc.get(key) == value for key, value in query.items()))
+        
+        return list(self.stats_apply(services, projection, sort, limit))
+    
+    def stats_iter_all_svc(self, query={}, projection=None, batch_size=None, sort=None, limit=0):
+        """see Storage class"""
+        return self.stats_get_all_svc(query, projection, batch_size, sort, limit)
+    
+    def stats_get_svc(self, service):
+        """see query_exec_find_svc"""
+        id_svc = self.uptime_index.get(self.query_svc_key(service))
+        if id_svc is None:
+            return None
+        
+        return dict(self.uptime[id_svc])
+    
+    def stats_get_all_downtimes_svc(self, service, start_date, duration):
+        """see query_exec_find_all_downtimes"""
+        return self.query_exec_find_all_downtimes(service, start_date, duration)
+    